@@ -0,0 +1,126 @@
+# Import basic libraries
+import sys
+import time
+import threading
+import Queue
+import collections
+
+
+# Exception raised in a worker (sys.exc_info()), handed to the consumer in place of a batch. 
+WorkerError = collections.namedtuple('WorkerError', ['exc_info'])
+
+
+class BatchPrefetcher(object):
+	"""
+	Description: Builds training batches on background threads, while the model trains on the current batch.
+	Replaces a single training generator in train_epoch (both the in-house loop and model.fit_generator).
+	Implementation Notes:
+	+ Each worker thread owns its own generator (created with generator_factory). So, the batches are built in parallel (a single shared generator would build them one at a time).
+	++ Each generator shuffles the images independently. So, with more than one worker, the images are not visited in a single fixed order per pass (same as the random batches of a single generator).
+	+ At most queue_size batches are built ahead of the consumer (bounds memory).
+	+ Thread-safe: Batches can be requested from several threads (e.g. fit_generator with workers > 1).
+	+ Threads are sufficient since the decoding (PIL/cv2) and most of the numpy work release the GIL.
+	+ An exception in a worker is raised in the consumer (and in every later request for a batch, also from other consumer threads).
+	+ After stop(), requests for a batch raise StopIteration. The consumers never block forever, since the queue is polled (this also keeps Ctrl-C working in python 2).
+	"""
+
+	def __init__(self, generator_factory, num_workers=4, queue_size=8):
+		"""
+		Args
+		generator_factory: Function without arguments that returns a new (infinite) generator of batches, e.g. lambda: data.create_custom_labeled_generator(...)
+		num_workers: Number of worker threads (and generators).
+		queue_size: Maximum number of batches built ahead of the consumer.
+		"""
+		self.generator_factory = generator_factory
+		self.num_workers = max(1, num_workers)
+		self.queue = Queue.Queue(maxsize=max(1, queue_size))
+		self.stop_event = threading.Event()
+		self.lock = threading.Lock()
+		self.worker_error = None # The first WorkerError received by a consumer
+
+		# Throughput tracking
+		self.batch_count = 0
+		self.wait_time = 0.0 # Time the consumer was blocked, waiting for a batch
+
+		self.workers = [threading.Thread(target=self._run_worker) for _ in range(self.num_workers)]
+		for worker in self.workers:
+			worker.daemon = True # Don't keep the training script alive
+			worker.start()
+
+
+	def _run_worker(self):
+		try:
+			generator = self.generator_factory()
+			while not self.stop_event.is_set():
+				self._put(next(generator))
+		except Exception:
+			self._put(WorkerError(sys.exc_info()))
+
+
+	def _put(self, item):
+		""" Adds item to the queue, unless the prefetcher is stopped first. """
+		while not self.stop_event.is_set():
+			try:
+				self.queue.put(item, timeout=0.1)
+				return
+			except Queue.Full:
+				pass
+
+
+	def __iter__(self):
+		return self
+
+
+	def next(self):
+		"""
+		Returns the next batch (in the same format as the generators).
+		"""
+		wait_start = time.time()
+		while True:
+			if self.stop_event.is_set():
+				self._raise_stopped()
+
+			try:
+				item = self.queue.get(timeout=0.1)
+				break
+			except Queue.Empty:
+				pass
+		wait_time = time.time() - wait_start
+
+		with self.lock:
+			self.wait_time += wait_time
+			self.batch_count += 1
+
+		# Re-raise the exception of a worker
+		if isinstance(item, WorkerError):
+			with self.lock:
+				if self.worker_error is None:
+					self.worker_error = item
+			self.stop()
+			self._raise_stopped()
+
+		return item
+
+	__next__ = next
+
+
+	def _raise_stopped(self):
+		""" Raises the first exception of a worker. Raises StopIteration if the prefetcher was stopped without an exception. """
+		with self.lock:
+			worker_error = self.worker_error
+
+		if worker_error is None:
+			raise StopIteration
+
+		exc_type, exc_value, exc_traceback = worker_error.exc_info
+		raise exc_type, exc_value, exc_traceback
+
+
+	def get_wait_time(self):
+		with self.lock:
+			return self.wait_time
+
+
+	def stop(self):
+		""" Stops the worker threads (batches already in the queue are dropped). """
+		self.stop_event.set()
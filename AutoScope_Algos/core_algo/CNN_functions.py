@@ -13,12 +13,17 @@ import re
 
 #Import keras libraries
 from tensorflow.python.keras.utils import plot_model
+from tensorflow.python.keras.models import load_model as load_keras_model
 from tensorflow.python.keras._impl.keras import backend as K
 
 # import from local libraries
 import ClassifyParticlesData  
 import classification_models as createModel
 import ClassifyParticles_config
+from StreamingMetrics import StreamingMetrics
+
+# Supported values of config.inference_precision (the float type of the weights and activations used for prediction)
+inference_precision_options = ['float32', 'float16']
 
 
 def save_struct_to_file(history, file_path):
@@ -48,11 +53,23 @@ def get_json_log(log_path):
 
 def validate_segmentation_config(config):
 	assert(config.nclasses == config.segmentation_metadata["nclasses"]) # Check that the data creation nclasses is the same as the model nclasses. 
+	validate_inference_precision(config)
+	if (config.tile_inference):
+		assert(config.tile_size[0]%32 == 0 and config.tile_size[1]%32 == 0) # Tiles need to line up with the pooling grid of the model. 
+		assert(config.tile_overlap%32 == 0)
+		assert(config.tile_size[0] <= config.target_size[0] and config.tile_size[1] <= config.target_size[1])
+		assert(config.tile_overlap < min(config.tile_size))
+	assert(config.tile_inference or not config.prefilter_tiles) # The pre-filter skips tiles. 
+
+
+def validate_inference_precision(config):
+	assert(config.inference_precision in inference_precision_options)
 
 
 def validate_classification_config(config):
 	assert(config.nclasses == config.classification_metadata["nclasses"]) # Check that the data creation nclasses is the same as the model nclasses. 
 	assert(config.nclasses == len(config.class_mapping))
+	validate_inference_precision(config)
 	print config.nclasses
 	print len(glob.glob(config.train_images_dir + "*"))
 	assert(config.nclasses == len(glob.glob(config.train_images_dir + "*")))
@@ -94,10 +111,10 @@ def freeze_lower_layers(model, layer_name):
 
 def get_pixel_accuracy_perBatch(all_truth, all_pred):
 	'Return the accuracy given the predicted labels and the ground truth labels for an entire batch.'
-	correct_prediction = np.equal(np.argmax(all_truth, axis=2), np.argmax(all_pred, axis=2))
-	pixel_accuracy = np.mean(correct_prediction.astype(np.float))
+	metrics = StreamingMetrics(all_truth.shape[-1])
+	metrics.update(all_truth, all_pred)
 
-	return pixel_accuracy
+	return metrics.get_accuracy()
 
 
 def get_pixel_accuracy_perImage(img_truth, img_pred):
@@ -110,14 +127,10 @@ def get_pixel_accuracy_perImage(img_truth, img_pred):
 
 def get_confusion_matrix(all_truth, all_pred): 
 	'Caculate a confusion matrix given the predicted labels and the ground truth labels. '
+	metrics = StreamingMetrics(all_truth.shape[1])
+	metrics.update(all_truth, all_pred)
 
-	classes = all_truth.shape[1] # Get total classes
-	truth_class = np.argmax(all_truth, axis=1)
-	pred_class = np.argmax(all_pred, axis=1) 
-	confusion = np.zeros((classes, classes), dtype=float)
-	for num, truth_cl in enumerate(truth_class): 
-		confusion[truth_cl, pred_class[num]] += 1
-	return confusion
+	return metrics.get_confusion_matrix()
 
 def get_classification_accuracy_perBatch(all_truth, all_pred):
 	'Return the accuracy given the predicted labels and the ground truth labels. '
@@ -126,10 +139,33 @@ def get_classification_accuracy_perBatch(all_truth, all_pred):
 	return accuracy
 
 
+def log_training_step_times(logger, step_count, image_count, elapsed_time, data_wait_time=None):
+	"""
+	Description: Logs the training throughput, and the time per step spent blocked on data vs. spent in compute (training). 
+	Args
+	step_count: The number of batches trained. 
+	image_count: The number of images trained. 
+	elapsed_time: Total time (in seconds) spent on the steps. 
+	data_wait_time: Total time (in seconds) blocked waiting on batches. None if unknown. 
+	"""
+	if (step_count == 0) or (elapsed_time <= 0):
+		return
+
+	logger.info("Training throughput: %0.1f images/sec (including data loading and augmentation)", image_count/elapsed_time)
+	if data_wait_time is not None:
+		logger.info("Time per step: %0.4fs blocked on data, %0.4fs compute (%0.1f%% blocked on data)", 
+			data_wait_time/step_count, (elapsed_time - data_wait_time)/step_count, 100*data_wait_time/elapsed_time)
+
+
 def predArray_to_predMatrix(pred_array, target_size):
 	"""
 	Description: Convert prediction array (categorical) to a matrix with each pixel labeled with maximum class. 
+	Compact predictions (label maps with integer type) are already labeled, and only reshaped. 
 	"""
+	# Compact prediction: already in label format. 
+	if np.issubdtype(pred_array.dtype, np.integer):
+		return np.reshape(pred_array, target_size)
+
 	# Convert from categorical format to label format. 
 	pred_labeled = np.argmax(pred_array, axis=1) 
 	# Reshape into single channel images. 
@@ -137,6 +173,21 @@ def predArray_to_predMatrix(pred_array, target_size):
 	return pred_matrix
 
 
+def predArray_to_compactPrediction(pred_array, target_size, include_confidence=False):
+	"""
+	Description: Convert prediction array (categorical) to the compact format produced by segmentation_models.FCN8_compact_output. 
+	Returns
+	label_map: uint8 (height, width) matrix with each pixel labeled with maximum class. 
+	confidence_map: uint8 (height, width) matrix with the quantized max-probability. None if include_confidence is False. 
+	"""
+	label_map = np.reshape(np.argmax(pred_array, axis=1), target_size).astype(np.uint8)
+
+	confidence_map = None
+	if (include_confidence):
+		confidence_map = np.reshape(np.round(np.max(pred_array, axis=1)*255.0), target_size).astype(np.uint8)
+
+	return label_map, confidence_map
+
 
 def apply_morph(img_input, morph_type=None):
 	"""
@@ -188,12 +239,13 @@ def apply_morph(img_input, morph_type=None):
 
 	return img_output
 
-def standard_segmentation(img_input, min_particle_size):
+def standard_segmentation(img_input, min_particle_size, logger=None):
 	"""
 	Description: Applies standard segmentation algorithm to transform greyscale image to segmented image. 
 	Uses adaptive thresholding, morphology functions, and component analysis. 
 	Args
 	img_input: Raw, grayscale autoscope image. 
+	logger: If given, the number of original components is logged. 
 	Output: Segmented image, with each pixel labeled as either 0 (background) or 1 (foreground). Single channel image. 
 	"""
 	
@@ -208,18 +260,17 @@ def standard_segmentation(img_input, min_particle_size):
 	# Filter markers based on each marker property. 
 	connected_output = cv2.connectedComponentsWithStats(im_morph, connectivity=8)
 	base_num_labels = connected_output[0]
-	print "Number of Original Components: %d" % (base_num_labels - 1) # Minus 1 since we don't count the background
+	if logger is not None:
+		logger.info("Number of Original Components: %d", base_num_labels - 1) # Minus 1 since we don't count the background
 	base_markers = connected_output[1]
 	base_stats = connected_output[2]
 
-	# Loop over each marker. Based on stats, decide to eliminate or include marker. 
-	for index in range(base_num_labels):
-		# The first label is the background (zero label). We always ignore it. . 
-		if index == 0:
-			continue
-		# Area: If any connected component has an area less than "min_particle_size" pixels, turn it into a background (black)
-		if base_stats[index][4] <= min_particle_size:
-			im_morph[base_markers == index] = 0
+	# Based on stats, decide to eliminate or include each marker (looked up for all pixels at once). 
+	# Area: If any connected component has an area less than "min_particle_size" pixels, turn it into a background (black)
+	keep_marker = base_stats[:, cv2.CC_STAT_AREA] > min_particle_size
+	# The first label is the background (zero label). We always ignore it. 
+	keep_marker[0] = False
+	im_morph = keep_marker[base_markers].astype(np.uint8)
 
 	# After the obvious components have been removed, the rest of the components are consolidated by closing the particles. 
 	struct_element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (4,4))
@@ -240,6 +291,8 @@ def get_foreground_accuracy_perImage(truth_array, pred_array, config, radius, ba
 	Arguments 
 	truth_array: Single ground truth array in (image_pixels, classes)
 	pred_array: Single predictions array in (image_pixels, classes)
+	Returns
+	The particle detection counts (see determine_segmentation_accuracy)
 	"""
 	
 	# Convert from prediction arrays to labeled matrices
@@ -251,7 +304,7 @@ def get_foreground_accuracy_perImage(truth_array, pred_array, config, radius, ba
 	truth_reshaped = apply_morph(truth_reshaped, morph_type=None) # Just converts to binary image
 	pred_reshaped = apply_morph(pred_reshaped, morph_type='foreground')
 
-	determine_segmentation_accuracy(truth_reshaped, pred_reshaped, config, radius, base_output_path)
+	return determine_segmentation_accuracy(truth_reshaped, pred_reshaped, config, radius, base_output_path)
 
 
 def determine_segmentation_accuracy(truth_matrix, pred_matrix, config, radius, base_output_path):
@@ -261,6 +314,8 @@ def determine_segmentation_accuracy(truth_matrix, pred_matrix, config, radius, b
 	Arguments 
 	truth_matrix: Binary matrix with segmented pixels (0 is background, and 1 is foreground)
 	pred_matrix: Predicted binary matrix with segmented pixels (0 is background, and 1 is foreground)
+	Returns
+	Dictionary with the particle detection counts: 'truth', 'pred', 'intersection', 'only_truth', 'only_pred'
 	Guiding heuristics
 	+ For each ground truth particle, the algorthm determines if there is a predicted particle in the region of interest. The same predicted particle blob can  be used twice for different ground truth particles. 
 	+ Possible Improvement: A current issue is that ground truth and predicted particles merge into a single particle. The connectedComponentsWithStats treats these merged particles as a single particle, leading to errors both in the wrongly detected and missed detections. A solution is to look at any pixel in region of interest, instead of just looking at the centroid. 
@@ -350,6 +405,13 @@ def determine_segmentation_accuracy(truth_matrix, pred_matrix, config, radius, b
 		cv2.imwrite(base_output_path + "_truth.jpg", truth_output)
 		cv2.imwrite(base_output_path + "_pred.jpg", pred_output)
 
+	return {
+		'truth': total_ground_truth_particles, 
+		'pred': total_pred_particles, 
+		'intersection': intersection_of_pred_and_truth, 
+		'only_truth': only_truth_particles, 
+		'only_pred': only_pred_particles}
+
 def nearest_centroid(centroid, array_of_centroids):
 	"""
 	Calculates the closest point in array_of_centroids to centroid. 
@@ -415,6 +477,25 @@ def get_crop_coordinates(input_image_shape, centroid, target_dim):
 	return x1,x2,y1,y2
 
 
+def get_available_memory():
+	"""
+	Description: Returns the memory (in bytes) available to new processes. Returns None if it cannot be determined. 
+	On Linux, uses MemAvailable (includes reclaimable caches). Otherwise, falls back to the free physical pages. 
+	"""
+	# Linux
+	if (os.path.exists('/proc/meminfo')):
+		with open('/proc/meminfo', 'r') as meminfo:
+			for line in meminfo:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1])*1024 # Given in kB
+
+	# Other POSIX systems
+	try:
+		return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+	except (ValueError, OSError, AttributeError):
+		return None
+
+
 def load_model(model, path, config):
 
 	if path is  None: 
@@ -427,6 +508,86 @@ def load_model(model, path, config):
 
 
 
+def build_model_for_inference(build_model, input_shape, config):
+	"""
+	Description: Builds a model for prediction and loads the trained weights, without loading any weights twice. 
+	+ If config.model_artifact_file exists, the complete model (architecture + weights) is loaded from this single file. 
+	+ Otherwise, the architecture is built. The imagenet weights are only loaded when there is no checkpoint (config.weight_file_input) that overwrites them. 
+	+ If config.model_artifact_file is given but doesn't exist yet, it's created. So, the next startup loads the artifact. 
+	+ The artifact is rebuilt (and overwritten) when the weight file is newer than the artifact, or when its input shape doesn't match input_shape (e.g. after toggling tile_inference). 
+	+ The model is built with config.inference_precision ('float32' or 'float16') weights and activations. The model artifact is only used with float32. 
+	Args
+	build_model: The model builder, called as build_model(input_shape, base_weights, classes). E.g. segmentation_models.FCN8_32px_factor
+	input_shape: The input shape of the model. Note: A model artifact is saved with a fixed input shape. 
+	"""
+	# The model artifact is stored in float32. So, it's only used with float32 inference. 
+	use_artifact = (config.model_artifact_file is not None) and (config.inference_precision == 'float32')
+
+	if use_artifact and os.path.isfile(config.model_artifact_file):
+		if is_model_artifact_outdated(config):
+			config.logger.info("Model artifact %s is older than %s. Rebuilding it.", config.model_artifact_file, config.weight_file_input)
+		else:
+			model = load_keras_model(config.model_artifact_file, compile=False)
+			if (get_image_input_shape(model) == tuple(input_shape)):
+				config.logger.info("Load Model artifact from %s", config.model_artifact_file)
+				return model
+			config.logger.info("Model artifact %s has input shape %s instead of %s. Rebuilding it.", config.model_artifact_file, get_image_input_shape(model), tuple(input_shape))
+
+	# The layers create their weights and activations with the default float type. 
+	# The float32 weights are cast to the inference precision when loaded. 
+	default_floatx = K.floatx()
+	default_epsilon = K.epsilon()
+	K.set_floatx(config.inference_precision)
+	if (config.inference_precision == 'float16'):
+		K.set_epsilon(1e-4) # The default epsilon (1e-7) underflows in float16
+	try:
+		model = build_model(input_shape = input_shape, base_weights = get_base_weights_for_inference(config), classes=config.nclasses)
+
+		# Load weights (if the load file exists)
+		load_model(model, config.weight_file_input, config)
+	finally:
+		K.set_floatx(default_floatx)
+		K.set_epsilon(default_epsilon)
+
+	config.logger.info("Inference precision: %s", config.inference_precision)
+
+	if use_artifact:
+		save_model(model, config.model_artifact_file, config)
+
+	return model
+
+
+def is_model_artifact_outdated(config):
+	"""
+	Description: Returns True if the weight file (config.weight_file_input) was modified after the model artifact was saved. 
+	"""
+	if (config.weight_file_input is None) or (not os.path.isfile(config.weight_file_input)):
+		return False
+
+	return os.path.getmtime(config.weight_file_input) > os.path.getmtime(config.model_artifact_file)
+
+
+def get_image_input_shape(model):
+	"""
+	Description: Returns the input shape of the image input (the first input), without the batch dimension. 
+	"""
+	input_shape = model.input_shape
+	if isinstance(input_shape, list): # Models with several inputs (e.g. base_model_with_pos)
+		input_shape = input_shape[0]
+
+	return tuple(input_shape[1:])
+
+
+def get_base_weights_for_inference(config):
+	"""
+	Description: Returns the imagenet weights file. Returns None if a checkpoint (config.weight_file_input) exists, since the checkpoint overwrites all the imagenet weights. 
+	"""
+	if (config.weight_file_input is not None) and os.path.isfile(config.weight_file_input):
+		return None
+
+	return config.imagenet_weights_file
+
+
 def save_model(model, path, config):
 	if path is  None: 
 		config.logger.info("Attempted save model weights. No save location given in configuration.")
@@ -486,6 +647,15 @@ def print_summary_statistics_for_labels(label_list, class_mapping, config, disca
 
 	# Get counts for each of the particle labels
 	label_count_dic = count_labels(label_list, class_mapping)
+
+	print_summary_statistics_for_label_counts(label_count_dic, class_mapping, config, discard_label=discard_label, image_count=image_count)
+
+
+def print_summary_statistics_for_label_counts(label_count_dic, class_mapping, config, discard_label= None, image_count = 1):
+	"""
+	Description: Same as print_summary_statistics_for_labels, but for labels that are already counted (see count_labels). 
+	Allows the summary to be updated incrementally (e.g. one canvas image at a time), without keeping all the labels. 
+	"""
 	# Count total number of labels
 	total_labels = sum(label_count_dic.values())
 	# Count the total number of particles => discarding the discard_label
@@ -504,7 +674,7 @@ def print_summary_statistics_for_labels(label_list, class_mapping, config, disca
 		# Calculate metrics
 		perPrimas = label_count_dic[label]/float(image_count) #calculates average per primas microscope image
 		perHPF = perPrimas*k_primas_to_HPF # converts to perHPF
-		particle_percent = 100*label_count_dic[label]/float(total_particles)
+		particle_percent = 100*label_count_dic[label]/float(total_particles) if total_particles > 0 else 0.0
 
 		# Print results
 		# Pretty print the percent
@@ -593,12 +763,8 @@ def initialize_classification_model(log_dir=None):
 	# Instantiate training/validation data
 	data = ClassifyParticlesData.ClassifyParticlesData(config)
 
-	# Builds model 
-	model = createModel.base_model_with_pos(input_shape = config.image_shape, base_weights = config.imagenet_weights_file, classes=config.nclasses)
-
-
-	# Load weights (if the load file exists)
-	load_model(model, config.weight_file_input, config)
+	# Builds model and loads weights
+	model = build_model_for_inference(createModel.base_model_with_pos, config.image_shape, config)
 
 	return model, data
 
@@ -0,0 +1,92 @@
+# Import basic libraries
+import os
+import json
+from datetime import datetime
+
+"""
+Description: On-disk record of the canvas images of a solution folder that are already processed. Allows a restarted watch_folder_daemon.py to resume where it left off.
+
+Implementation Notes:
++ Each canvas is recorded after all its outputs are written. So, a canvas is either recorded with its complete results, or processed again after a restart.
++ The label counts of the solution are updated with each recorded canvas (the labels of previous canvases are not needed for the summary statistics).
++ The manifest is written to a temporary file first, and then renamed. So, an interrupted write never corrupts the manifest.
+"""
+
+manifest_file_name = "processed_manifest.json"
+
+
+class CanvasManifest(object):
+
+	def __init__(self, root_folder, class_mapping):
+		"""
+		Args
+		root_folder: The solution folder that contains the canvas images. The manifest is stored in this folder.
+		class_mapping: dict that maps {label (int): class name (str)}
+		"""
+		self.root_folder = root_folder
+		self.manifest_path = root_folder + manifest_file_name
+		self.class_mapping = class_mapping
+
+		# Resume from the previous session (if any)
+		self.canvases = {}
+		self.failed_canvases = {}
+		self.label_counts = {label: 0 for label in class_mapping}
+		if os.path.isfile(self.manifest_path):
+			with open(self.manifest_path, 'r') as manifest_file:
+				manifest = json.load(manifest_file)
+			self.canvases = manifest["canvases"]
+			self.failed_canvases = manifest["failed_canvases"]
+			# JSON keys are strings
+			for label, count in manifest["label_counts"].iteritems():
+				self.label_counts[int(label)] = count
+
+
+	def is_done(self, file_name):
+		""" Returns True if the canvas was processed (or failed) in this or a previous session. """
+		return (file_name in self.canvases) or (file_name in self.failed_canvases)
+
+
+	def get_canvas_count(self):
+		return len(self.canvases)
+
+
+	def record_canvas(self, file_name, label_list):
+		"""
+		Description: Records a processed canvas, and adds its labels to the label counts of the solution. Saves the manifest.
+		Args
+		file_name: The file name of the canvas image (in root_folder).
+		label_list: The label of each particle on the canvas.
+		"""
+		canvas_counts = {label: 0 for label in self.class_mapping}
+		for label in label_list:
+			canvas_counts[int(label)] += 1
+		for label, count in canvas_counts.iteritems():
+			self.label_counts[label] += count
+
+		self.canvases[file_name] = {
+			"processed_time": datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
+			"label_counts": canvas_counts}
+		self.save()
+
+
+	def record_failure(self, file_name, error):
+		"""
+		Description: Records a canvas that can't be processed, so it is not retried after a restart. Saves the manifest.
+		"""
+		self.failed_canvases[file_name] = {
+			"failed_time": datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
+			"error": error}
+		self.save()
+
+
+	def save(self):
+		manifest = {
+			"canvas_count": len(self.canvases),
+			"label_counts": self.label_counts,
+			"canvases": self.canvases,
+			"failed_canvases": self.failed_canvases}
+
+		temp_path = self.manifest_path + ".tmp"
+		with open(temp_path, 'w') as manifest_file:
+			json.dump(manifest, manifest_file, indent=1)
+		os.rename(temp_path, self.manifest_path)
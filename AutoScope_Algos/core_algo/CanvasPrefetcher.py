@@ -0,0 +1,102 @@
+# Import basic libraries
+import time
+import collections
+import itertools
+from multiprocessing.pool import ThreadPool
+
+
+# A single decoded canvas. index is the position of the canvas in image_path_list. 
+Canvas = collections.namedtuple('Canvas', ['index', 'image_path', 'original_img', 'img_input'])
+
+
+class CanvasPrefetcher(object):
+	"""
+	Description: Decodes and preprocesses canvas images on background threads, while the model predicts the current canvas. 
+	Each canvas is decoded a single time. Both the original image (for cropping/labeling) and the model input are handed to the consumer. 
+	Implementation Notes: 
+	+ At most prefetch_count canvases are decoded ahead of the consumer (bounds memory). 
+	+ Canvases are returned in the order of image_path_list. 
+	+ Threads are sufficient since cv2/PIL decoding and resizing release the GIL. 
+	"""
+
+	def __init__(self, data, image_path_list, prefetch_count=2, num_workers=2):
+		"""
+		Args
+		data: SegmentParticlesData instance used to decode/preprocess the canvas images. 
+		image_path_list: List of paths to the canvas images. 
+		prefetch_count: Maximum number of canvases decoded ahead of the consumer. 
+		num_workers: Number of decoding threads. 
+		"""
+		self.data = data
+		self.image_path_list = list(image_path_list)
+		self.prefetch_count = max(1, prefetch_count)
+		self.num_workers = max(1, num_workers)
+
+		# Throughput tracking
+		self.canvas_count = 0
+		self.wait_time = 0.0 # Time the consumer was blocked, waiting for a decoded canvas
+		self.start_time = None
+		self.end_time = None
+
+
+	def _load_canvas(self, index, image_path):
+		original_img, img_input = self.data.load_canvas(image_path, new_size = self.data.config.target_size)
+		return Canvas(index, image_path, original_img, img_input)
+
+
+	def __iter__(self):
+		"""
+		Yields a Canvas for each path in image_path_list. 
+		"""
+		self.start_time = time.time()
+		pool = ThreadPool(self.num_workers)
+		path_iterator = enumerate(self.image_path_list)
+		pending = collections.deque()
+
+		try:
+			# Fill the prefetch queue
+			for index, image_path in itertools.islice(path_iterator, self.prefetch_count):
+				pending.append(pool.apply_async(self._load_canvas, (index, image_path)))
+
+			while pending:
+				wait_start = time.time()
+				canvas = pending.popleft().get()
+				self.wait_time += time.time() - wait_start
+
+				# Start decoding the next canvas before handing the current canvas to the consumer. 
+				for index, image_path in itertools.islice(path_iterator, 1):
+					pending.append(pool.apply_async(self._load_canvas, (index, image_path)))
+
+				self.canvas_count += 1
+				yield canvas
+		finally:
+			pool.terminate()
+			self.end_time = time.time()
+
+
+	def iter_batches(self, batch_size):
+		"""
+		Yields lists of up to batch_size Canvas objects. 
+		"""
+		canvas_iterator = iter(self)
+		while True:
+			canvas_batch = list(itertools.islice(canvas_iterator, batch_size))
+			if not canvas_batch:
+				return
+			yield canvas_batch
+
+
+	def log_throughput(self, logger):
+		"""
+		Prints the throughput of the pipeline (canvases/sec) and the time the consumer was blocked on decoding. 
+		"""
+		if self.start_time is None:
+			return
+
+		end_time = self.end_time if self.end_time is not None else time.time()
+		elapsed_time = end_time - self.start_time
+		throughput = self.canvas_count/elapsed_time if elapsed_time > 0 else 0.0
+
+		logger.info("Canvas Pipeline Results")
+		logger.info("Canvases processed: %d, Total time: %0.2fs, Throughput: %0.3f canvases/sec", self.canvas_count, elapsed_time, throughput)
+		logger.info("Time waiting on canvas decoding: %0.2fs (%0.1f%% of total)", self.wait_time, 100*self.wait_time/elapsed_time if elapsed_time > 0 else 0.0)
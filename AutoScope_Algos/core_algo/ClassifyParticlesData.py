@@ -6,19 +6,26 @@ import glob
 import os
 import math
 from datetime import datetime
+import time
 from collections import defaultdict
 import random
 import itertools
+import threading
 import cv2
 import re
 
 
 # Import keras libraries
 from tensorflow.python.keras.preprocessing import image as image_keras
-from tensorflow.python.keras.preprocessing.image import ImageDataGenerator, flip_axis, random_shift, random_rotation
+from tensorflow.python.keras.preprocessing.image import ImageDataGenerator, flip_axis
 
 # Import local libraries
 import CNN_functions
+import CropShard
+from StreamingMetrics import StreamingMetrics
+from CropCache import CropCache
+from PackedDataset import PackedDataset
+from BatchPrefetcher import BatchPrefetcher
 
 
 class ClassifyParticlesData(object):
@@ -28,6 +35,9 @@ class ClassifyParticlesData(object):
 		self.config = config
 		self.train_count = 0 
 		self.image_train_count = 0 
+		self.crop_shards = {} # Maps shard paths to opened (memory-mapped) CropShards
+		self.crop_shards_lock = threading.Lock() # The generators of a BatchPrefetcher open the shards on different threads
+		self.crop_cache = None if config.crop_cache_size_mb is None else CropCache(config.crop_cache_size_mb) # Shared by all the generators of this instance
 
 
 
@@ -41,10 +51,23 @@ class ClassifyParticlesData(object):
 		for iris_class_path in list_of_classes:
 			iris_class_name = iris_class_path.split("/")[-1]
 
-			classes_dict[iris_class_name] +=  len(glob.glob(iris_class_path + "/*"))
+			classes_dict[iris_class_name] +=  self._count_images_in_folder(iris_class_path)
 
 		return classes_dict
 
+
+	def _count_images_in_folder(self, folder_path):
+		"""
+		Description: Counts the images in folder_path. A shard counts as the number of crops it contains (and its sidecar index is ignored). 
+		"""
+		cnt = 0
+		for path in glob.glob(folder_path + "/*"):
+			if path.endswith(CropShard.shard_suffix):
+				cnt += len(self._get_crop_shard(path))
+			elif not path.endswith(CropShard.index_suffix):
+				cnt += 1
+		return cnt
+
 	def _get_batches_per_epoch(self, directory, batch_size):
 		"""
 		Args: 
@@ -75,7 +98,7 @@ class ClassifyParticlesData(object):
 		for r, dirs, _ in os.walk(directory):
 			# Count images in sub-directories. 
 			for dr in dirs:
-				cnt += len(glob.glob(os.path.join(r, dr + "/*")))
+				cnt += self._count_images_in_folder(os.path.join(r, dr))
 		return cnt
 
 
@@ -264,7 +287,7 @@ class ClassifyParticlesData(object):
 		print "Batches per Epoch for Validation: %d"%(self.config.batches_per_epoch_val)
 
 		# Setup list of training images.
-		images_list = glob.glob(target_directory + '*/*.bmp') # path to training data
+		images_list = self.get_crop_list(target_directory) # path to training data
 		
 		# Verify class mapping dictionary
 		# Specifically, verify that the auto-generated mapping is identical to the config mapping
@@ -281,89 +304,210 @@ class ClassifyParticlesData(object):
 
 		# Shuffle image list
 		random.shuffle(images_list)
+		feature_table = self.get_custom_feature_table(images_list) if self.config.enable_custom_features else None
 
 		#  Returns generator that cycles through the list of images
-		images_iterator = itertools.cycle(images_list)
+		index_iterator = itertools.cycle(range(len(images_list)))
 
 		# Provide an image and the corresponding path. 
 		while(True): 
-			x_inputs, y_labels, _ = self._get_batch_of_images(images_iterator, 
+			x_inputs, y_labels, _ = self._get_batch_of_images(images_list, index_iterator, 
 				include_labels=True, 
 				include_custom_features=self.config.enable_custom_features,
-				augment_data=augment_data)
+				augment_data=augment_data, 
+				feature_table=feature_table)
 
 
 			yield x_inputs, y_labels
 
 
+	def create_packed_labeled_generator(self, pack_prefix, augment_data):
+		"""
+		Description: Identical to create_custom_labeled_generator(), but reads the crops from a packed dataset (see PackedDataset). 
+		Each batch is gathered from the memory-mapped arrays with a single fancy-index. 
+		Args
+		pack_prefix: Path to the packed dataset, without the suffix (e.g. config.train_pack_prefix). 
+		"""
+		dataset = PackedDataset(pack_prefix)
+
+		# Verify that the crops were packed with the current configuration
+		if (self.config.class_mapping != dataset.get_class_mapping()):
+			raise ValueError("class_mapping in class configuration doesn't match with the packed dataset. Please reconcile.")
+		if (self.config.target_size != dataset.get_target_size()) or (self.config.color != dataset.get_color()):
+			raise ValueError("target_size/color in class configuration doesn't match with the packed dataset. Please pack the dataset again.")
+
+		preprocess = self.get_preprocess_func()
+		one_hot_labels = np.eye(len(self.config.class_mapping))
+
+		# Cycles through the crops in a new random order for each pass
+		batch_indices = np.zeros(0, dtype=np.int64)
+		while(True):
+			while (len(batch_indices) < self.config.batch_size):
+				batch_indices = np.concatenate([batch_indices, dataset.get_epoch_indices(self.config.packed_balance_classes)])
+
+			images, labels, features = dataset.get_batch(np.sort(batch_indices[:self.config.batch_size]))
+			batch_indices = batch_indices[self.config.batch_size:]
+
+			# Normalize each image (the preprocess functions normalize a single image), then augment the batch
+			image_input = self._transform_batch(np.array([preprocess(x) for x in images.astype(np.float32)]), augment_data)
+
+			if (self.config.enable_custom_features):
+				x_inputs = {'image_input': image_input, 'features_input': features}
+			else: 
+				x_inputs = image_input
+
+			yield x_inputs, one_hot_labels[labels]
+
+
 	def create_custom_prediction_generator(self, pred_dir_path):
 		"""
 		Description: Creates a generator that returns images to be predicted. 
+		Yields (x_inputs, path_list, valid_mask) tuples, in the same format as create_prediction_iterator. 
 		Return
 		x_inputs: Numpy array that includes the images in the folders within pred_dir_path + the centroids of the corresponding image. 
 		path_list: Python list that includes the path to the images in x_input
+		valid_mask: Always True for each image (the generator cycles, so there is no padding). 
+		Note: Cycles through the images (never exhausted). Use create_prediction_iterator to predict each image exactly once. 
 		"""
 		# Symmetrically list images
-		images_list = glob.glob(pred_dir_path + "*/*.bmp")
+		images_list = self.get_crop_list(pred_dir_path)
 
 		# Shuffle lists
 		random.shuffle(images_list)
+		feature_table = self.get_custom_feature_table(images_list) if self.config.enable_custom_features else None
 
 		#  Returns generator that cycles through the list of images
-		images_iterator = itertools.cycle(images_list)
+		index_iterator = itertools.cycle(range(len(images_list)))
 
 		# Provide an image and the corresponding path. 
 		while(True): 
 			# Get batch of inputs and their corresponding path lists. 
 			x_inputs, _, path_list = self._get_batch_of_images(
-				images_iterator, 
+				images_list, 
+				index_iterator, 
 				include_labels=False, 
 				include_custom_features = self.config.enable_custom_features,
-				augment_data=False)
+				augment_data=False, 
+				feature_table=feature_table)
 			
 
-			yield x_inputs, path_list
+			yield x_inputs, path_list, np.ones(len(path_list), dtype=bool)
 
 
-	def _get_batch_of_images(self, images_iterator, include_labels, include_custom_features, augment_data):
+	def create_prediction_iterator(self, pred_dir_path, fixed_flips=None):
+		"""
+		Description: Creates a finite generator that returns each image in pred_dir_path exactly once (in the order of get_crop_list). 
+		The last batch is padded to batch_size by repeating its last image. 
+		Args
+		fixed_flips: (flip_horizontal, flip_vertical) applied to every image instead of the random flips. None for random flips. 
+		Return
+		x_inputs: Same as create_custom_prediction_generator. Always batch_size images. 
+		path_list: Python list that includes the path to the images in x_input (None for padding). 
+		valid_mask: Bool array that is False for padding. 
+		"""
+		images_list = self.get_crop_list(pred_dir_path)
+		feature_table = self.get_custom_feature_table(images_list) if self.config.enable_custom_features else None
+		batch_size = self.config.batch_size
+
+		for batch_start in range(0, len(images_list), batch_size):
+			batch_indices = range(batch_start, min(batch_start+batch_size, len(images_list)))
+			x_inputs, _, path_list = self._get_batch_of_images(
+				images_list, 
+				iter(batch_indices), 
+				include_labels=False, 
+				include_custom_features = self.config.enable_custom_features,
+				augment_data=False, 
+				batch_size=len(batch_indices), 
+				feature_table=feature_table, 
+				fixed_flips=fixed_flips)
+
+			# Pad the last batch
+			pad_count = batch_size - len(batch_indices)
+			valid_mask = np.arange(batch_size) < len(batch_indices)
+			if (pad_count > 0):
+				if isinstance(x_inputs, dict):
+					x_inputs = {name: self._pad_batch(x_input, pad_count) for name, x_input in x_inputs.iteritems()}
+				else:
+					x_inputs = self._pad_batch(x_inputs, pad_count)
+				path_list = path_list + [None]*pad_count
+
+			yield x_inputs, path_list, valid_mask
+
+
+	def _pad_batch(self, batch, pad_count):
+		""" Repeats the last item of batch pad_count times. """
+		return np.concatenate([batch, np.repeat(batch[-1:], pad_count, axis=0)], axis=0)
+
+
+	def get_crop_list(self, directory):
+		"""
+		Description: Lists all crops within the subfolders of directory. 
+		Return
+		crop_list: Python list that includes 1) the path to each .bmp crop and 2) a CropShard.ShardCrop reference to each crop stored in a shard. 
+		"""
+		crop_list = glob.glob(directory + '*/*.bmp')
+
+		for shard_path in CropShard.get_shard_paths(directory + '*/'):
+			crop_list.extend(self._get_crop_shard(shard_path).get_crop_refs())
+
+		return crop_list
+
+
+	def _get_crop_shard(self, shard_path):
+		"""
+		Description: Returns the CropShard for shard_path. Each shard is only opened once (thread-safe). 
+		"""
+		with self.crop_shards_lock:
+			if shard_path not in self.crop_shards:
+				self.crop_shards[shard_path] = CropShard.CropShard(shard_path)
+
+			return self.crop_shards[shard_path]
+
+
+	def _get_batch_of_images(self, crop_list, index_iterator, include_labels, include_custom_features, augment_data, batch_size=None, feature_table=None, fixed_flips=None):
 		"""
 		Description: Get a batch of images with the corresponding 1) labels and 2) load paths for each image. 
 		Args: 
-		images_iterator: Iterator that yiels a single path to a single input image
+		crop_list: List of paths to input images (or CropShard.ShardCrop), e.g. from get_crop_list()
+		index_iterator: Iterator that yields the index (within crop_list) of a single input image
 		include_labels: Bool that indicates if labels should be generated for this batch. 
 		include_custom_features: Bool that indicates if centroid feature should be included in x_inputs
 		augment_data: Bool that indicates if real time data augmentation should be applied
+		batch_size: The number of images in the batch. If None, config.batch_size. 
+		feature_table: The custom features of each crop in crop_list (see get_custom_feature_table). Only needed with include_custom_features. 
+		fixed_flips: (flip_horizontal, flip_vertical) applied to every image instead of the random flips. None for random flips. 
 		"""
 		image_input = []
-		coordinates_input = []
 		label_list = []
 		path_list = []
+		batch_indices = []
+
+		if batch_size is None:
+			batch_size = self.config.batch_size
 
-		for i in range(self.config.batch_size):
+		for i in range(batch_size):
 
 			# Get image path 
-			image_path = next(images_iterator)
+			crop_index = next(index_iterator)
+			image_path = crop_list[crop_index]
+			batch_indices.append(crop_index)
 			path_list.append(image_path)
 
-			# Get image
-			image_input.append(self._get_image_from_dir(image_path, augment_data, new_size = self.config.target_size))
+			# Get image (augmented below, as a batch)
+			image_input.append(self._get_cached_image_from_dir(image_path, new_size = self.config.target_size))
 
 			# Get labels (if include_labels is True)
 			if (include_labels):
 				label_list.append(self._get_label_from_imgPath(image_path))
 
-			# Get image cordinates
-			if (include_custom_features):
-				crop_filename = image_path[image_path.rfind('/')+1:] # Identify image_path file name
-				coordinate_features = self._get_custom_features(crop_filename)
-				coordinates_input.append(coordinate_features)
-
 		# Build + format objects to be returned
 		# Create x_inputs
+		image_input = self._transform_batch(np.array(image_input), augment_data, fixed_flips)
 		if (include_custom_features):
-			x_inputs = {'image_input': np.array(image_input), 'features_input': np.array(coordinates_input, dtype=np.float32)}
+			# Get image cordinates
+			x_inputs = {'image_input': image_input, 'features_input': feature_table[batch_indices]}
 		else: 
-			x_inputs = np.array(image_input)
+			x_inputs = image_input
 
 		# Create y_labels
 		if (include_labels):
@@ -374,6 +518,27 @@ class ClassifyParticlesData(object):
 		return x_inputs, y_labels, path_list
 
 
+	def create_inputs_from_crops(self, crop_list, centroid_list):
+		"""
+		Description: Builds the model inputs for crops that are already in memory (e.g. crops produced by the segmentation model). 
+		Args
+		crop_list: List of crops (BGR format, as produced by cv2). 
+		centroid_list: The centroid of each crop on the canvas, given in (width, height) format. 
+		Return
+		x_inputs: Same format as the x_inputs of _get_batch_of_images(). 
+		"""
+		image_input = [self._get_image_from_array(crop, augment_data=False, new_size=self.config.target_size) for crop in crop_list]
+
+		if (self.config.enable_custom_features):
+			# Truncate the centroids, so the features are identical to the features parsed from a crop filename
+			coordinate_pos = np.array([[float(int(centroid[0])), float(int(centroid[1]))] for centroid in centroid_list]).reshape(-1, 2)
+			x_inputs = {'image_input': np.array(image_input), 'features_input': self.get_custom_feature_array(coordinate_pos)}
+		else: 
+			x_inputs = np.array(image_input)
+
+		return x_inputs
+
+
 	def _get_custom_features(self, crop_filename):
 		"""
 		crop_filename: Extract, calculate and normalize the custom features. Specifically, get position information. 
@@ -391,6 +556,18 @@ class ClassifyParticlesData(object):
 		# Determine raw coordinate_pos (already returned as float)
 		coordinate_pos = CNN_functions.get_coordinates_from_cropname(crop_filename)
 
+		return self.get_custom_features_from_coordinates(coordinate_pos)
+
+
+	def get_custom_features_from_coordinates(self, coordinate_pos):
+		"""
+		Description: Calculate and normalize the custom features from the raw coordinate position of a crop. 
+		Args
+		coordinate_pos: The raw coordinate position with the origin at pixel (0,0), given in (width, height) format. 
+		Return
+		normalized_pos_list: See _get_custom_features()
+		"""
+
 		# Swith from (height, width) to (width, height)
 		dims_w_h = [float(self.config.canvas_dims[1]), float(self.config.canvas_dims[0])]
 
@@ -417,6 +594,54 @@ class ClassifyParticlesData(object):
 		return normalized_pos_list
 
 
+	def get_custom_feature_table(self, crop_list):
+		"""
+		Description: Calculates the custom features of all the crops in crop_list (e.g. a directory or a shard) a single time. 
+		The batch builders look up the features of each crop by its index in crop_list. 
+		Return
+		feature_table: float32 array of size (crops, features). Identical to np.array(_get_custom_features(crop_filename), dtype=np.float32) for each crop. 
+		"""
+		coordinate_pos = [CNN_functions.get_coordinates_from_cropname(CropShard.get_crop_name(crop_ref)) for crop_ref in crop_list]
+
+		return self.get_custom_feature_array(np.array(coordinate_pos, dtype=np.float64).reshape(-1, 2))
+
+
+	def get_custom_feature_array(self, coordinate_pos):
+		"""
+		Description: Vectorized get_custom_features_from_coordinates(). Each operation is identical to the scalar implementation (in float64), so the features are identical as well. 
+		Args
+		coordinate_pos: float64 array of size (crops, 2) with the raw coordinate position of each crop, given in (width, height) format. 
+		Return
+		feature_array: float32 array of size (crops, 6). See _get_custom_features(). 
+		"""
+		coordinate_x = coordinate_pos[:, 0]
+		coordinate_y = coordinate_pos[:, 1]
+
+		# Swith from (height, width) to (width, height)
+		dims_w_h = [float(self.config.canvas_dims[1]), float(self.config.canvas_dims[0])]
+
+		# Calculate delta_pos
+		dims_half_w_h = [dims_w_h[0]/2.0, dims_w_h[1]/2.0]
+		delta_x = coordinate_x - dims_half_w_h[0]
+		delta_y = coordinate_y - dims_half_w_h[1]
+
+		# Determine angular_pos
+		angle = np.arctan2(delta_y, delta_x)
+		mag = np.sqrt(delta_y*delta_y + delta_x*delta_x)
+		mag_max = math.sqrt(math.pow(dims_half_w_h[1],2) + math.pow(dims_half_w_h[0], 2))
+
+		# Normalize position values (same order as normalized_pos_list)
+		feature_array = np.stack([
+			coordinate_x/dims_w_h[0], 
+			coordinate_y/dims_w_h[1], 
+			delta_x/dims_half_w_h[0], 
+			delta_y/dims_half_w_h[1], 
+			mag/mag_max, 
+			angle/math.pi], axis=1)
+
+		return feature_array.astype(np.float32)
+
+
 	def _get_label_from_imgPath(self, image_path):
 		"""
 		Description: Gets a sparse categorical label array from the image_path. 
@@ -424,6 +649,9 @@ class ClassifyParticlesData(object):
 		+ Uses config.class_mapping to go from class name to label. 
 		+ Constructs a sparse categorical label with all 0s except a 1 at label position. 
 		"""
+		# Crops stored in a shard are labeled by the folder that contains the shard
+		if isinstance(image_path, CropShard.ShardCrop):
+			image_path = image_path.shard_path
 
 		class_name = image_path.split('/')[-2]
 		label = self.config.class_mapping[class_name]
@@ -437,9 +665,97 @@ class ClassifyParticlesData(object):
 		"""
 		Descriptions: Loads and preprocess image (including resizes,  image norm for each image and augmenting the image). 
 		"""
+		# The augmentation is applied after the cache, so it's different each time. 
+		x = self._get_cached_image_from_dir(image_path, new_size)
+
+		return self._transform_image(x, augment_data)
+
+
+	def _get_cached_image_from_dir(self, image_path, new_size=None):
+		"""
+		Description: Loads and preprocesses image, without augmenting. Uses the crop cache (see crop_cache_size_mb). 
+		The cache is keyed on the path (no stat call per crop), since the training data doesn't change during a run. 
+		"""
+		if self.crop_cache is None:
+			return self._load_image_from_dir(image_path, new_size)
+
+		cache_key = (image_path, new_size)
+		x = self.crop_cache.get(cache_key)
+		if x is None:
+			x = self.crop_cache.put(cache_key, self._load_image_from_dir(image_path, new_size))
+
+		return x
+
+
+	def _load_image_from_dir(self, image_path, new_size=None):
+		"""
+		Description: Loads and preprocesses image, without augmenting. 
+		"""
+		return self._get_image_tensor(self._open_image(image_path), new_size)
+
+
+	def _open_image(self, image_path):
+		"""
+		Description: Opens an image (or a crop in a shard) as a PIL image. 
+		"""
 		# Use PIL since in correct RGB format. And, Keras relies on PIL. 
-		img = PIL.Image.open(image_path)
+		if isinstance(image_path, CropShard.ShardCrop):
+			crop = self._get_crop_shard(image_path.shard_path).get_crop(image_path.index)
+			return PIL.Image.fromarray(crop[:, :, ::-1])
 
+		return PIL.Image.open(image_path)
+
+
+	def get_packed_crop(self, image_path):
+		"""
+		Description: Loads an image for a packed dataset (see PackedDataset). Converted to config.color and resized to config.target_size, but not normalized. 
+		Return
+		x: uint8 array of size config.image_shape
+		"""
+		img = self._resize_image(self._open_image(image_path), self.config.target_size)
+
+		return np.reshape(np.asarray(img, dtype=np.uint8), self.config.image_shape)
+
+
+	def _get_image_from_array(self, crop, augment_data, new_size=None):
+		"""
+		Description: Identical to _get_image_from_dir(), but for a crop that is already in memory (BGR format, as produced by cv2). 
+		"""
+		img = PIL.Image.fromarray(crop[:, :, ::-1])
+
+		return self._preprocess_image(img, augment_data, new_size)
+
+
+	def _preprocess_image(self, img, augment_data, new_size=None):
+		"""
+		Description: Preprocess a PIL image (including resizes,  image norm for each image and augmenting the image). 
+		"""
+		x = self._get_image_tensor(img, new_size)
+
+		# augment image
+		x = self._transform_image(x, augment_data)
+		
+		return x
+
+
+	def _get_image_tensor(self, img, new_size=None):
+		"""
+		Description: Converts a PIL image to the model input before augmentation (including resizes and image norm for each image). 
+		"""
+		img = self._resize_image(img, new_size)
+
+		x = image_keras.img_to_array(img) # convert to numpy array (as float 32)
+
+		preprocess = self.get_preprocess_func()
+		x = preprocess(x)
+
+		return x
+
+
+	def _resize_image(self, img, new_size=None):
+		"""
+		Description: Converts a PIL image to config.color, and resizes it to new_size (if given). 
+		"""
 
 		# Convert to grayscale if necessary. Keras implementation also converts from rgb/grayscale first. 
 		if ('grayscale' == self.config.color):
@@ -451,102 +767,164 @@ class ClassifyParticlesData(object):
 			new_size_PIL = new_size[::-1] # Move from numpy convention to PIL convention
 			if (img.size != new_size_PIL):
 				img = img.resize(new_size_PIL, resample = PIL.Image.ANTIALIAS) #PIL implementation: Use antialias to not alias while downsampling. 
-		
 
-		x = image_keras.img_to_array(img) # convert to numpy array (as float 32)
+		return img
 
-		preprocess = self.get_preprocess_func()
-		x = preprocess(x)
+	def _transform_image(self, x, augment_data):
+		"""
+		Description: Augments a single input image randomly, in real-time (see _transform_batch). 
+		"""
+		return self._transform_batch(x[np.newaxis], augment_data)[0]
 
-		# augment image
-		x = self._transform_image(x, augment_data)
-		
-		return x
 
-	def _transform_image(self, x, augment_data):
+	def _transform_batch(self, x_batch, augment_data, fixed_flips=None):
 		"""
-		Description: Augments an input image randomly, in real-time. 
+		Description: Augments a batch of input images randomly, in real-time. 
 		Note: We always flip images around axis since sometimes we have duplicate images in a dataset (since we might pad classes to equalize them)
-		ToDo: To improve efficiency, combine rotation/shift into single homography transformation (instead of applying two back to back.)
-		Currently, apply two transformations/interpolations sequetially. Can concatenate this into a single transformation. 
+		When augmenting, the flips, rotation and shift of each image are combined into a single affine transformation. So, each image is only interpolated once. 
+		Args
+		x_batch: Array of images of size (batch, height, width, channels). 
+		fixed_flips: (flip_horizontal, flip_vertical) applied to every image instead of the random flips. None for random flips. 
+		"""
+		batch_size = x_batch.shape[0]
+
+		# Probabilistic horizontal/vertical flips (unless fixed_flips is given)
+		if fixed_flips is None:
+			flips = np.random.random((batch_size, 2)) < 0.5
+		else:
+			flips = np.tile(fixed_flips, (batch_size, 1)).astype(bool)
+
+		# Only flip (no interpolation needed) when not augmenting data
+		if (not augment_data):
+			x_list = []
+			for x, (flip_horizontal, flip_vertical) in zip(x_batch, flips):
+				if (flip_horizontal):
+					x = flip_axis(x, 1) # flip around columns
+				if (flip_vertical):
+					x = flip_axis(x, 0) # flip around rows
+				x_list.append(x)
+
+			return np.array(x_list)
+
+		transform_matrices = self._get_augmentation_matrices(flips, height=x_batch.shape[1], width=x_batch.shape[2])
+
+		# Nearest-neighbor interpolation and nearest fill mode (same as the keras random_rotation/random_shift)
+		x_list = []
+		for x, transform_matrix in zip(x_batch, transform_matrices):
+			x_warped = cv2.warpAffine(x, transform_matrix, (x.shape[1], x.shape[0]), 
+				flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP, 
+				borderMode=cv2.BORDER_REPLICATE)
+			x_list.append(np.reshape(x_warped, x.shape)) # cv2 drops the channel axis of single channel images
+
+		return np.array(x_list)
+
+
+	def _get_augmentation_matrices(self, flips, height, width):
+		"""
+		Description: Samples a random rotation + shift for each image, and combines it with the flips into a single affine transformation. 
+		The transformations are identical to applying flip_axis, then keras random_rotation (rg=45), then keras random_shift (wrg=hrg=0.1). 
+		Args
+		flips: Bool array of size (batch, 2) with the (horizontal, vertical) flip of each image. 
+		Return
+		transform_matrices: Array of size (batch, 2, 3). Maps each output pixel to its input pixel, in cv2 (x=column, y=row) format (see cv2.WARP_INVERSE_MAP). 
 		"""
+		batch_size = flips.shape[0]
 
-		# Probabilistic horizontal flip
-		if np.random.random() < 0.5:
-			x = flip_axis(x, 1) # flip around columns
+		# Sample the transformations of each image
+		theta = np.deg2rad(np.random.uniform(-45, 45, batch_size))
+		shift_rows = np.random.uniform(-0.1, 0.1, batch_size)*height # high_aug => 0.2, med_aug => 0.1
+		shift_cols = np.random.uniform(-0.1, 0.1, batch_size)*width
 
-		# Probabilist vertical flip
-		if np.random.random() < 0.5:
-			x = flip_axis(x, 0) # flip around rows
-		
-		# Only apply when agumenting data. 
-		if (augment_data):
-			x = random_rotation(x, 
-				rg=45, 
-				row_axis=0, 
-				col_axis=1, 
-				channel_axis=2,
-				fill_mode='nearest')
-
-			x = random_shift(x, 
-				wrg=0.1, # high_aug => 0.2, med_aug => 0.1
-				hrg=0.1, 
-				row_axis=0, 
-				col_axis=1, 
-				channel_axis=2,
-				fill_mode='nearest')
+		# All matrices map output (row, column) to input (row, column), same as keras (scipy.ndimage.affine_transform)
+		flip_cols = np.tile(np.eye(3), (batch_size, 1, 1))
+		flip_cols[flips[:, 0], 1, 1] = -1
+		flip_cols[flips[:, 0], 1, 2] = width - 1
 
+		flip_rows = np.tile(np.eye(3), (batch_size, 1, 1))
+		flip_rows[flips[:, 1], 0, 0] = -1
+		flip_rows[flips[:, 1], 0, 2] = height - 1
 
-		return x
+		# Rotation around the image center (same offset as keras transform_matrix_offset_center)
+		offset_rows = float(height)/2 + 0.5
+		offset_cols = float(width)/2 + 0.5
+		offset_matrix = np.array([[1, 0, offset_rows], [0, 1, offset_cols], [0, 0, 1]])
+		reset_matrix = np.array([[1, 0, -offset_rows], [0, 1, -offset_cols], [0, 0, 1]])
+		rotation = np.tile(np.eye(3), (batch_size, 1, 1))
+		rotation[:, 0, 0] = np.cos(theta)
+		rotation[:, 0, 1] = -np.sin(theta)
+		rotation[:, 1, 0] = np.sin(theta)
+		rotation[:, 1, 1] = np.cos(theta)
+		rotation = np.matmul(np.matmul(offset_matrix, rotation), reset_matrix)
+
+		translation = np.tile(np.eye(3), (batch_size, 1, 1))
+		translation[:, 0, 2] = shift_rows
+		translation[:, 1, 2] = shift_cols
+
+		# Transformations applied in sequence are combined in the reverse order (since the matrices map output to input)
+		transform = np.matmul(np.matmul(np.matmul(flip_cols, flip_rows), rotation), translation)
+
+		# Swap from (row, column) to cv2 (x=column, y=row) format
+		transform_matrices = np.stack([
+			np.stack([transform[:, 1, 1], transform[:, 1, 0], transform[:, 1, 2]], axis=1),
+			np.stack([transform[:, 0, 1], transform[:, 0, 0], transform[:, 0, 2]], axis=1)], axis=1)
+
+		return transform_matrices
 
 
 	def print_data_summary(self): 
 		self.config.logger.info("###### DATA ######")
-		self.config.logger.info("Total Training Data: %d", len(glob.glob(self.config.train_images_dir + '*/*.bmp')))
-		self.config.logger.info("Total Validation Data: %d", len(glob.glob(self.config.val_images_dir + '*/*.bmp')))
+		self.config.logger.info("Total Training Data: %d", len(self.get_crop_list(self.config.train_images_dir)))
+		self.config.logger.info("Total Validation Data: %d", len(self.get_crop_list(self.config.val_images_dir)))
 		self.config.logger.info("Images Per Class: %s", self._get_images_per_class())
+		if self.crop_cache is not None:
+			self.crop_cache.log_statistics(self.config.logger)
 		self.config.logger.info("###### DATA ######  \n\n")
 
 
-	def predict_particle_images(self, model, pred_generator, total_batches=1): 
+	def predict_particle_images(self, model, pred_generator, total_batches=None): 
 		""" 
 		Description: Predicts the class for each particle provided by a genrator, up to a certain count. 
+		The padding of the batches (see valid_mask) is dropped from the output. 
 		Args
 		model: Tensorflow model used to predict particles 
-		pred_generator: Generator that produces batches of images to be classified. Generator returned by create_custom_prediction_generator().
-		total_batches: The number of batches of images that will be processes. 
+		pred_generator: Generator that yields (x_inputs, path_list, valid_mask) batches of images to be classified, e.g. returned by create_prediction_iterator(). 
+		total_batches: The number of batches of images that will be processes. If None, until pred_generator is exhausted (needs a finite generator). 
+		Note: create_custom_prediction_generator() cycles forever. So, it can only be used with total_batches. 
+		Returns
+		all_pred: The categorical prediction for each image, of size (images, nclasses). 
+		all_path_list: The path of each image (same order as all_pred). 
 		"""
 
 		# Track overall label metrics
-		all_pred = None
-		all_path_list = None
+		all_pred = []
+		all_path_list = [] # Python list, since paths can be CropShard.ShardCrop references
 
 
 		# Validate across multiple batches
-		for _ in range(total_batches):
-			x_inputs, path_list =  next(pred_generator)	
+		for x_inputs, path_list, valid_mask in itertools.islice(pred_generator, total_batches):
 			label_pred = model.predict_on_batch(x_inputs)
 
-			# Append to overall metrics
-			if all_pred is None: 
-				all_pred = label_pred
-				all_path_list = path_list
-			else: 
-				all_pred = np.append(all_pred, label_pred, axis=0)
-				all_path_list = np.append(all_path_list, path_list, axis=0)
+			# Append to overall metrics (without padding)
+			all_pred.append(label_pred[valid_mask])
+			all_path_list.extend(path for path, valid in zip(path_list, valid_mask) if valid)
+
+		if not all_pred:
+			return np.zeros((0, self.config.nclasses), dtype=np.float32), all_path_list
 
-		return all_pred, all_path_list
+		return np.concatenate(all_pred, axis=0), all_path_list
 
 
 
 	def validate_epoch(self, model, val_generator): 
 		""" 
 		Validates model for a single epoch. Provides average results across the entire epoch. 
+		Returns
+		accuracy: The classification accuracy across the epoch. 
+		confusion: The confusion matrix (truth classes x predicted classes). 
 		"""
 
 		# Track overall label metrics
-		all_truth = None
-		all_pred = None
+		metrics = StreamingMetrics(self.config.nclasses)
 
 		# Validate across multiple batches
 		for _ in range(self.config.batches_per_epoch_val):
@@ -554,17 +932,12 @@ class ClassifyParticlesData(object):
 			label_pred = model.predict_on_batch(x_inputs)
 
 			
-			# Append to overall metrics
-			if all_truth is None: 
-				all_truth = label_truth
-				all_pred = label_pred
-			else: 
-				all_truth = np.append(all_truth, label_truth, axis=0)
-				all_pred = np.append(all_pred, label_pred, axis=0)
+			# Update overall metrics
+			metrics.update(label_truth, label_pred)
 
 
-		accuracy =CNN_functions.get_classification_accuracy_perBatch(all_truth, all_pred)
-		confusion = CNN_functions.get_confusion_matrix(all_truth, all_pred)
+		accuracy = metrics.get_accuracy()
+		confusion = metrics.get_confusion_matrix()
 
 		# Output results
 		self.config.logger.info("Validation Results")
@@ -572,24 +945,34 @@ class ClassifyParticlesData(object):
 		self.config.logger.info("Map Class Name to Class Number: %s", self.config.class_mapping)
 		self.config.logger.info("Confusion Matrix:")
 		self.config.logger.info(confusion)
+		metrics.log_per_class_metrics(self.config.logger, class_names=sorted(self.config.class_mapping, key=self.config.class_mapping.get))
+		if self.crop_cache is not None:
+			self.crop_cache.log_statistics(self.config.logger)
 		self.config.logger.info("\n\n\n")
 
+		return accuracy, confusion
+
 
 	def train_epoch(self, model, train_generator, in_house = True):
 		""" 
 		Trains model for a single epoch. Provides average results across the entire epoch. 
+		Logs the time per step blocked on data vs. spent in compute. For fit_generator, the time blocked on data is only known for a BatchPrefetcher (measured at the keras queue). 
 		"""
 
 		# Track overall metrics
 		loss = 0
 		accuracy = 0
+		start_time = time.time()
+		data_wait_time = 0.0 # Time blocked on train_generator
 
 		# Use home-brew training
 		if (in_house): 
 			loss_all = []
 			accuracy_all = []
 			for batch in range(self.config.batches_per_epoch_train):
+				wait_start = time.time()
 				x_inputs, label_truth =  next(train_generator)
+				data_wait_time += time.time() - wait_start
 				metric_output = model.train_on_batch(x_inputs, label_truth)
 				# Update per batch tracking variables
 				self.train_count += 1
@@ -603,6 +986,7 @@ class ClassifyParticlesData(object):
 
 		# Use keras-built in training
 		else: 
+			start_wait_time = train_generator.get_wait_time() if isinstance(train_generator, BatchPrefetcher) else None
 			history = model.fit_generator(
 				train_generator, # Produces training data for a single batch. 
 				epochs = 1, # Only train a single epoch 
@@ -610,6 +994,7 @@ class ClassifyParticlesData(object):
 			)
 			self.train_count += self.config.batches_per_epoch_train # Update image tracking 
 			self.image_train_count += self.config.batches_per_epoch_train*self.config.batch_size
+			data_wait_time = None if start_wait_time is None else (train_generator.get_wait_time() - start_wait_time)
 
 			# Note: Use mean just in case we increase epochs in model.fit_generator
 			loss = np.mean(history.history["loss"])
@@ -620,6 +1005,11 @@ class ClassifyParticlesData(object):
 		# Output results
 		self.config.logger.info("Training Results")
 		self.config.logger.info("Step: %d, Images Trained: %d, Batch loss: %2.6f, Training accuracy: %1.3f" %(self.train_count, self.image_train_count, loss, accuracy))
+		CNN_functions.log_training_step_times(self.config.logger, 
+			step_count = self.config.batches_per_epoch_train, 
+			image_count = self.config.batches_per_epoch_train*self.config.batch_size, 
+			elapsed_time = time.time() - start_time, 
+			data_wait_time = data_wait_time)
 
 
 
@@ -26,6 +26,7 @@ class ClassifyParticles_Config():
 		self.root_data_dir =  "./core_algo/data/clinical_experiment/"
 		self.weight_file_input_name =  '20180211_final_model_highAug.h5'	#Set to 'None' to disable.
 		self.weight_file_output_name = "classify_weights_" # Set to 'None' to disable. 
+		self.model_artifact_name = None # Single file with the complete model for fast prediction startup (created on first use, and rebuilt when the weight file is newer). Set to 'None' to disable. 
 		self.target_size = (64, 64) # Warning: Be careful if non-square dimensions (see above note). 
 		self.batch_size = 1
 		self.num_epochs = 5  # Print validation results after each epoch. Save model after num_epochs.
@@ -44,14 +45,23 @@ class ClassifyParticles_Config():
 		self.channels = 1
 		self.color = 'grayscale' # Select 'rgb' or 'grayscale'. Remember to adjust normalization script in preprocessing function. 
 		self.preprocess_func = "gray_imageNorm" # Options include => "gray_imageNorm", "rgb_imageNorm", "rgb_datasetNorm"
+		self.crop_cache_size_mb = 512 # Memory for caching the preprocessed crops across epochs (see CropCache). The augmentation is still applied to each use. Crops changed on disk during a run are not reloaded. Set to 'None' to disable. 
+		self.inference_precision = 'float32' # 'float32' or 'float16' weights and activations for prediction (not training). Check the accuracy with compare_inference_precision.py before using float16. 
+		self.use_packed_dataset = False # If true, trains from the packed datasets at train_pack_prefix/val_pack_prefix (see PackedDataset) instead of the crop folders. Create with data_preperation/pack_classification_folder.py
+		self.packed_balance_classes = True # Only for packed datasets. If true, repeats the crops of the smaller classes in each pass (replaces the _cpy duplicates of balance_classes_in_dir). 
+		self.prefetch_workers = 4 # Number of threads building training batches ahead of the model (see BatchPrefetcher). Set to 0 to build the batches in the training loop. 
+		self.prefetch_queue_size = 8 # Maximum number of training batches built ahead of the model. 
 
 		# Auto Configurations: Can be auto-calculated. 
 		self.train_images_dir = self.root_data_dir + "image_data/" + self.project_folder + "classification/training/"
 		self.val_images_dir = self.root_data_dir + "image_data/" + self.project_folder + "classification/validation/"
+		self.train_pack_prefix = self.root_data_dir + "image_data/" + self.project_folder + "classification_packed/training"
+		self.val_pack_prefix = self.root_data_dir + "image_data/" + self.project_folder + "classification_packed/validation"
 		self.weight_file_output = None if self.weight_file_output_name is None else (self.root_data_dir + "model_storage/" + self.project_folder + self.weight_file_output_name)
 		self.log_dir = self.root_data_dir + "log/" + self.project_folder
 		self.output_img_dir = self.root_data_dir + "image_data/" + self.project_folder +"classification/debug_output/"
 		self.weight_file_input = None if self.weight_file_input_name is None else (self.root_data_dir + "model_storage/" + self.project_folder + self.weight_file_input_name)  
+		self.model_artifact_file = None if self.model_artifact_name is None else (self.root_data_dir + "model_storage/" + self.project_folder + self.model_artifact_name)
 		self.image_shape = self.target_size + (self.channels,)
 		#self.colors = [(random.randint(0,255),random.randint(0,255),random.randint(0,255)) for _ in range(self.nclasses)]
 		self.colors = [(255,0,0), (0,0,0), (0,0,255),(255,255,255)] # in bgr format
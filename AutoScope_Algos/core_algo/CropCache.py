@@ -0,0 +1,73 @@
+# Import basic libraries
+import threading
+import collections
+
+"""
+Description: In-memory cache of decoded and preprocessed crops (the model input before augmentation). Avoids decoding, resizing and normalizing the same crop in every epoch.
+
+Implementation Notes:
++ Least-recently-used eviction: When the cached crops exceed max_size_mb, the crops that were used the longest time ago are removed first.
++ The cached arrays are read-only, so a consumer can't change the cached crop by accident (augmentations need to return new arrays).
++ Thread-safe, so it can be shared between generators running on different threads.
+"""
+
+
+class CropCache(object):
+
+	def __init__(self, max_size_mb):
+		"""
+		Args
+		max_size_mb: The maximum memory used by the cached crops (in MB).
+		"""
+		self.max_size_bytes = max_size_mb*1024*1024
+		self.size_bytes = 0
+		self.entries = collections.OrderedDict() # Ordered from least to most recently used
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+
+
+	def get(self, key):
+		"""
+		Returns the cached crop for key. Returns None if the crop is not cached.
+		"""
+		with self.lock:
+			crop = self.entries.pop(key, None)
+			if crop is None:
+				self.misses += 1
+				return None
+
+			# Mark as most recently used
+			self.entries[key] = crop
+			self.hits += 1
+
+			return crop
+
+
+	def put(self, key, crop):
+		"""
+		Stores crop for key, and evicts the least recently used crops (if needed). Returns the (read-only) cached crop.
+		"""
+		crop.flags.writeable = False
+		if (crop.nbytes > self.max_size_bytes):
+			return crop
+
+		with self.lock:
+			previous_crop = self.entries.pop(key, None)
+			if previous_crop is not None:
+				self.size_bytes -= previous_crop.nbytes
+
+			self.entries[key] = crop
+			self.size_bytes += crop.nbytes
+
+			while (self.size_bytes > self.max_size_bytes):
+				_, evicted_crop = self.entries.popitem(last=False)
+				self.size_bytes -= evicted_crop.nbytes
+
+		return crop
+
+
+	def log_statistics(self, logger):
+		logger.info("Crop cache: %d hits, %d misses, %d crops cached (%0.1f of %0.1f MB)", self.hits, self.misses, len(self.entries),
+			self.size_bytes/(1024.0*1024.0), self.max_size_bytes/(1024.0*1024.0))
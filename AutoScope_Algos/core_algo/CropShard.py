@@ -0,0 +1,150 @@
+# Import basic libraries
+import os
+import json
+import collections
+from glob import glob
+import numpy as np
+
+"""
+Description: Shard format for cropped particles. All the crops of a single canvas are stored in a single file, instead of a .bmp file per crop.
+
+Implementation Notes:
++ <shard_prefix>_crops.npy: Contiguous uint8 array of size (crops, height, width, channels). Crops are stored in BGR format (same as cv2).
++ <shard_prefix>_crops_index.json: Sidecar index. For each crop: the centroid (width, height), the source canvas, the label (None if not labeled) and the crop name.
++ The crop name is the filename the crop would have had as a .bmp file (e.g. 'img1_43_235.bmp'). So, all functions that parse the crop filename keep working.
++ Shards are read through a memory-map. So, reading a crop doesn't open a file.
+"""
+
+shard_suffix = "_crops.npy"
+index_suffix = "_crops_index.json"
+
+# Reference to a single crop within a shard.
+ShardCrop = collections.namedtuple('ShardCrop', ['shard_path', 'index', 'name'])
+
+
+class CropShardWriter(object):
+	"""
+	Description: Collects the crops of a single canvas, and writes them as a single shard.
+	"""
+
+	def __init__(self, shard_prefix, crop_size, channels=3):
+		"""
+		Args
+		shard_prefix: Output path of the shard, without the suffix.
+		crop_size: Height/width of each crop. All crops in a shard need to have the same dimensions.
+		"""
+		self.shard_prefix = shard_prefix
+		self.crop_size = crop_size
+		self.channels = channels
+		self.crops = []
+		self.index = []
+
+
+	def add_crop(self, crop, centroid, canvas_name, name, label=None):
+		"""
+		Args
+		crop: uint8 BGR crop of size (crop_size, crop_size, channels)
+		centroid: The centroid of the crop on the canvas, in (width, height) format.
+		canvas_name: The name of the canvas the crop was taken from (no extension).
+		name: The crop name (filename the crop would have as a .bmp file).
+		label: The class name of the crop (if known)
+		"""
+		if (crop.shape[0] != self.crop_size) or (crop.shape[1] != self.crop_size):
+			raise ValueError("CropShardWriter: All crops in a shard need to have crop_size dimensions.")
+
+		self.crops.append(crop)
+		self.index.append({
+			"centroid": [float(centroid[0]), float(centroid[1])],
+			"canvas": canvas_name,
+			"label": label,
+			"name": name})
+
+
+	def close(self):
+		"""
+		Writes the shard and the sidecar index. Returns the path to the shard.
+		"""
+		crops_array = np.zeros((len(self.crops), self.crop_size, self.crop_size, self.channels), dtype=np.uint8)
+		for i, crop in enumerate(self.crops):
+			crops_array[i] = np.reshape(crop, crops_array.shape[1:])
+
+		shard_path = self.shard_prefix + shard_suffix
+		np.save(shard_path, crops_array)
+
+		with open(self.shard_prefix + index_suffix, 'w') as index_file:
+			json.dump({"crops": self.index, "crop_size": self.crop_size, "channels": self.channels}, index_file)
+
+		return shard_path
+
+	def __len__(self):
+		return len(self.crops)
+
+
+
+class CropShard(object):
+	"""
+	Description: Memory-mapped reader for a single shard.
+	"""
+
+	def __init__(self, shard_path):
+		self.shard_path = shard_path
+
+		with open(get_index_path(shard_path), 'r') as index_file:
+			self.index = json.load(index_file)["crops"]
+
+		# An empty array cannot be memory-mapped.
+		mmap_mode = 'r' if len(self.index) > 0 else None
+		self.crops = np.load(shard_path, mmap_mode=mmap_mode)
+
+
+	def __len__(self):
+		return len(self.index)
+
+
+	def get_crop(self, index):
+		""" Returns a single crop as a uint8 BGR array. """
+		return np.asarray(self.crops[index])
+
+
+	def get_crop_refs(self):
+		""" Returns a ShardCrop reference for each crop in the shard. """
+		return [ShardCrop(self.shard_path, i, metadata["name"]) for i, metadata in enumerate(self.index)]
+
+
+	def get_centroid(self, index):
+		return self.index[index]["centroid"]
+
+
+	def get_label(self, index):
+		return self.index[index]["label"]
+
+
+
+def get_index_path(shard_path):
+	""" Returns the path of the sidecar index for shard_path. """
+	return shard_path[:-len(shard_suffix)] + index_suffix
+
+
+def get_shard_paths(directory_glob):
+	""" Returns the sorted list of shards that match directory_glob (e.g. 'data/*/'). """
+	shard_paths = glob(directory_glob + "*" + shard_suffix)
+	shard_paths.sort()
+	return shard_paths
+
+
+def get_crop_name(crop_ref):
+	"""
+	Returns the crop filename of a crop reference (either a path to a .bmp crop, or a ShardCrop).
+	"""
+	if isinstance(crop_ref, ShardCrop):
+		return crop_ref.name
+
+	return crop_ref[crop_ref.rfind('/')+1:]
+
+
+def move_shard(shard_path, output_dir):
+	""" Moves a shard (and the sidecar index) into output_dir. """
+	shard_filename = os.path.basename(shard_path)
+	index_filename = os.path.basename(get_index_path(shard_path))
+	os.rename(get_index_path(shard_path), output_dir + index_filename)
+	os.rename(shard_path, output_dir + shard_filename)
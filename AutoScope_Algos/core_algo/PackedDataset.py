@@ -0,0 +1,149 @@
+# Import basic libraries
+import json
+import numpy as np
+
+"""
+Description: Packed format for a classification dataset. All the crops of a classification folder (e.g. classification/training/) are stored in a few array files, instead of a .bmp file per crop.
+
+Implementation Notes:
++ <pack_prefix>_images.npy: Contiguous uint8 array of size (crops, height, width, channels). Crops are already converted to config.color and resized to config.target_size (but not normalized).
++ <pack_prefix>_labels.npy: The label of each crop (int, see config.class_mapping).
++ <pack_prefix>_features.npy: The custom features of each crop (float32, see ClassifyParticlesData._get_custom_features).
++ <pack_prefix>_metadata.json: The class_mapping, target_size and color used to pack the crops, and the name of each crop.
++ The arrays are read through a memory-map. So, a batch is assembled with a single fancy-index per array (no file is opened per crop).
++ The _cpy duplicates of balance_classes_in_dir are not needed. Instead, get_epoch_indices() repeats the crops of the smaller classes.
++ Create with data_preperation/pack_classification_folder.py
+"""
+
+images_suffix = "_images.npy"
+labels_suffix = "_labels.npy"
+features_suffix = "_features.npy"
+metadata_suffix = "_metadata.json"
+
+
+class PackedDatasetWriter(object):
+	"""
+	Description: Writes the crops of a classification folder into a packed dataset, one crop at a time (the crops are never all in memory).
+	"""
+
+	def __init__(self, pack_prefix, crop_count, image_shape, feature_count, class_mapping, target_size, color):
+		"""
+		Args
+		pack_prefix: Output path of the packed dataset, without the suffix.
+		crop_count: The number of crops that will be added.
+		image_shape: (height, width, channels) of each crop.
+		feature_count: The number of custom features of each crop.
+		"""
+		self.pack_prefix = pack_prefix
+		self.crop_count = crop_count
+		self.images = np.lib.format.open_memmap(pack_prefix + images_suffix, mode='w+', dtype=np.uint8, shape=(crop_count,) + tuple(image_shape))
+		self.labels = np.zeros(crop_count, dtype=np.int32)
+		self.features = np.zeros((crop_count, feature_count), dtype=np.float32)
+		self.metadata = {
+			"class_mapping": class_mapping,
+			"target_size": list(target_size),
+			"color": color,
+			"names": []}
+
+
+	def add_crop(self, image, label, features, name):
+		"""
+		Args
+		image: uint8 crop of size image_shape.
+		label: The label of the crop (int).
+		features: The custom features of the crop.
+		name: The crop name (e.g. 'img1_43_235.bmp').
+		"""
+		index = len(self.metadata["names"])
+		if (index >= self.crop_count):
+			raise ValueError("PackedDatasetWriter: More crops added than crop_count.")
+
+		self.images[index] = np.reshape(image, self.images.shape[1:])
+		self.labels[index] = label
+		self.features[index] = features
+		self.metadata["names"].append(name)
+
+
+	def close(self):
+		"""
+		Writes the labels, features and metadata. Returns the pack_prefix.
+		"""
+		if (len(self.metadata["names"]) != self.crop_count):
+			raise ValueError("PackedDatasetWriter: Expected %d crops, but %d crops were added." % (self.crop_count, len(self.metadata["names"])))
+
+		self.images.flush()
+		del self.images
+
+		np.save(self.pack_prefix + labels_suffix, self.labels)
+		np.save(self.pack_prefix + features_suffix, self.features)
+		with open(self.pack_prefix + metadata_suffix, 'w') as metadata_file:
+			json.dump(self.metadata, metadata_file)
+
+		return self.pack_prefix
+
+	def __len__(self):
+		return len(self.metadata["names"])
+
+
+
+class PackedDataset(object):
+	"""
+	Description: Memory-mapped reader for a packed dataset.
+	"""
+
+	def __init__(self, pack_prefix):
+		self.pack_prefix = pack_prefix
+
+		with open(pack_prefix + metadata_suffix, 'r') as metadata_file:
+			self.metadata = json.load(metadata_file)
+
+		# An empty array cannot be memory-mapped.
+		mmap_mode = 'r' if len(self.metadata["names"]) > 0 else None
+		self.images = np.load(pack_prefix + images_suffix, mmap_mode=mmap_mode)
+		self.labels = np.load(pack_prefix + labels_suffix)
+		self.features = np.load(pack_prefix + features_suffix)
+
+
+	def __len__(self):
+		return len(self.labels)
+
+
+	def get_batch(self, indices):
+		"""
+		Description: Gathers a batch of crops.
+		Args
+		indices: Array with the index of each crop in the batch. Sorted indices read the memory-map sequentially.
+		Return
+		images: uint8 array of size (batch, height, width, channels)
+		labels: The label of each crop.
+		features: The custom features of each crop.
+		"""
+		return self.images[indices], self.labels[indices], self.features[indices]
+
+
+	def get_epoch_indices(self, balance_classes):
+		"""
+		Description: Returns a random order of the crops for a single pass through the dataset.
+		Args
+		balance_classes: If True, the crops of each class are repeated until each class has as many crops as the largest class (same as balance_classes_in_dir).
+		"""
+		if (not balance_classes) or (len(self) == 0):
+			return np.random.permutation(len(self))
+
+		class_indices = [np.flatnonzero(self.labels == label) for label in np.unique(self.labels)]
+		max_count = max(len(indices) for indices in class_indices)
+		balanced_indices = np.concatenate([np.resize(np.random.permutation(indices), max_count) for indices in class_indices])
+
+		return np.random.permutation(balanced_indices)
+
+
+	def get_class_mapping(self):
+		return self.metadata["class_mapping"]
+
+
+	def get_target_size(self):
+		return tuple(self.metadata["target_size"])
+
+
+	def get_color(self):
+		return self.metadata["color"]
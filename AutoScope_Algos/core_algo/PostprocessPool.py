@@ -0,0 +1,144 @@
+# Import basic libraries
+import logging
+import collections
+import multiprocessing
+import cv2
+
+"""
+Description: Runs the post-processing of canvas images in worker processes, so the main process can keep the model busy.
+
+Implementation Notes:
++ Results are returned in the order the functions were submitted (regardless of which worker finishes first).
++ Each worker receives a copy of the data object when the pool is created. So, create the pool after the data object is configured.
++ The workers are forked. Threads that exist at the fork (e.g. the TensorFlow session threads, once the model is built) are not running in the workers, and any lock they hold stays locked. So, the submitted functions should only use numpy/cv2 (not the model). Create the pool before starting the CanvasPrefetcher threads.
++ Call close() when done, and terminate() on an error (otherwise the worker processes keep running).
++ The submitted functions need to be module-level functions (so they can be sent to the workers). They are called as func(data, *args).
++ The log messages of the workers are recorded and returned with the results. The main process then logs them (in order) with the original logger.
++ With num_workers=0, the functions are run in the main process.
+"""
+
+# The data object of a worker process (set when the worker starts)
+_worker_data = None
+
+
+class PostprocessPool(object):
+
+	def __init__(self, data, num_workers=2, max_pending=None):
+		"""
+		Args
+		data: Instance of SegmentParticlesData (or ClassifyParticlesData). Passed as the first argument of the submitted functions.
+		num_workers: The number of worker processes. If 0, the functions are run in the main process.
+		max_pending: The maximum number of submitted functions that are not collected yet. If None, 2*num_workers.
+		"""
+		self.data = data
+		self.num_workers = num_workers
+		self.max_pending = max_pending if max_pending is not None else 2*num_workers
+		self.pending = collections.deque()
+
+		self.pool = None
+		if (num_workers > 0):
+			self.pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(data,))
+
+
+	def submit(self, func, *args):
+		"""
+		Description: Runs func(data, *args) in a worker.
+		Returns the results of the submitted functions that are done (in order). Blocks while more than max_pending functions are not done.
+		"""
+		if self.pool is None:
+			return [func(self.data, *args)]
+
+		self.pending.append(self.pool.apply_async(_run_in_worker, (func, args)))
+
+		results = []
+		while self.pending and (self.pending[0].ready() or len(self.pending) > self.max_pending):
+			results.append(self._get_next_result())
+
+		return results
+
+
+	def close(self):
+		"""
+		Description: Waits for all submitted functions, and shuts down the workers. Returns the remaining results (in order).
+		"""
+		results = []
+		while self.pending:
+			results.append(self._get_next_result())
+
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+		return results
+
+
+	def terminate(self):
+		"""
+		Description: Stops the workers immediately, and drops the functions that are not collected yet. Does nothing after close().
+		"""
+		self.pending.clear()
+
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+
+	def _get_next_result(self):
+		result, log_records = self.pending.popleft().get()
+
+		# Log the messages of the worker
+		for level, msg, args in log_records:
+			self.data.config.logger.log(level, msg, *args)
+
+		return result
+
+
+
+class LogRecorder(object):
+	"""
+	Description: Stand-in for a logger in a worker process. Records the log messages, so they can be logged by the main process.
+	"""
+
+	def __init__(self):
+		self.records = []
+
+	def log(self, level, msg, *args):
+		self.records.append((level, msg, args))
+
+	def debug(self, msg, *args):
+		self.log(logging.DEBUG, msg, *args)
+
+	def info(self, msg, *args):
+		self.log(logging.INFO, msg, *args)
+
+	def warning(self, msg, *args):
+		self.log(logging.WARNING, msg, *args)
+
+	def error(self, msg, *args):
+		self.log(logging.ERROR, msg, *args)
+
+
+
+def _init_worker(data):
+	global _worker_data
+	_worker_data = data
+
+	# The workers already run in parallel. Also, OpenCV's thread pool can hang after a fork.
+	cv2.setNumThreads(0)
+
+
+def _run_in_worker(func, args):
+	"""
+	Description: Runs func(data, *args) in a worker process. Returns the result and the recorded log messages.
+	"""
+	logger = _worker_data.config.logger
+	_worker_data.config.logger = LogRecorder()
+	try:
+		result = func(_worker_data, *args)
+		log_records = _worker_data.config.logger.records
+	finally:
+		_worker_data.config.logger = logger
+
+	return result, log_records
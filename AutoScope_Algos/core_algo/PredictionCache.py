@@ -0,0 +1,122 @@
+# Import basic libraries
+import os
+import hashlib
+import numpy as np
+from glob import glob
+
+"""
+Description: On-disk cache for the predictions of the segmentation model. Allows re-running the post-processing on a solution folder without re-running the model.
+
+Implementation Notes:
++ Keyed by the content of the canvas image, the content of the weight file, the target_size and the inference mode (full canvas/tiled, inference precision). So, a new canvas or new weights never use old predictions.
++ Predictions are stored in the compact format (uint8 (height, width) label map, see CNN_functions.predArray_to_compactPrediction).
++ Least-recently-used eviction: Each time a prediction is used, its modification time is updated. When the cache exceeds max_size_mb, the oldest predictions are removed.
+"""
+
+cache_suffix = ".npy"
+
+
+class PredictionCache(object):
+
+	def __init__(self, cache_dir, max_size_mb, weight_file, target_size, inference_mode=""):
+		"""
+		Args
+		cache_dir: The folder that stores the cached predictions.
+		max_size_mb: The maximum size of the cache (in MB).
+		weight_file: The weight file loaded into the model (None if no weights are loaded).
+		target_size: The (height, width) of the predictions.
+		inference_mode: Optional string that identifies other settings that change the predictions (e.g. tiled inference).
+		"""
+		self.cache_dir = cache_dir
+		self.max_size_bytes = max_size_mb*1024*1024
+		self.target_size = target_size
+
+		if (not os.path.isdir(cache_dir)):
+			os.makedirs(cache_dir)
+
+		# The model part of the key is the same for all canvas images.
+		weight_hash = "none" if (weight_file is None or not os.path.isfile(weight_file)) else get_file_hash(weight_file)
+		self.model_key = "%s_%dx%d_%s" % (weight_hash, target_size[0], target_size[1], inference_mode)
+
+		self.hits = 0
+		self.misses = 0
+
+
+	def get_key(self, image_path):
+		""" Returns the cache key of the canvas image at image_path. """
+		sha1 = hashlib.sha1()
+		sha1.update(get_file_hash(image_path))
+		sha1.update(self.model_key)
+		return sha1.hexdigest()
+
+
+	def load(self, key):
+		"""
+		Returns the cached label map for key. Returns None if the prediction is not cached.
+		"""
+		cache_path = self._get_cache_path(key)
+		try:
+			label_map = np.load(cache_path)
+		except (IOError, ValueError):
+			self.misses += 1
+			return None
+
+		# Mark as recently used
+		os.utime(cache_path, None)
+		self.hits += 1
+
+		return label_map
+
+
+	def save(self, key, label_map):
+		"""
+		Stores the label map for key, and evicts the least recently used predictions (if needed).
+		"""
+		# Write to a temporary file first, so other processes never load a partially written prediction.
+		cache_path = self._get_cache_path(key)
+		temp_path = cache_path + ".%d.tmp" % os.getpid()
+		with open(temp_path, 'wb') as cache_file:
+			np.save(cache_file, label_map)
+		os.rename(temp_path, cache_path)
+
+		self._evict()
+
+
+	def log_statistics(self, logger):
+		logger.info("Prediction cache: %d hits, %d misses (%s)", self.hits, self.misses, self.cache_dir)
+
+
+	def _evict(self):
+		cache_files = []
+		for cache_path in glob(self.cache_dir + "*" + cache_suffix):
+			try:
+				file_stat = os.stat(cache_path)
+			except OSError: # Removed by another process
+				continue
+			cache_files.append((file_stat.st_mtime, file_stat.st_size, cache_path))
+
+		# Remove the oldest predictions first
+		cache_files.sort()
+		total_size = sum(file_size for _, file_size, _ in cache_files)
+		for _, file_size, cache_path in cache_files:
+			if (total_size <= self.max_size_bytes):
+				break
+			try:
+				os.remove(cache_path)
+			except OSError:
+				pass
+			total_size -= file_size
+
+
+	def _get_cache_path(self, key):
+		return self.cache_dir + key + cache_suffix
+
+
+
+def get_file_hash(path, chunk_size=1024*1024):
+	""" Returns the sha1 hex digest of the content of the file at path. """
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as input_file:
+		for chunk in iter(lambda: input_file.read(chunk_size), b''):
+			sha1.update(chunk)
+	return sha1.hexdigest()
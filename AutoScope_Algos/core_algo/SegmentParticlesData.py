@@ -6,6 +6,7 @@ import glob
 import os
 import math
 from datetime import datetime
+import time
 from collections import defaultdict
 import random
 import itertools
@@ -17,6 +18,9 @@ from tensorflow.python.keras.preprocessing import image as image_keras
 
 # Import local libraries
 import CNN_functions
+from PredictionCache import PredictionCache
+from StreamingMetrics import StreamingMetrics
+from BatchPrefetcher import BatchPrefetcher
 
 
 class SegmentParticlesData(object):
@@ -26,6 +30,9 @@ class SegmentParticlesData(object):
 		self.config = config
 		self.train_count = 0 
 		self.image_train_count = 0 
+		self.prediction_cache = None # Created on first use (see get_prediction_cache)
+		self.prefilter_tile_count = 0 # Tiles considered by the tile pre-filter (see prefilter_tiles)
+		self.prefilter_skipped_count = 0 # Tiles predicted as background without the model
 
 
 	def _get_batches_per_epoch(self, directory, batch_size):
@@ -168,6 +175,47 @@ class SegmentParticlesData(object):
 		# Use PIL since in correct RGB format. And, Keras relies on PIL. 
 		img = PIL.Image.open(image_path) 
 
+		return self._preprocess_image(img, new_size)
+
+
+	def load_canvas(self, image_path, new_size=None):
+		"""
+		Description: Decodes the canvas image a single time. Returns both the original image and the preprocessed model input. 
+		Returns
+		original_img: The original image as a uint8 BGR numpy array (same as cv2.imread)
+		img_input: The preprocessed image (same as _get_image_from_dir)
+		"""
+		original_img = cv2.imread(image_path)
+		if original_img is None:
+			raise IOError("load_canvas: Unable to read image at %s"%(image_path))
+
+		return original_img, self._get_canvas_input(original_img, new_size)
+
+
+	def decode_canvas(self, image_bytes, new_size=None):
+		"""
+		Description: Same as load_canvas, but for an encoded image (e.g. the bytes of a .bmp file) that is already in memory. 
+		"""
+		original_img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+		if original_img is None:
+			raise IOError("decode_canvas: Unable to decode image")
+
+		return original_img, self._get_canvas_input(original_img, new_size)
+
+
+	def _get_canvas_input(self, original_img, new_size=None):
+		"""
+		Description: Preprocesses a decoded canvas image (BGR) into the model input. 
+		"""
+		# Build PIL image from decoded pixels ('BGR'->'RGB'), so that resizing is identical to _get_image_from_dir
+		img = PIL.Image.fromarray(np.ascontiguousarray(original_img[..., ::-1]))
+		return self._preprocess_image(img, new_size)
+
+
+	def _preprocess_image(self, img, new_size=None):
+		"""
+		Resizes a PIL image. Zero centers each pixel. Converts to 32-float BGR dataset. 
+		"""
 
 		# TODO: Used PIL since VGG16 pretrained network used PIL. Not necessary, and can be changed to numpy implementation. 
 		if new_size:
@@ -284,21 +332,304 @@ class SegmentParticlesData(object):
 		image_path: string pointing directly to the original image on the disk. 
 		Returns
 		label_pred[0]: The predicted segmentation of size (height*width, nclassses). Array with categorical output. 
+			With compact_prediction or prediction_cache_dir, a uint8 (height, width) label map. 
 		"""
-
+		# Use the cached prediction (if available)
+		prediction_cache = self.get_prediction_cache()
+		if prediction_cache is not None:
+			cache_key = prediction_cache.get_key(image_path)
+			label_pred = prediction_cache.load(cache_key)
+			if label_pred is not None:
+				return label_pred
 
 		# Get and preprocess label/image
 		img_input = self._get_image_from_dir(image_path, new_size = self.config.target_size)
-		
-		# Convert label/image to correctly shaped tensor
-		img_tensor = np.expand_dims(img_input, axis=0) # Turn single image into tensor (which is what the model expects)
-		label_shape = (self.config.target_size[0]*self.config.target_size[1] , self.config.nclasses)
+		label_pred = self.predict_input(model, img_input)
+
+		if prediction_cache is not None:
+			label_pred = self._save_prediction_to_cache(prediction_cache, cache_key, label_pred)
+
+		return label_pred
+
+
+	def predict_input(self, model, img_input, return_confidence=False):
+		""" 
+		Predicts the segmented output for a preprocessed input image. 
+		Args
+		model: The model used to predict image segmentation. With tile_inference, the model is built with tile_size inputs. 
+		img_input: Preprocessed image of size (height, width, channels), as returned by _get_image_from_dir. 
+		return_confidence: If True, also returns the confidence map (only available with compact_prediction/compact_confidence, otherwise None)
+		Returns
+		label_pred: The predicted segmentation of size (height*width, nclassses). Array with categorical output. 
+			With compact_prediction, a uint8 (height, width) label map. 
+		"""
+		label_pred_list, confidence_list = self._predict_inputs(model, [img_input])
+
+		if (return_confidence):
+			return label_pred_list[0], confidence_list[0]
+
+		return label_pred_list[0]
+
+
+	def predict_image_batch(self, model, image_path_list):
+		""" 
+		Predicts the segmented output for a list of input images with a single model call. 
+		Args
+		model: The model used to predict image segmentation
+		image_path_list: list of strings pointing directly to the original images on the disk. 
+		Returns
+		label_pred_list: List with the predicted segmentation for each image (in the same order as image_path_list). 
+		"""
+		img_input_list = [self._get_image_from_dir(image_path, new_size = self.config.target_size) for image_path in image_path_list]
+
+		return self.predict_input_batch(model, img_input_list)
+
+
+	def predict_input_batch(self, model, img_input_list, return_confidence=False, image_path_list=None):
+		""" 
+		Predicts the segmented output for a list of preprocessed input images. 
+		Without tile_inference, all images are stacked into a single tensor and predicted in one call. 
+		With tile_inference, the images are predicted one after the other (the tiles are already batched). 
+		image_path_list: The path of each input image. Only needed to use the prediction cache (see prediction_cache_dir). 
+			Only the images without a cached prediction are predicted by the model. 
+		Returns
+		label_pred_list: List with the predicted segmentation for each image (same format as predict_input). 
+		confidence_list: Only returned with return_confidence. 
+		"""
+		prediction_cache = self.get_prediction_cache()
+		if (prediction_cache is None) or (image_path_list is None):
+			label_pred_list, confidence_list = self._predict_inputs(model, img_input_list)
+		else:
+			label_pred_list, confidence_list = self._predict_inputs_cached(model, img_input_list, image_path_list, prediction_cache)
+
+		if (return_confidence):
+			return label_pred_list, confidence_list
+
+		return label_pred_list
+
+
+	def _predict_inputs(self, model, img_input_list):
+		"""
+		Description: Predicts a list of preprocessed input images. Handles tiled/full-canvas models as well as compact/categorical outputs. 
+		Returns
+		label_pred_list: The prediction for each image. 
+		confidence_list: The confidence map for each image (None for each image if not available)
+		"""
+		label_pred_list = []
+		confidence_list = []
+
+		# Predict each canvas in overlapping tiles. Tiles are blended first, so the compact format is computed afterwards. 
+		if (self.config.tile_inference):
+			for img_input in img_input_list:
+				label_pred = self._predict_input_tiled(model, img_input)
+				confidence = None
+				if (self.config.compact_prediction):
+					label_pred, confidence = CNN_functions.predArray_to_compactPrediction(label_pred, img_input.shape[:2], self.config.compact_confidence)
+
+				label_pred_list.append(label_pred)
+				confidence_list.append(confidence)
+
+			return label_pred_list, confidence_list
+
+		# Convert images to correctly shaped tensor
+		img_tensor = np.array(img_input_list)
 
 		# Get model predictions. 
-		label_pred = model.predict(img_tensor)
+		# Note: Compact models with a confidence map have two outputs => [label_map, confidence_map]
+		model_output = model.predict(img_tensor, batch_size=len(img_input_list))
+		if isinstance(model_output, list):
+			label_pred, confidence = model_output
+		else:
+			label_pred, confidence = model_output, None
 
+		for i in range(len(img_input_list)):
+			label_pred_list.append(label_pred[i])
+			confidence_list.append(None if confidence is None else confidence[i])
+
+		return label_pred_list, confidence_list
+
+
+	def _predict_inputs_cached(self, model, img_input_list, image_path_list, prediction_cache):
+		"""
+		Description: Same as _predict_inputs(), but uses the cached predictions. Predictions are returned in the compact format. 
+		Confidence maps are not cached (so confidence_list is None for each image). 
+		"""
+		cache_key_list = [prediction_cache.get_key(image_path) for image_path in image_path_list]
+		label_pred_list = [prediction_cache.load(cache_key) for cache_key in cache_key_list]
+
+		# Predict the images that are not cached
+		missing_index_list = [i for i, label_pred in enumerate(label_pred_list) if label_pred is None]
+		if missing_index_list:
+			predicted_list, _ = self._predict_inputs(model, [img_input_list[i] for i in missing_index_list])
+			for i, label_pred in zip(missing_index_list, predicted_list):
+				label_pred_list[i] = self._save_prediction_to_cache(prediction_cache, cache_key_list[i], label_pred)
+
+		return label_pred_list, [None for _ in label_pred_list]
+
+
+	def _save_prediction_to_cache(self, prediction_cache, cache_key, label_pred):
+		""" Converts label_pred to the compact format, and stores it in the cache. Returns the compact label map. """
+		if not np.issubdtype(label_pred.dtype, np.integer):
+			label_pred, _ = CNN_functions.predArray_to_compactPrediction(label_pred, self.config.target_size)
+
+		label_map = np.reshape(label_pred, self.config.target_size).astype(np.uint8)
+		prediction_cache.save(cache_key, label_map)
+
+		return label_map
+
+
+	def get_prediction_cache(self):
+		"""
+		Description: Returns the PredictionCache configured in prediction_cache_dir. Returns None if the cache is disabled. 
+		"""
+		if (self.config.prediction_cache_dir is None):
+			return None
+
+		if self.prediction_cache is None:
+			inference_mode = "tiled_%dx%d_%d" % (self.config.tile_size + (self.config.tile_overlap,)) if self.config.tile_inference else "full"
+			inference_mode += "_" + self.config.inference_precision
+			if (self.config.prefilter_tiles):
+				inference_mode += "_prefilter%d" % self.config.prefilter_min_particle_size
+			self.prediction_cache = PredictionCache(
+				self.config.prediction_cache_dir, 
+				self.config.prediction_cache_size_mb, 
+				self.config.weight_file_input, 
+				self.config.target_size, 
+				inference_mode)
+
+		return self.prediction_cache
+
+
+	def get_auto_batch_size(self, memory_fraction=0.5, max_batch_size=16):
+		"""
+		Description: Estimates the number of canvas images that can be predicted in a single call, based on the available memory. 
+		The estimate is dominated by the block1 activations of the VGG encoder (2 x 64 channels at full resolution), as well as the input/output tensors. 
+		Args
+		memory_fraction: Proportion of the available memory that predictions are allowed to use. 
+		max_batch_size: Upper bound of the returned batch size. 
+		Returns
+		batch_size: At least 1. 
+		"""
+		available_memory = CNN_functions.get_available_memory()
+		if available_memory is None:
+			return 1
+
+		# With tile_inference, the model activations scale with the tiles, while the canvas only needs input/output buffers. 
+		input_dims = self.config.tile_size if self.config.tile_inference else self.config.target_size
+		activation_bytes = input_dims[0]*input_dims[1]*4*(2*64)
+		if (self.config.tile_inference):
+			activation_bytes *= self.config.tile_batch_size
+		canvas_bytes = self.config.target_size[0]*self.config.target_size[1]*4*(self.config.channels + self.config.nclasses)
+		
+		# Batched tiled predictions only hold one set of activations at a time. 
+		if (self.config.tile_inference):
+			batch_size = int((available_memory*memory_fraction - activation_bytes)/canvas_bytes)
+		else:
+			batch_size = int(available_memory*memory_fraction/(activation_bytes + canvas_bytes))
+
+		return max(1, min(batch_size, max_batch_size))
+
+
+	def _predict_input_tiled(self, model, img_input):
+		"""
+		Description: Predicts the segmented output of img_input by splitting it into overlapping tiles. 
+		Tiles are predicted in batches of tile_batch_size. The softmax output of each tile is weighted with a window that ramps down over the overlap region, 
+		so that the tile borders (where the zero-padding of the model causes artifacts) contribute less than the tile centers. 
+		Returns
+		label_pred: The predicted segmentation of size (height*width, nclassses). Same format as the full-canvas prediction. 
+		"""
+		tile_h, tile_w = self.config.tile_size
+		img_h, img_w = img_input.shape[0], img_input.shape[1]
+		nclasses = self.config.nclasses
+
+		# Top-left corner of each tile
+		tile_corners = [(y, x) for y in self._get_tile_starts(img_h, tile_h) for x in self._get_tile_starts(img_w, tile_w)]
+
+		# Blending window for a single tile
+		tile_weights = np.outer(self._get_tile_window(tile_h), self._get_tile_window(tile_w)).astype(np.float32)
+
+		# Accumulate weighted predictions. Only the canvas-sized outputs are held in memory (not canvas-sized activations). 
+		pred_sum = np.zeros((img_h, img_w, nclasses), dtype=np.float32)
+		weight_sum = np.zeros((img_h, img_w), dtype=np.float32)
+
+		# Tiles without candidate foreground are not given to the model. They are blended as certain background (class 0). 
+		if (self.config.prefilter_tiles):
+			foreground_mask = self.get_candidate_foreground(img_input)
+			has_foreground = [foreground_mask[y:y+tile_h, x:x+tile_w].any() for y, x in tile_corners]
+			skipped_corners = [corner for corner, keep in zip(tile_corners, has_foreground) if not keep]
+			tile_corners = [corner for corner, keep in zip(tile_corners, has_foreground) if keep]
+			for y, x in skipped_corners:
+				pred_sum[y:y+tile_h, x:x+tile_w, 0] += tile_weights
+				weight_sum[y:y+tile_h, x:x+tile_w] += tile_weights
+
+			self.prefilter_tile_count += len(skipped_corners) + len(tile_corners)
+			self.prefilter_skipped_count += len(skipped_corners)
+
+		for batch_start in range(0, len(tile_corners), self.config.tile_batch_size):
+			batch_corners = tile_corners[batch_start:batch_start+self.config.tile_batch_size]
+			tile_tensor = np.array([img_input[y:y+tile_h, x:x+tile_w] for y, x in batch_corners])
+
+			# Output of size (tiles, tile_h*tile_w, nclasses)
+			tile_pred = model.predict(tile_tensor, batch_size=len(batch_corners))
+
+			for index, (y, x) in enumerate(batch_corners):
+				pred_tile = np.reshape(tile_pred[index], (tile_h, tile_w, nclasses))
+				pred_sum[y:y+tile_h, x:x+tile_w] += pred_tile*tile_weights[..., np.newaxis]
+				weight_sum[y:y+tile_h, x:x+tile_w] += tile_weights
+
+		# Normalize the blended predictions, and return in the (height*width, nclasses) format. 
+		pred_sum /= weight_sum[..., np.newaxis]
+		label_pred = np.reshape(pred_sum, (img_h*img_w, nclasses))
+
+		return label_pred
+
+
+	def get_candidate_foreground(self, img_input):
+		"""
+		Description: Cheap foreground estimate used to pre-filter the tiles (see prefilter_tiles). 
+		Reverts the preprocessing of img_input, and applies CNN_functions.standard_segmentation to the grayscale image. 
+		Returns
+		Binary (height, width) matrix (1 is candidate foreground). 
+		"""
+		img_bgr = np.clip(img_input + np.asarray(self.config.bgr_means, dtype=np.float32), 0, 255).astype(np.uint8)
+		img_gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+
+		return CNN_functions.standard_segmentation(img_gray, self.config.prefilter_min_particle_size)
+
+
+	def log_prefilter_statistics(self, logger):
+		if (self.prefilter_tile_count == 0):
+			return
+
+		logger.info("Tile pre-filter: %d of %d tiles skipped (%0.3f)", self.prefilter_skipped_count, self.prefilter_tile_count, 
+			self.prefilter_skipped_count/float(self.prefilter_tile_count))
+
+
+	def _get_tile_starts(self, length, tile_length):
+		"""
+		Returns the start position of each tile along a single dimension. 
+		Tiles are shifted by (tile_length - tile_overlap). The last tile is aligned with the end of the dimension. 
+		"""
+		if (tile_length >= length):
+			return [0]
+
+		stride = tile_length - self.config.tile_overlap
+		starts = range(0, length - tile_length, stride)
+		starts.append(length - tile_length)
+
+		return starts
+
+
+	def _get_tile_window(self, tile_length):
+		"""
+		Returns the 1D blending window for a tile. The window is 1 in the center and ramps down linearly over tile_overlap pixels at each edge. 
+		Note: The window is never 0, so that canvas borders (only covered by a single tile) are still normalized correctly. 
+		"""
+		ramp_length = float(self.config.tile_overlap + 1)
+		position = np.arange(tile_length, dtype=np.float32)
+		window = np.minimum(np.minimum((position + 1)/ramp_length, (tile_length - position)/ramp_length), 1.0)
 
-		return label_pred[0]
+		return window
 
 
 
@@ -307,25 +638,19 @@ class SegmentParticlesData(object):
 		Validates model for a single epoch. Provides average results across the entire epoch. 
 		"""
 
-		# Track overall label metrics
-		all_truth = None
-		all_pred = None
+		# Track overall label metrics (only the last batch is kept in memory)
+		metrics = StreamingMetrics(self.config.nclasses)
 
 		# Validate across multiple batches
 		for _ in range(self.config.batches_per_epoch_val):
 			img_input, label_truth =  next(val_generator)
 			label_pred = model.predict_on_batch(img_input)
 			
-			# Append to overall metrics
-			if all_truth is None: 
-				all_truth = label_truth
-				all_pred = label_pred
-			else: 
-				all_truth = np.append(all_truth, label_truth, axis=0)
-				all_pred = np.append(all_pred, label_pred, axis=0)
+			# Update overall metrics
+			metrics.update(label_truth, label_pred)
 
 
-		pixel_wise_accuracy_perBatch = CNN_functions.get_pixel_accuracy_perBatch(all_truth, all_pred)
+		pixel_wise_accuracy_perBatch = metrics.get_accuracy()
 
 
 		# Save random image from last batch (original, truth, prediction). Once per epoch. 
@@ -361,23 +686,29 @@ class SegmentParticlesData(object):
 		# Output results
 		self.config.logger.info("Validation Results")
 		self.config.logger.info("Validation accuracy: %1.8f" %(pixel_wise_accuracy_perBatch))
+		metrics.log_per_class_metrics(self.config.logger)
 		self.config.logger.info("\n\n")
 
 	def train_epoch(self, model, train_generator, in_house = True):
 		""" 
 		Trains model for a single epoch. Provides average results across the entire epoch. 
+		Logs the time per step blocked on data vs. spent in compute. For fit_generator, the time blocked on data is only known for a BatchPrefetcher (measured at the keras queue). 
 		"""
 
 		# Track overall metrics
 		loss = 0
 		accuracy = 0
+		start_time = time.time()
+		data_wait_time = 0.0 # Time blocked on train_generator
 
 		# Use home-brew training
 		if (in_house): 
 			loss_all = []
 			accuracy_all = []
 			for batch in range(self.config.batches_per_epoch_train):
+				wait_start = time.time()
 				img_input, label_truth =  next(train_generator)
+				data_wait_time += time.time() - wait_start
 				metric_output = model.train_on_batch(img_input, label_truth)
 				# Update per batch tracking variables
 				self.train_count += 1
@@ -391,6 +722,7 @@ class SegmentParticlesData(object):
 
 		# Use keras-built in training
 		else: 
+			start_wait_time = train_generator.get_wait_time() if isinstance(train_generator, BatchPrefetcher) else None
 			history = model.fit_generator(
 				train_generator, # Produces training data for a single batch. 
 				epochs = 1, # Only train a single epoch 
@@ -398,6 +730,7 @@ class SegmentParticlesData(object):
 			)
 			self.train_count += self.config.batches_per_epoch_train # Update image tracking 
 			self.image_train_count += self.config.batches_per_epoch_train*self.config.batch_size
+			data_wait_time = None if start_wait_time is None else (train_generator.get_wait_time() - start_wait_time)
 
 			# Note: Use mean just in case we increase epochs in model.fit_generator
 			loss = np.mean(history.history["loss"])
@@ -406,6 +739,11 @@ class SegmentParticlesData(object):
 		# Output results
 		self.config.logger.info("Training Results")
 		self.config.logger.info("Step: %d, Images Trained: %d, Batch loss: %2.6f, Training accuracy: %1.3f" %(self.train_count, self.image_train_count, loss, accuracy))
+		CNN_functions.log_training_step_times(self.config.logger, 
+			step_count = self.config.batches_per_epoch_train, 
+			image_count = self.config.batches_per_epoch_train*self.config.batch_size, 
+			elapsed_time = time.time() - start_time, 
+			data_wait_time = data_wait_time)
 
 
 	def train(self, model, train_generator, val_generator,): 
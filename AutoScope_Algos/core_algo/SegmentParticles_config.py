@@ -18,6 +18,22 @@ Execution Notes:
 ++ target_size needs to be evenly divided by 32 in order to work with the model.
 + RAM Constraint
 ++ During execution (if running locally), the system can get RAM constrained. If that's the case, shut down other running programs, especially Chrome. 
+++ For prediction on entire canvas images, set tile_inference to True. The model is then built with tile_size inputs, and the canvas is predicted in overlapping tiles. Peak memory is set by tile_size and tile_batch_size, not by target_size. 
++ Tiled Inference: 
+++ tile_size and tile_overlap need to be evenly divided by 32, so the tiles line up with the pooling grid of the full canvas. 
+++ Larger tile_overlap gives results closer to full-canvas prediction (the VGG receptive field is large), but increases the number of tiles. 
+++ With prefilter_tiles, the standard segmentation algorithm is run on the canvas first. Only the tiles with candidate foreground are predicted by the model. Most of a canvas is empty background, so most tiles are skipped. 
+++ Use compare_tile_prefilter.py to measure the skipped tiles, the speedup and the particle recall (compared to predicting all tiles). 
++ Compact Prediction: 
+++ With compact_prediction, the argmax is computed within the model (FCN8_compact_output). With tile_inference, the tiles are blended first, and the argmax is computed afterwards. 
+++ All prediction consumers accept both formats (through CNN_functions.predArray_to_predMatrix). 
++ Prediction Cache: 
+++ Set prediction_cache_dir to cache the predictions of canvas images on disk. Re-running a folder with only post-processing changes then skips the model. 
+++ Cached predictions are returned in the compact format (uint8 label maps). A new weight file, target_size or tile setting never uses old predictions. 
++ Inference Precision: 
+++ With inference_precision = 'float16', the prediction model is built with float16 weights and activations (the float32 weight file is cast when loaded). Halves the model memory. 
+++ The speedup depends on the CPU (float16 kernels need hardware support). Use compare_inference_precision.py to measure the accuracy cost and the speedup on the validation folder. 
+++ The model artifact (model_artifact_name) is only used with float32. 
 
 
 Implementation Notes: 
@@ -31,6 +47,7 @@ class SegmentParticles_Config():
 		self.root_data_dir =  "./core_algo/data/clinical_experiment/"
 		self.weight_file_input_name = "20180125_base_segmentation.h5"   #Set to 'None' to disable.
 		self.weight_file_output_name = "seg_class_weights_" # Set to 'None' to disable. 
+		self.model_artifact_name = None # Single file with the complete model for fast prediction startup (created on first use, and rebuilt when the weight file is newer or inference_shape changes). Set to 'None' to disable. 
 		self.generate_images_with_cropping = False
 		self.fullscale_target_size = None # (height, width) for numpy
 		self.target_size = (2464,3264) # (480, 480) for  crops or (2464,3264) for entire image at 8MPX
@@ -49,6 +66,19 @@ class SegmentParticles_Config():
 		self.input_folders = ["10um", "wbc", "rbc"]
 		self.detection_radius = 30 # The proximity that a predicted particle needs to be to a ground truth particle for it to be detected/classified. (needs to be adjusted based on resampling of image)
 		self.bgr_means = [90.61598179, 129.97525112, 103.00621832] # VGG is [103.939, 116.779, 123.68]  
+		self.tile_inference = False # If True, predict_image predicts the canvas in overlapping tiles (to bound memory). Only used for prediction, not training. 
+		self.tile_size = (512, 512) # (height, width) of each tile. Only needed with tile_inference. 
+		self.tile_overlap = 128 # Minimum overlap between neighboring tiles (in pixels). Overlapping predictions are blended. 
+		self.tile_batch_size = 4 # Number of tiles given to the model in a single predict call. 
+		self.prefilter_tiles = False # If True (with tile_inference), tiles without candidate foreground (CNN_functions.standard_segmentation) skip the model, and are predicted as background. 
+		self.prefilter_min_particle_size = 3 # Candidate foreground components with this area (in pixels) or less are ignored by the tile pre-filter. 
+		self.compact_prediction = False # If True, predictions are returned as uint8 (height, width) label maps instead of float32 (height*width, nclasses) arrays. 
+		self.compact_confidence = False # If True (with compact_prediction), the model also produces a uint8 confidence map. 
+		self.prediction_cache_dir = None # Folder used to cache predictions of canvas images (see PredictionCache). Set to 'None' to disable. 
+		self.prediction_cache_size_mb = 2048 # Maximum size of the prediction cache. Least recently used predictions are removed first. 
+		self.inference_precision = 'float32' # 'float32' or 'float16' weights and activations for prediction (not training). Check the accuracy with compare_inference_precision.py before using float16. 
+		self.prefetch_workers = 4 # Number of threads building training batches ahead of the model (see BatchPrefetcher). Set to 0 to build the batches in the training loop. 
+		self.prefetch_queue_size = 8 # Maximum number of training batches built ahead of the model. 
 
 		# Auto Configurations: Can be auto-calculated. 
 		self.train_images_dir = self.root_data_dir + "image_data/" + self.project_folder + "segmentation/train_images/"
@@ -59,7 +89,9 @@ class SegmentParticles_Config():
 		self.log_dir = self.root_data_dir + "log/" + self.project_folder
 		self.output_img_dir = self.root_data_dir + "image_data/" + self.project_folder +"segmentation/img_output/"
 		self.weight_file_input = None if self.weight_file_input_name is None else (self.root_data_dir + "model_storage/" + self.project_folder + self.weight_file_input_name)  
+		self.model_artifact_file = None if self.model_artifact_name is None else (self.root_data_dir + "model_storage/" + self.project_folder + self.model_artifact_name)
 		self.image_shape = self.target_size + (self.channels,)
+		self.inference_shape = (self.tile_size if self.tile_inference else self.target_size) + (self.channels,) # Input shape of the model used for prediction. 
 		#self.colors = [(0,0,0)] + [(random.randint(0,255),random.randint(0,255),random.randint(0,255)) for _ in range(self.nclasses-1)]
 		self.colors = [(0,0,0), (0,0,255), (255,0,0),(0,255,0)] # in bgr format
 		self.segmentation_metadata = CNN_functions.get_json_log(self.root_data_dir + "image_data/" + self.project_folder + "segmentation_metadata.log")
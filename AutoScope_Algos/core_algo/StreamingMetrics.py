@@ -0,0 +1,92 @@
+# Import basic libraries
+import numpy as np
+
+"""
+Description: Accumulates classification/segmentation metrics one batch at a time.
+
+Implementation Notes:
++ Only the running confusion matrix is stored (nclasses x nclasses). So, the predictions of previous batches don't need to be kept in memory.
++ The confusion matrix of a batch is computed with a single np.bincount (no loop over the pixels/particles).
++ All metrics are derived from the confusion matrix. Rows are the ground truth classes, and columns are the predicted classes.
+"""
+
+
+class StreamingMetrics(object):
+
+	def __init__(self, nclasses):
+		self.nclasses = nclasses
+		self.confusion = np.zeros((nclasses, nclasses), dtype=np.int64)
+
+
+	def update(self, truth, pred):
+		"""
+		Description: Adds a batch of categorical outputs.
+		Args
+		truth: Ground truth in categorical format, with the classes in the last axis. E.g. (batch, classes) or (batch, image_pixels, classes)
+		pred: Predictions in the same format as truth.
+		"""
+		self.update_labels(np.argmax(truth, axis=-1), np.argmax(pred, axis=-1))
+
+
+	def update_labels(self, truth_labels, pred_labels):
+		"""
+		Description: Adds a batch of labels (e.g. from np.argmax, or compact segmentation predictions).
+		Args
+		truth_labels: Integer array with the ground truth label of each particle/pixel (any shape).
+		pred_labels: Integer array with the predicted label of each particle/pixel (same shape as truth_labels).
+		"""
+		# Each (truth, pred) pair is mapped to a single index in the flattened confusion matrix
+		pair_index = self.nclasses*np.ravel(truth_labels).astype(np.int64) + np.ravel(pred_labels)
+		self.confusion += np.bincount(pair_index, minlength=self.nclasses*self.nclasses).reshape(self.nclasses, self.nclasses)
+
+
+	def get_confusion_matrix(self):
+		""" Returns the confusion matrix (truth classes x predicted classes). """
+		return self.confusion.astype(float)
+
+
+	def get_count(self):
+		""" Returns the number of particles/pixels added. """
+		return int(self.confusion.sum())
+
+
+	def get_accuracy(self):
+		""" Returns the fraction of particles/pixels with the correct label (the pixel accuracy for segmentation). """
+		return np.trace(self.confusion)/float(max(1, self.get_count()))
+
+
+	def get_precision(self):
+		""" Returns the precision of each class. NaN for classes that are never predicted. """
+		return self._divide(np.diag(self.confusion), self.confusion.sum(axis=0))
+
+
+	def get_recall(self):
+		""" Returns the recall of each class. NaN for classes that are not in the ground truth. """
+		return self._divide(np.diag(self.confusion), self.confusion.sum(axis=1))
+
+
+	def get_iou(self):
+		""" Returns the intersection over union of each class. NaN for classes that are neither in the ground truth nor predicted. """
+		true_positives = np.diag(self.confusion)
+		return self._divide(true_positives, self.confusion.sum(axis=0) + self.confusion.sum(axis=1) - true_positives)
+
+
+	def log_per_class_metrics(self, logger, class_names=None):
+		"""
+		Description: Logs the precision, recall and IoU of each class.
+		class_names: The name of each class (in label order). If None, the labels are used.
+		"""
+		if class_names is None:
+			class_names = [str(label) for label in range(self.nclasses)]
+
+		precision = self.get_precision()
+		recall = self.get_recall()
+		iou = self.get_iou()
+		logger.info("Class\t\t\tPrecision\t\t\tRecall\t\t\tIoU")
+		for label, class_name in enumerate(class_names):
+			logger.info("%s\t\t\t%0.4f\t\t\t%0.4f\t\t\t%0.4f", class_name, precision[label], recall[label], iou[label])
+
+
+	def _divide(self, numerator, denominator):
+		with np.errstate(divide='ignore', invalid='ignore'):
+			return numerator/denominator.astype(float)
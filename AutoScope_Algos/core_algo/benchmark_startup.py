@@ -0,0 +1,108 @@
+# Import basic libraries (timed separately below)
+import time
+import os
+import_start_time = time.time()
+
+#Import keras libraries
+from tensorflow.python.keras._impl.keras import backend as K
+from tensorflow.python.keras.models import load_model as load_keras_model
+
+# import from local libraries
+import CNN_functions
+from segmentation_models import FCN8_32px_factor, FCN8_compact_output
+from classification_models import base_model_with_pos
+from SegmentParticles_config import SegmentParticles_Config
+from ClassifyParticles_config import ClassifyParticles_Config
+
+import_time = time.time() - import_start_time
+
+"""
+Description: Measures the startup time of the segmentation and classification models used for prediction.
+Reports the import time, the graph build time and the weight load time separately.
+
+Execution Notes:
++ Run from the same folder as process_urine_segment.py (the configurations use relative paths).
++ Startup paths that are compared for each model:
+++ Previous: Graph build + imagenet weights, followed by the checkpoint (imagenet weights are overwritten).
+++ Current: Graph build without imagenet weights, followed by the checkpoint (see CNN_functions.build_model_for_inference).
+++ Artifact: Single pre-serialized model file (only if model_artifact_file exists).
++ The segmentation artifact is also wrapped with FCN8_compact_output (checks that a loaded artifact can be used with compact_prediction).
+"""
+
+# Number of times each startup path is timed (the minimum is reported)
+repeat_count = 3
+
+
+
+def main():
+	print "Import time (tensorflow/keras + local modules): %0.2f seconds" % import_time
+
+	seg_config = SegmentParticles_Config()
+	benchmark_model("Segmentation (FCN8_32px_factor)", FCN8_32px_factor, seg_config.inference_shape, seg_config, wrap_artifact=FCN8_compact_output)
+
+	class_config = ClassifyParticles_Config()
+	benchmark_model("Classification (base_model_with_pos)", base_model_with_pos, class_config.image_shape, class_config)
+
+
+
+def benchmark_model(model_name, build_model, input_shape, config, wrap_artifact=None):
+	"""
+	Description: Times each startup stage of a single model. Prints the results.
+	wrap_artifact: If given, the loaded artifact is wrapped with wrap_artifact(model), and the wrapped output shape is checked against input_shape.
+	"""
+	print "\n### %s ###" % model_name
+
+	# Previous startup path: imagenet weights are loaded, then overwritten by the checkpoint
+	build_time, load_time = time_startup(build_model, input_shape, config.imagenet_weights_file, config)
+	print "Previous: Graph build + imagenet weights: %0.2f seconds, Checkpoint load: %0.2f seconds, Total: %0.2f seconds" % (
+		build_time, load_time, build_time + load_time)
+
+	# Current startup path: imagenet weights are skipped when the checkpoint exists
+	build_time, load_time = time_startup(build_model, input_shape, CNN_functions.get_base_weights_for_inference(config), config)
+	print "Current: Graph build: %0.2f seconds, Checkpoint load: %0.2f seconds, Total: %0.2f seconds" % (
+		build_time, load_time, build_time + load_time)
+
+	# Single pre-serialized model
+	if (config.model_artifact_file is not None) and os.path.isfile(config.model_artifact_file):
+		artifact_times = []
+		for _ in range(repeat_count):
+			K.clear_session()
+			start_time = time.time()
+			model = load_keras_model(config.model_artifact_file, compile=False)
+			artifact_times.append(time.time() - start_time)
+		print "Artifact: Load: %0.2f seconds" % min(artifact_times)
+
+		if wrap_artifact is not None:
+			wrapped_model = wrap_artifact(model)
+			assert tuple(wrapped_model.output_shape[1:3]) == tuple(input_shape[:2]), "Wrapped artifact has output shape %s" % (wrapped_model.output_shape,)
+			print "Artifact: Wrapped with %s, output shape %s" % (wrap_artifact.__name__, wrapped_model.output_shape)
+	else:
+		print "Artifact: Not available (set model_artifact_name in the configuration, and run a prediction once to create it)."
+
+
+
+def time_startup(build_model, input_shape, base_weights, config):
+	"""
+	Description: Times the graph build (including base_weights, if given) and the checkpoint load.
+	Returns
+	The minimum graph build time and the minimum checkpoint load time across repeat_count runs.
+	"""
+	build_times = []
+	load_times = []
+	for _ in range(repeat_count):
+		K.clear_session()
+
+		start_time = time.time()
+		model = build_model(input_shape = input_shape, base_weights = base_weights, classes=config.nclasses)
+		build_times.append(time.time() - start_time)
+
+		start_time = time.time()
+		CNN_functions.load_model(model, config.weight_file_input, config)
+		load_times.append(time.time() - start_time)
+
+	return min(build_times), min(load_times)
+
+
+
+if __name__ == "__main__":
+	main()
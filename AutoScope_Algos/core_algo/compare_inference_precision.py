@@ -0,0 +1,158 @@
+# Import basic libraries
+import time
+import glob
+import argparse
+import numpy as np
+
+# import from local libraries
+import CNN_functions
+from SegmentParticlesData import SegmentParticlesData
+from ClassifyParticlesData import ClassifyParticlesData
+from segmentation_models import FCN8_32px_factor
+from classification_models import base_model_with_pos
+from SegmentParticles_config import SegmentParticles_Config
+from ClassifyParticles_config import ClassifyParticles_Config
+
+"""
+Description: Compares reduced-precision inference (see inference_precision in the configurations) against float32 on the validation folders.
+Reports the accuracy cost next to the speedup, so the reduced precision can be checked before it's enabled for prediction.
+
+Execution Notes:
++ Run from the same folder as process_urine_segment.py (the configurations use relative paths).
++ python compare_inference_precision.py --model both
++ Segmentation: Each validation canvas (val_images_dir) is predicted by both models. The particle detection accuracy is determined with CNN_functions.get_foreground_accuracy_perImage.
+++ Also reports the fraction of pixels with the same label in both predictions.
++ Classification: The same validation batches (val_images_dir) are classified by both models. Compares the confusion matrices from ClassifyParticlesData.validate_epoch.
++ Timing: Only the model predictions are timed. Each model predicts once before timing starts (the first prediction includes the graph setup).
+"""
+
+""" Configuration """
+# The reduced precision that is compared against float32
+reduced_precision = 'float16'
+# Maximum number of validation canvas images used for the segmentation comparison (None for all)
+max_segmentation_images = 10
+
+
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-m","--model", help="Model to compare: 'segmentation', 'classification' or 'both'", type=str, default='both')
+	args = parser.parse_args()
+
+	if args.model in ('segmentation', 'both'):
+		compare_segmentation_precision()
+
+	if args.model in ('classification', 'both'):
+		compare_classification_precision()
+
+
+
+def compare_segmentation_precision():
+	"""
+	Description: Compares the particle detection accuracy and the prediction time of the float32 and the reduced-precision segmentation models.
+	"""
+	config = SegmentParticles_Config()
+	CNN_functions.validate_segmentation_config(config)
+	data = SegmentParticlesData(config)
+	precision_list = ['float32', reduced_precision]
+
+	# Build a model for each precision
+	model_dict = {}
+	for precision in precision_list:
+		config.inference_precision = precision
+		model_dict[precision] = CNN_functions.build_model_for_inference(FCN8_32px_factor, config.inference_shape, config)
+
+	image_path_list = sorted(glob.glob(config.val_images_dir + "*/*.bmp"))[:max_segmentation_images]
+	if not image_path_list:
+		raise ValueError("compare_segmentation_precision: No validation images in %s" % config.val_images_dir)
+
+	total_stats = {precision: {} for precision in precision_list}
+	predict_time = {precision: 0.0 for precision in precision_list}
+	pixel_agreement_list = []
+	for image_index, image_path in enumerate(image_path_list):
+
+		# The annotations have the same class folder and file name as the image (see get_data_generator)
+		annotation_path = config.val_annotations_dir + "/".join(image_path.split('/')[-2:])
+		img_input = data._get_image_from_dir(image_path, new_size = config.target_size)
+		label_input = data._get_annotation_from_dir(annotation_path, new_size = config.target_size)
+		truth_array = np.reshape(label_input, (config.target_size[0]*config.target_size[1], config.nclasses))
+		file_prefix = CNN_functions.get_file_name_from_path(image_path, remove_ext=True)
+
+		pred_matrix_dict = {}
+		for precision in precision_list:
+			# Exclude the graph setup from the timing
+			if image_index == 0:
+				data.predict_input(model_dict[precision], img_input)
+
+			start_time = time.time()
+			label_pred = data.predict_input(model_dict[precision], img_input)
+			predict_time[precision] += time.time() - start_time
+
+			stats = CNN_functions.get_foreground_accuracy_perImage(
+				truth_array = truth_array,
+				pred_array = label_pred,
+				config = config,
+				radius = config.detection_radius,
+				base_output_path = config.output_img_dir + file_prefix + "_" + precision)
+			for key, count in stats.items():
+				total_stats[precision][key] = total_stats[precision].get(key, 0) + count
+
+			pred_matrix_dict[precision] = CNN_functions.predArray_to_predMatrix(label_pred, config.target_size)
+
+		pixel_agreement_list.append(np.mean(pred_matrix_dict['float32'] == pred_matrix_dict[reduced_precision]))
+
+	# Output results
+	config.logger.info("###### Segmentation: float32 vs. %s (%d validation images) ######", reduced_precision, len(image_path_list))
+	for precision in precision_list:
+		stats = total_stats[precision]
+		config.logger.info("%s: Detected %d of %d ground truth particles (%0.3f), %d particles only in prediction, %0.2f seconds per image",
+			precision, stats['intersection'], stats['truth'], stats['intersection']/float(max(1, stats['truth'])),
+			stats['only_pred'], predict_time[precision]/len(image_path_list))
+	config.logger.info("Pixels with the same label: %0.4f", np.mean(pixel_agreement_list))
+	config.logger.info("Speedup: %0.2fx", predict_time['float32']/max(predict_time[reduced_precision], 1e-6))
+	config.logger.info("\n")
+
+
+
+def compare_classification_precision():
+	"""
+	Description: Compares the validation accuracy, the confusion matrix and the prediction time of the float32 and the reduced-precision classification models.
+	"""
+	config = ClassifyParticles_Config()
+	CNN_functions.validate_classification_config(config)
+	data = ClassifyParticlesData(config)
+	precision_list = ['float32', reduced_precision]
+
+	# Both models classify the same validation batches
+	val_generator = data.create_custom_labeled_generator(target_directory=config.val_images_dir, augment_data=False)
+	batch_list = [next(val_generator) for _ in range(config.batches_per_epoch_val)]
+
+	results = {}
+	for precision in precision_list:
+		config.inference_precision = precision
+		model = CNN_functions.build_model_for_inference(base_model_with_pos, config.image_shape, config)
+
+		# Exclude the graph setup from the timing
+		model.predict_on_batch(batch_list[0][0])
+
+		config.logger.info("Inference precision: %s", precision)
+		start_time = time.time()
+		accuracy, confusion = data.validate_epoch(model, iter(batch_list))
+		results[precision] = (accuracy, confusion, time.time() - start_time)
+
+	# Output results
+	accuracy_float32, confusion_float32, time_float32 = results['float32']
+	accuracy_reduced, confusion_reduced, time_reduced = results[reduced_precision]
+	config.logger.info("###### Classification: float32 vs. %s (%d validation batches) ######", reduced_precision, len(batch_list))
+	config.logger.info("float32: Accuracy %0.4f, %0.2f seconds", accuracy_float32, time_float32)
+	config.logger.info("%s: Accuracy %0.4f, %0.2f seconds", reduced_precision, accuracy_reduced, time_reduced)
+	config.logger.info("Confusion matrix difference (%s - float32):", reduced_precision)
+	config.logger.info(confusion_reduced - confusion_float32)
+	config.logger.info("Speedup: %0.2fx", time_float32/max(time_reduced, 1e-6))
+	config.logger.info("\n")
+
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,100 @@
+# Import basic libraries
+import time
+import glob
+import argparse
+import numpy as np
+
+# import from local libraries
+import CNN_functions
+from SegmentParticlesData import SegmentParticlesData
+from segmentation_models import FCN8_32px_factor
+from SegmentParticles_config import SegmentParticles_Config
+
+"""
+Description: Measures the tile pre-filter (see prefilter_tiles in SegmentParticles_Config) against predicting all the tiles.
+Reports the fraction of tiles skipped, the speedup, and the particle recall compared to the prediction of all tiles.
+
+Execution Notes:
++ Run from the same folder as process_urine_segment.py (the configurations use relative paths).
++ Requires tile_inference in SegmentParticles_Config.
++ python compare_tile_prefilter.py --image_glob "./path/to/canvas/folder/*.bmp" (by default, uses the segmentation validation images)
++ Recall: The particles of the prediction of all tiles are treated as the ground truth (CNN_functions.determine_segmentation_accuracy).
+++ A particle missed by the pre-filter lies in a skipped tile. Increase the tile overlap or decrease prefilter_min_particle_size if the recall is too low.
++ Timing: Only the predictions are timed (including the pre-filter). The model predicts once before timing starts (the first prediction includes the graph setup).
+"""
+
+""" Configuration """
+# Maximum number of canvas images used for the comparison (None for all)
+max_images = 10
+
+
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-i","--image_glob", help="Glob pattern for the canvas images (default: the segmentation validation images)", type=str, default=None)
+	args = parser.parse_args()
+
+	config = SegmentParticles_Config()
+	CNN_functions.validate_segmentation_config(config)
+	if (not config.tile_inference):
+		raise ValueError("compare_tile_prefilter: The tile pre-filter requires tile_inference in SegmentParticles_Config.")
+
+	image_glob = args.image_glob if args.image_glob is not None else config.val_images_dir + "*/*.bmp"
+	image_path_list = sorted(glob.glob(image_glob))[:max_images]
+	if not image_path_list:
+		raise ValueError("compare_tile_prefilter: No canvas images match %s" % image_glob)
+
+	data = SegmentParticlesData(config)
+	model = CNN_functions.build_model_for_inference(FCN8_32px_factor, config.inference_shape, config)
+
+	total_stats = {}
+	predict_time = {False: 0.0, True: 0.0}
+	pixel_agreement_list = []
+	for image_index, image_path in enumerate(image_path_list):
+		img_input = data._get_image_from_dir(image_path, new_size = config.target_size)
+
+		# Exclude the graph setup from the timing
+		if image_index == 0:
+			config.prefilter_tiles = False
+			data.predict_input(model, img_input)
+
+		# Predict all the tiles, then only the tiles with candidate foreground
+		pred_matrix_dict = {}
+		for prefilter_tiles in (False, True):
+			config.prefilter_tiles = prefilter_tiles
+			start_time = time.time()
+			label_pred = data.predict_input(model, img_input)
+			predict_time[prefilter_tiles] += time.time() - start_time
+
+			pred_matrix = CNN_functions.predArray_to_predMatrix(label_pred, config.target_size)
+			pred_matrix_dict[prefilter_tiles] = CNN_functions.apply_morph(pred_matrix, morph_type='foreground')
+
+		# Particle recall of the pre-filtered prediction (compared to the prediction of all tiles)
+		file_prefix = CNN_functions.get_file_name_from_path(image_path, remove_ext=True)
+		stats = CNN_functions.determine_segmentation_accuracy(
+			truth_matrix = pred_matrix_dict[False],
+			pred_matrix = pred_matrix_dict[True],
+			config = config,
+			radius = config.detection_radius,
+			base_output_path = config.output_img_dir + file_prefix + "_prefilter")
+		for key, count in stats.items():
+			total_stats[key] = total_stats.get(key, 0) + count
+
+		pixel_agreement_list.append(np.mean(pred_matrix_dict[False] == pred_matrix_dict[True]))
+
+	# Output results
+	config.logger.info("###### Tile pre-filter (%d canvas images) ######", len(image_path_list))
+	data.log_prefilter_statistics(config.logger)
+	config.logger.info("All tiles: %0.2f seconds per image", predict_time[False]/len(image_path_list))
+	config.logger.info("Pre-filtered tiles: %0.2f seconds per image", predict_time[True]/len(image_path_list))
+	config.logger.info("Speedup: %0.2fx", predict_time[False]/max(predict_time[True], 1e-6))
+	config.logger.info("Particle recall: %d of %d particles (%0.3f), %d particles only in the pre-filtered prediction",
+		total_stats['intersection'], total_stats['truth'], total_stats['intersection']/float(max(1, total_stats['truth'])), total_stats['only_pred'])
+	config.logger.info("Pixels with the same label: %0.4f", np.mean(pixel_agreement_list))
+	config.logger.info("\n")
+
+
+
+if __name__ == "__main__":
+	main()
@@ -42,7 +42,7 @@ def main():
 
 
 	# Apply standard segmentation algo
-	img_segmented_pred = CNN_functions.standard_segmentation(im_original, min_particle_size)
+	img_segmented_pred = CNN_functions.standard_segmentation(im_original, min_particle_size, logger=config.logger)
 
 	# Calculate accuracy. 
 	output_filename_suffix = img_filename[:img_filename.rfind('.')]
@@ -13,6 +13,7 @@ import sys
 import utility_functions_data as util
 sys.path.insert(0, './urine_particles')
 import CNN_functions
+import CropShard
 
 
 """
@@ -38,6 +39,7 @@ output_crop_size = 64 # The output size of the crops, measured in pixels. Used o
 validation_proportion = 0.2 #Proportion of images placed in validation
 skip_boundary_particles = True # Skip the particles that are on the boundary of the image. 
 debug_flag = True
+crop_output_format = 'bmp' # Select 'bmp' to save each crop as a .bmp file. Select 'shard' to save the crops of each canvas (per class) in a single CropShard. 
 balance_classes = False # Flag to balance classes in training and validation. 
 segmentation_metadata_exists = False # Flag to cross-reference metadata from classification/segmentation setup.
 
@@ -82,7 +84,10 @@ def main():
 	generate_crops_from_labels(input_particle_folders)
 
 	# Split into validation and training data
-	util.split_data(input_dir=training_root_dir, output_dir=validation_root_dir, move_proportion=validation_proportion, in_order=False)
+	if (crop_output_format == 'shard'):
+		util.split_shards(input_dir=training_root_dir, output_dir=validation_root_dir, move_proportion=validation_proportion, in_order=False)
+	else:
+		util.split_data(input_dir=training_root_dir, output_dir=validation_root_dir, move_proportion=validation_proportion, in_order=False)
 
 	# Augment the dataset so each class has equal images
 	if (balance_classes):
@@ -116,7 +121,7 @@ def generate_crops_from_labels(input_particle_folders):
 			log.close()
 
 			# Crop the original image based on the predicted segmentation. Label the crops based on the reference coordinates. 
-			original_img_cropped = crop_particles_into_class_folders_using_labels(original_img, particle_list)
+			original_img_cropped = crop_particles_into_class_folders_using_labels(original_img, particle_list, canvas_name=particle_folder + "_" + base_file_name)
 
 			# Save output with cropped images
 			if (debug_flag):
@@ -124,14 +129,18 @@ def generate_crops_from_labels(input_particle_folders):
 				cv2.imwrite(debug_img_output_path, original_img_cropped)
 
 
-def crop_particles_into_class_folders_using_labels(original_image, particle_list):
+def crop_particles_into_class_folders_using_labels(original_image, particle_list, canvas_name=None):
 	"""
 	Description: Crop particles based on ground truth labels. 
+	canvas_name: Name of the shard for the crops of original_image (only used when crop_output_format is 'shard'). 
 	"""
 	original_cpy = None
 	if (debug_flag):
 		original_cpy = original_image.copy()
 
+	# Crops are collected into a shard per class (only used when crop_output_format is 'shard')
+	shard_writers = {}
+
 	# Turn reference coordinates into numpy array (useful for matrix calculation)
 	coordinates_truth_list, metadata_truth_list = map(list, zip(*particle_list))
 	coordinates_truth_list = np.asarray(coordinates_truth_list)
@@ -155,8 +164,16 @@ def crop_particles_into_class_folders_using_labels(original_image, particle_list
 		class_folder = class_name + "/"
 		# Important: Order of centroid data important! Used as a feature later. 
 		file_name = target_truth_metadata["main"] + "_" + target_truth_metadata["sub"] + "_" + str(int(centroid[0])) + "_" + str(int(centroid[1])) + ".bmp"
-		output_path = training_root_dir + class_folder + file_name
-		cv2.imwrite(output_path, crop)
+		if (crop_output_format == 'shard'):
+			# Shards need crops with identical dimensions
+			if (crop.shape[0] != output_crop_size) or (crop.shape[1] != output_crop_size): 
+				crop = cv2.resize(crop, (output_crop_size, output_crop_size), interpolation=cv2.INTER_AREA)
+			if class_name not in shard_writers:
+				shard_writers[class_name] = CropShard.CropShardWriter(training_root_dir + class_folder + canvas_name, crop_size=output_crop_size, channels=original_image.shape[2])
+			shard_writers[class_name].add_crop(crop, centroid, canvas_name=canvas_name, name=file_name, label=class_name)
+		else:
+			output_path = training_root_dir + class_folder + file_name
+			cv2.imwrite(output_path, crop)
 
 		# Place indicator for each ground truth partidcle detected. 
 		if (debug_flag): 
@@ -168,6 +185,10 @@ def crop_particles_into_class_folders_using_labels(original_image, particle_list
 				color=(0, 255, 0), 
 				thickness=2)
 
+	# Save the shards with the crops of each class
+	for shard_writer in shard_writers.values():
+		shard_writer.close()
+
 	# Return original_cpy for debugging purposes
 	return original_cpy
 
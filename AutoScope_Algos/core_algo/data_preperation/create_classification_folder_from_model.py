@@ -20,6 +20,7 @@ import utility_functions_data as util
 sys.path.insert(0, './urine_particles')
 from SegmentParticlesData import SegmentParticlesData
 import CNN_functions
+import CropShard
 from segmentation_models import FCN8_32px_factor as createModel
 from SegmentParticles_config import SegmentParticles_Config
 
@@ -48,6 +49,7 @@ output_crop_size = 64 # The output size of the crops, measured in pixels. Used o
 validation_proportion = 0.2 #Proportion of images placed in validation
 skip_boundary_particles = True # Skip the particles that are on the boundary of the image. 
 debug_flag = True
+crop_output_format = 'bmp' # Select 'bmp' to save each crop as a .bmp file. Select 'shard' to save the crops of each canvas (per class) in a single CropShard. 
 
 
 classification_labels = {
@@ -91,7 +93,10 @@ def main():
 	generate_crops_from_model(segmentation_metadata)
 
 	# Split into validation and training data
-	util.split_data(input_dir=training_root_dir, output_dir=validation_root_dir, move_proportion=validation_proportion, in_order=False)
+	if (crop_output_format == 'shard'):
+		util.split_shards(input_dir=training_root_dir, output_dir=validation_root_dir, move_proportion=validation_proportion, in_order=False)
+	else:
+		util.split_data(input_dir=training_root_dir, output_dir=validation_root_dir, move_proportion=validation_proportion, in_order=False)
 
 
 	# Augment the dataset so each class has equal images
@@ -131,19 +136,17 @@ def generate_crops_from_model(segmentation_metadata):
 			log.close()
 
 			# Create reference labeled image. 
-			im_mask = np.zeros(original_img.shape) 
 			label_colors = [(i,i,i) for i in range(segmentation_metadata["nclasses"])]
-			im_mask = util.label_single_image(
-				input_image=im_mask, 
+			label_mask = util.rasterize_particle_list(
+				image_shape=original_img.shape, 
 				particle_list=particle_list, 
-				color_list=label_colors, 
 				radius=segmentation_metadata["indicator_radius"], 
 				segmentation_labels=segmentation_metadata["segmentation_labels"])
 
 		
 			# Predict segmentation of original_img with segmentation model  
 			temp_annotations_path = classification_folder_dir + "temp.bmp"
-			cv2.imwrite(temp_annotations_path, im_mask)
+			cv2.imwrite(temp_annotations_path, util.labels_to_image(label_mask, label_colors))
 			label_pred, label_truth = data.validate_image(model, original_img_path, temp_annotations_path)
 			os.remove(temp_annotations_path) # Remove the temp file. 
 
@@ -158,11 +161,10 @@ def generate_crops_from_model(segmentation_metadata):
 					base_output_path = save_path)
 
 			# Reshape the predicted labels.
-			label_pred_reshaped = np.argmax(label_pred, axis=1) # Convert from categorical format to label format. 
-			label_pred_reshaped = np.reshape(label_pred_reshaped, data.config.target_size)
+			label_pred_reshaped = CNN_functions.predArray_to_predMatrix(label_pred, data.config.target_size) # Convert from categorical format to label format. 
 
 			# Crop the original image based on the predicted segmentation. Label the crops based on the reference coordinates. 
-			original_img_cropped = crop_particles_into_class_folders_using_model(original_img, label_pred_reshaped, particle_list)
+			original_img_cropped = crop_particles_into_class_folders_using_model(original_img, label_pred_reshaped, particle_list, canvas_name=particle_folder + "_" + base_file_name)
 
 
 			# Save output with cropped images
@@ -172,9 +174,10 @@ def generate_crops_from_model(segmentation_metadata):
 
 
 
-def crop_particles_into_class_folders_using_model(original_image, predicted_image, particle_list):
+def crop_particles_into_class_folders_using_model(original_image, predicted_image, particle_list, canvas_name=None):
 	"""
 	Description: Crop particles based on segmentations produced by model. 
+	canvas_name: Name of the shard for the crops of original_image (only used when crop_output_format is 'shard'). 
 	"""
 	# Obtain scaling factors between orginal and predicted images. 
 	factor_height, factor_width = get_scale_factors(original_image, predicted_image)
@@ -183,6 +186,9 @@ def crop_particles_into_class_folders_using_model(original_image, predicted_imag
 	if (debug_flag):
 		original_cpy = original_image.copy()
 
+	# Crops are collected into a shard per class (only used when crop_output_format is 'shard')
+	shard_writers = {}
+
 
 	# Get the centroids of each segmented particle
 	pred_centroids_list = get_segmentation_coordinates(predicted_image)
@@ -226,8 +232,16 @@ def crop_particles_into_class_folders_using_model(original_image, predicted_imag
 		class_folder = class_name + "/"
 		# Important: Order of centroid data important! Used as a feature later. 
 		file_name = target_truth_metadata["main"] + "_" + target_truth_metadata["sub"] + "_" + str(int(centroid_pred_upscaled[0])) + "_" + str(int(centroid_pred_upscaled[1])) + ".bmp"
-		output_path = training_root_dir + class_folder + file_name
-		cv2.imwrite(output_path, crop)
+		if (crop_output_format == 'shard'):
+			# Shards need crops with identical dimensions
+			if (crop.shape[0] != output_crop_size) or (crop.shape[1] != output_crop_size): 
+				crop = cv2.resize(crop, (output_crop_size, output_crop_size), interpolation=cv2.INTER_AREA)
+			if class_name not in shard_writers:
+				shard_writers[class_name] = CropShard.CropShardWriter(training_root_dir + class_folder + canvas_name, crop_size=output_crop_size, channels=original_image.shape[2])
+			shard_writers[class_name].add_crop(crop, centroid_pred_upscaled, canvas_name=canvas_name, name=file_name, label=class_name)
+		else:
+			output_path = training_root_dir + class_folder + file_name
+			cv2.imwrite(output_path, crop)
 
 		# Place indicator for each ground truth partidcle detected. 
 		if (debug_flag): 
@@ -239,6 +253,10 @@ def crop_particles_into_class_folders_using_model(original_image, predicted_imag
 				color=(0, 255, 0), 
 				thickness=3)
 
+	# Save the shards with the crops of each class
+	for shard_writer in shard_writers.values():
+		shard_writer.close()
+
 	# Return original_cpy for debugging purposes
 	return original_cpy
 	
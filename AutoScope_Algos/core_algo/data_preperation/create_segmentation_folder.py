@@ -7,6 +7,8 @@ from glob import glob
 import random
 import os
 import math
+import time
+import multiprocessing
 
 # Local libraries
 import utility_functions_data as util
@@ -19,6 +21,9 @@ Execution Notes:
 Implementation Notes: 
 + Take original images and coordinate logs from raw_image_data folder, label the images, and place them into an output training folder with the appropriate folder structure. 
 + Original images in training folder are linked to their corresponding images in the raw_data folder. Do not change/remove raw data. 
++ The coordinate logs are labeled in parallel by num_workers processes. Each log only writes its own outputs (named after the log), so the outputs don't depend on the number of workers or the order the logs are finished in. 
+++ split_data and the metadata log run after all the logs are labeled. 
+++ The time spent in each stage is printed at the end (summed over the workers for the labeling stages). 
 
 """
 
@@ -30,6 +35,7 @@ segmentation_folder_name = 'segmentation/'
 indicator_radius = 20 # Moved from 15 to 20px because moved from 5MPx to 8MPx (scaled radius based on linear increase of width)
 crop_images_flag = False
 validation_proportion = 0.1
+num_workers = None # Number of processes that label the coordinate logs in parallel. None for the number of CPU cores. Set to 0 to label in the main process. 
 
 
 # Implementation Notes: Labels need to start at 0 (with the bacgkround), and increment monotonically by 1. 
@@ -70,31 +76,75 @@ label_colors = [(i,i,i) for i in range(nclasses)]
 
 def main(): 
 
+	start_time = time.time()
 	create_segmentation_folder(output_dir_segmentation) # Build the training folder structure. 
 
+	coordinate_files = []
 	for target_folder in input_particle_folders:
 		coordinate_folder = input_dir_root + target_folder + "coordinates/"
-		coordinate_files = glob(coordinate_folder + "*_classes.json")
-		for coordinate_log_path in coordinate_files:
-
-			label_classes(coordinate_log_path)
+		coordinate_files.extend(sorted(glob(coordinate_folder + "*_classes.json")))
 
+	# Label all the coordinate logs (in parallel)
+	label_start_time = time.time()
+	stage_times = label_all_classes(coordinate_files, num_workers)
+	label_time = time.time() - label_start_time
 
 	# Move data from training folder into validation folder. 
 	# Since split_data sorts the data, will move corresponding images/annotations to the validation folder. 
+	split_start_time = time.time()
 	util.split_data(input_dir = train_annotations_dir, output_dir = val_annotations_dir, move_proportion = validation_proportion, in_order = True)
 	util.split_data(input_dir = train_images_dir, output_dir = val_images_dir, move_proportion = validation_proportion, in_order = True)
+	split_time = time.time() - split_start_time
 
 	# Create metadata log
 	create_segmentation_metadata_log(segmentation_metadata_path) 
 
+	# Print timings
+	print "Labeled %d coordinate logs in %0.1fs" % (len(coordinate_files), label_time)
+	for stage in ["load", "label", "save"]:
+		print "+ %s: %0.1fs (summed over workers)" % (stage, stage_times[stage])
+	print "split_data: %0.1fs" % (split_time)
+	print "Total: %0.1fs" % (time.time() - start_time)
+
+
+
+def label_all_classes(coordinate_files, num_workers):
+	"""
+	Description: Runs label_classes() for each coordinate log, spread over num_workers processes. Returns after all the logs are labeled. 
+	Return 
+	stage_times: Dictionary that maps each stage of label_classes() to the total time spent in the stage (in seconds). 
+	"""
+	stage_times = {"load": 0.0, "label": 0.0, "save": 0.0}
+
+	if (num_workers == 0):
+		log_stage_times_list = [label_classes(coordinate_log_path) for coordinate_log_path in coordinate_files]
+	else:
+		pool = multiprocessing.Pool(num_workers) # Workers are forked, so they use the same visual_colors
+		try:
+			log_stage_times_list = pool.map(label_classes, coordinate_files, chunksize=1)
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+
+	for log_stage_times in log_stage_times_list:
+		for stage, stage_time in log_stage_times.iteritems():
+			stage_times[stage] += stage_time
+
+	return stage_times
+
 
 
 
 def label_classes(coordinate_log_path, crop_bool = False):
 	"""
 	Use log file that indicates 1) coordinate of each particle and 2) type of each particle to perform semantic segmentation. 
+	Return
+	stage_times: Dictionary with the time spent loading the image/log, labeling the masks and saving the outputs (in seconds). 
 	"""
+	stage_start_time = time.time()
 
 	# Define directory/file names
 	base_file_name, particle_folder = util.get_image_name_from_coordinate_log(coordinate_log_path)
@@ -110,9 +160,6 @@ def label_classes(coordinate_log_path, crop_bool = False):
 
 	# Load image
 	im_original = cv2.imread(input_image_path) # Careful: format in BGR
-	im_overlay = im_original.copy()
-	im_mask = np.zeros(im_overlay.shape)
-	im_mask_display = np.zeros(im_overlay.shape)
 
 	# Load the coordinate data structure saved in JSON format. 
 	log = open(coordinate_log_path, 'r')
@@ -124,28 +171,33 @@ def label_classes(coordinate_log_path, crop_bool = False):
 	classes = coordinate_log_data['classes']
 
 	verify_class_configuration(classes, segmentation_labels)
+	load_time = time.time() - stage_start_time
+	stage_start_time = time.time()
 
 
-
-	im_overlay = util.label_single_image(im_overlay, particle_list, visual_colors, indicator_radius, segmentation_labels)
-	im_mask_display = util.label_single_image(im_mask_display, particle_list, visual_colors, indicator_radius, segmentation_labels)
-	im_mask = util.label_single_image(im_mask, particle_list, label_colors, indicator_radius, segmentation_labels)
+	# Rasterize the labels into a single-channel mask. The 3-channel masks are only created when they are saved. 
+	label_mask = util.rasterize_particle_list(im_original.shape, particle_list, indicator_radius, segmentation_labels)
+	im_overlay = util.labels_to_image(label_mask, visual_colors, output_image=im_original.copy())
+	label_time = time.time() - stage_start_time
+	stage_start_time = time.time()
 
 
 	# Save the image masks used for visualization. 
-	cv2.imwrite(output_image_display_path, im_mask_display)
+	cv2.imwrite(output_image_display_path, util.labels_to_image(label_mask, visual_colors))
 	cv2.imwrite(output_image_overlay_path, im_overlay)
+	del im_overlay
 
 	# Crops  the annotation image and the original image in the same pattern. 
 	if (crop_images_flag):
-		crop_image(img = im_mask, output_path = output_annotated_train_path[:-4]) # crop the annotations 
+		crop_image(img = util.labels_to_image(label_mask, label_colors), output_path = output_annotated_train_path[:-4]) # crop the annotations 
 		crop_image(img = im_original, output_path = output_image_train_path[:-4]) # crop the original image 
 
 
 	else: # Save entire images (annotations/original images) in corresponding training directory.
-		cv2.imwrite(output_annotated_train_path, im_mask)
+		cv2.imwrite(output_annotated_train_path, util.labels_to_image(label_mask, label_colors))
 		os.link(input_image_path, output_image_train_path)
-	
+
+	return {"load": load_time, "label": label_time, "save": time.time() - stage_start_time}
 
 
 
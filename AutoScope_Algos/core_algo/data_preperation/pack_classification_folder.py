@@ -0,0 +1,88 @@
+# Import basic libraries
+import os
+import re
+import sys
+import argparse
+
+# import from local libraries
+sys.path.insert(0, './urine_particles')
+from ClassifyParticlesData import ClassifyParticlesData
+import CropShard
+import PackedDataset
+from ClassifyParticles_config import ClassifyParticles_Config
+
+"""
+Description: Packs the classification folders (training + validation) into packed datasets (see PackedDataset).
+Goal of script: Train from a few memory-mapped arrays, instead of opening a .bmp file for every crop in every batch.
+
+Execution Notes:
++ Uses the folders, target_size, color and class_mapping of ClassifyParticles_Config. Pack again after changing target_size or color.
++ Outputs to config.train_pack_prefix and config.val_pack_prefix. To train from the packed datasets, set use_packed_dataset in ClassifyParticles_Config.
++ The _cpy duplicates of balance_classes_in_dir are skipped (see packed_balance_classes in ClassifyParticles_Config). Use --keep_copies to pack them.
++ Crops stored in CropShards are packed as well.
+"""
+
+# Matches the crop names of the duplicates created by balance_classes_in_dir (e.g. 'img1_43_235_cpy20.bmp')
+copy_name_pattern = re.compile(r'_cpy\d+\.bmp$')
+
+
+
+def pack_classification_folder(data, input_dir, pack_prefix, keep_copies):
+	"""
+	Description: Packs all the crops within the class subfolders of input_dir.
+	Args
+	data: ClassifyParticlesData instance (determines the target_size, color and custom features).
+	input_dir: Classification folder with a subfolder per class (e.g. classification/training/)
+	pack_prefix: Output path of the packed dataset, without the suffix.
+	keep_copies: If False, skips the _cpy duplicates created by balance_classes_in_dir.
+	"""
+	config = data.config
+	crop_list = data.get_crop_list(input_dir)
+	if (not keep_copies):
+		crop_list = [crop_ref for crop_ref in crop_list if not copy_name_pattern.search(CropShard.get_crop_name(crop_ref))]
+	crop_list.sort()
+
+	feature_table = data.get_custom_feature_table(crop_list)
+
+	writer = PackedDataset.PackedDatasetWriter(
+		pack_prefix = pack_prefix,
+		crop_count = len(crop_list),
+		image_shape = config.image_shape,
+		feature_count = feature_table.shape[1],
+		class_mapping = config.class_mapping,
+		target_size = config.target_size,
+		color = config.color)
+
+	for crop_ref, features in zip(crop_list, feature_table):
+		writer.add_crop(
+			image = data.get_packed_crop(crop_ref),
+			label = data._get_label_from_imgPath(crop_ref).argmax(),
+			features = features,
+			name = CropShard.get_crop_name(crop_ref))
+
+	writer.close()
+	print "Packed %d crops from %s into %s" % (len(crop_list), input_dir, pack_prefix)
+
+
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--keep_copies", help="Also pack the _cpy duplicates created by balance_classes_in_dir", action="store_true")
+	args = parser.parse_args()
+
+	config = ClassifyParticles_Config()
+	config.crop_cache_size_mb = None # Each crop is only loaded once
+	data = ClassifyParticlesData(config)
+
+	for input_dir, pack_prefix in [(config.train_images_dir, config.train_pack_prefix), (config.val_images_dir, config.val_pack_prefix)]:
+		pack_dir = os.path.dirname(pack_prefix)
+		if not os.path.exists(pack_dir):
+			os.makedirs(pack_dir)
+
+		pack_classification_folder(data, input_dir, pack_prefix, args.keep_copies)
+
+
+
+if __name__ == "__main__":
+	main()
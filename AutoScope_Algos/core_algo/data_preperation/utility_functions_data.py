@@ -1,4 +1,5 @@
 import cv2
+import numpy as np
 from glob import glob
 import os
 import math
@@ -6,6 +7,12 @@ import random
 import shutil
 import itertools
 
+# Note: rasterize_labels, get_disc_kernel and labels_to_image are duplicated in Labeling_Algos/labeling_tools/utility_functions.py
+# (Labeling_Algos and AutoScope_Algos are run from their own folders, and don't import from each other). Keep both copies identical.
+# Pixel offsets of the filled circles drawn by cv2.circle, for each radius. See get_disc_kernel
+_disc_kernels = {}
+
+
 def label_single_image(input_image, particle_list, color_list, radius, segmentation_labels):
 	"""
 	Args
@@ -16,22 +23,105 @@ def label_single_image(input_image, particle_list, color_list, radius, segmentat
 	Return
 	labeled_image: The color channels of the image cotains the color labels according to the information in particle_list.
 	Note: Technically, the labeled_image doesn't need to be returned since the input_image is a reference to the object. However, we return labeled_image for clarity. 
+	Note: To label a new (empty) image, use rasterize_particle_list() + labels_to_image() instead (no 3-channel mask is needed until the mask is saved). 
+	"""
+	label_mask = rasterize_particle_list(input_image.shape, particle_list, radius, segmentation_labels)
+
+	return labels_to_image(label_mask, color_list, output_image=input_image)
+
+
+def rasterize_particle_list(image_shape, particle_list, radius, segmentation_labels):
+	"""
+	Description: Rasterizes a filled circle for each particle in particle_list into a single-channel label mask (see rasterize_labels). 
+	Args
+	particle_list: list that includes values with the following format.  [centroid, metadata]
+	"""
+	centroid_list = [particle[0] for particle in particle_list]
+	label_list = [metadata_to_label(particle[1], segmentation_labels) for particle in particle_list]
+
+	return rasterize_labels(image_shape, centroid_list, label_list, radius)
+
+
+def rasterize_labels(image_shape, centroid_list, label_list, radius):
+	"""
+	Description: Rasterizes a filled circle for each particle into a single-channel uint8 label mask. 
+	The pixels of each circle are a precomputed kernel (see get_disc_kernel), so all the circles are stamped with a single vectorized assignment. 
+	Pixel-identical to drawing the filled circles with cv2.circle, one by one, in the order of centroid_list (later circles are drawn on top). 
+	Args
+	image_shape: The shape of the labeled image (only the height and width are used). 
+	centroid_list: The centroid of each particle, in (width, height) format. 
+	label_list: The label of each particle (0 to 254). 
+	radius: the indicator radius
+	Return
+	label_mask: uint8 array of size (height, width). label+1 for pixels within a circle, and 0 for pixels without a circle. 
 	"""
+	height, width = image_shape[:2]
+	label_mask = np.zeros((height, width), dtype=np.uint8)
+	if (len(centroid_list) == 0):
+		return label_mask
+
+	label_array = np.asarray(label_list, dtype=int)
+	if (label_array.min() < 0) or (label_array.max() > 254):
+		raise ValueError("rasterize_labels: Labels need to be between 0 and 254.")
+
+	# Truncate centroids (same as the int() cast for cv2.circle)
+	centroids = np.array([(int(centroid[0]), int(centroid[1])) for centroid in centroid_list])
+
+	# Pixels of each circle: (particles, kernel pixels)
+	row_offsets, col_offsets = get_disc_kernel(radius)
+	rows = centroids[:, 1:2] + row_offsets
+	cols = centroids[:, 0:1] + col_offsets
+	values = np.repeat(label_array + 1, len(row_offsets)).astype(np.uint8)
+
+	# Remove pixels outside the image
+	inside = ((rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)).ravel()
+	pixel_index = (rows*width + cols).ravel()[inside]
+	values = values[inside]
+
+	# Overlapping circles: Keep the last circle of each pixel (the first occurrence in reversed order)
+	pixel_index, first_index = np.unique(pixel_index[::-1], return_index=True)
+	label_mask.ravel()[pixel_index] = values[::-1][first_index]
+
+	return label_mask
 
-	for index in range(len(particle_list)):
 
-		# Obtain + format centroid
-		centroid = particle_list[index][0]
-		centroid_cv2 = (int(centroid[0]), int(centroid[1]))
+def get_disc_kernel(radius):
+	"""
+	Description: Returns the pixels of a filled circle drawn with cv2.circle, relative to the circle center. Computed once for each radius. 
+	Note: Only filled circles. cv2 clips thick outlines (thickness > 1) differently at the image border, so stamped outlines wouldn't be pixel-identical there. 
+	Return
+	row_offsets, col_offsets: int arrays with the row/column offset of each pixel. 
+	"""
+	if radius not in _disc_kernels:
+		center = radius + 1
+		kernel_img = np.zeros((2*center+1, 2*center+1), dtype=np.uint8)
+		cv2.circle(kernel_img, center=(center, center), radius=radius, color=1, thickness=-1)
+		row_offsets, col_offsets = np.nonzero(kernel_img)
+		_disc_kernels[radius] = (row_offsets - center, col_offsets - center)
+
+	return _disc_kernels[radius]
+
+
+def labels_to_image(label_mask, color_list, output_image=None):
+	"""
+	Description: Colors a label mask (see rasterize_labels). Only needed to save the mask or to draw it on an image. 
+	Args
+	label_mask: uint8 array of size (height, width) with label+1 for each labeled pixel. 
+	color_list: The color of each label. 
+	output_image: The image the labels are drawn on (in place). If None, a new uint8 image (zeros for unlabeled pixels). 
+	Return
+	labeled_image: The image with the color of each labeled pixel. 
+	"""
+	color_lut = np.zeros((256, len(color_list[0])), dtype=np.uint8)
+	color_lut[1:len(color_list)+1] = color_list
 
-		# Obtain the color
-		class_metadata = particle_list[index][1]
-		pixel_label = metadata_to_label(class_metadata, segmentation_labels)
-		indicator_color = color_list[pixel_label] 
+	if output_image is None:
+		return color_lut[label_mask]
 
-		cv2.circle(input_image, center=centroid_cv2, radius=radius, color=indicator_color, thickness=-1) # Label pixels on overlay image
+	labeled_pixels = label_mask > 0
+	output_image[labeled_pixels] = color_lut[label_mask[labeled_pixels]]
 
-	return input_image
+	return output_image
 
 def get_image_name_from_coordinate_log(log_path):
 	"""
@@ -102,6 +192,62 @@ def split_data(input_dir, output_dir, move_proportion, in_order):
 			os.rename(source, destination)
 
 
+def split_shards(input_dir, output_dir, move_proportion, in_order):
+	"""
+	Shard version of split_data(). For each particle folder, move 'move_proportion' of the crops stored in shards to the particle folder in the output directory. 
+	Crops are moved into a shard with the same name in the output directory. Each input shard is re-written with the remaining crops. 
+	"""
+	# Imported here, since the callers only add ./urine_particles to sys.path after importing this module (create_segmentation_folder never adds it). 
+	import CropShard
+
+	input_subfolder_path_list = glob(input_dir + "*")
+
+	# Process each particle folder. 
+	for input_subfolder_path in input_subfolder_path_list:
+		# Identify subfolder name
+		subfolder_name = input_subfolder_path.split("/")[-1]
+		target_output_dir = output_dir + subfolder_name + "/"
+
+		# Create output folder (if needed)
+		if (not os.path.isdir(target_output_dir)): 
+			os.makedirs(target_output_dir)
+
+		shard_list = [CropShard.CropShard(shard_path) for shard_path in CropShard.get_shard_paths(input_subfolder_path + "/")]
+		crop_list = [(shard, index) for shard in shard_list for index in range(len(shard))]
+		if (in_order):
+			crop_list.sort(key=lambda crop: crop[0].index[crop[1]]["name"]) # Ensures that crops will be appropriately sorted. 
+		else: 
+			random.shuffle(crop_list)
+
+		count = len(crop_list)
+		val_count = int(math.ceil(count * move_proportion))
+
+		assert(count >= 2) # Need at least two crops in order to allow split into validation foler. 
+
+		# Select the crops to be moved from each shard (up to val_count)
+		move_dic = {shard.shard_path: set() for shard in shard_list}
+		for shard, index in crop_list[:val_count]:
+			move_dic[shard.shard_path].add(index)
+
+		# Re-write each shard as 1) the remaining crops and 2) the moved crops. 
+		for shard in shard_list:
+			move_indices = move_dic[shard.shard_path]
+			if not move_indices:
+				continue
+
+			shard_prefix = shard.shard_path[:-len(CropShard.shard_suffix)]
+			shard_filename_prefix = shard_prefix[shard_prefix.rfind("/")+1:]
+			keep_writer = CropShard.CropShardWriter(shard_prefix, crop_size=shard.crops.shape[1], channels=shard.crops.shape[3])
+			move_writer = CropShard.CropShardWriter(target_output_dir + shard_filename_prefix, crop_size=shard.crops.shape[1], channels=shard.crops.shape[3])
+
+			for index, metadata in enumerate(shard.index):
+				writer = move_writer if index in move_indices else keep_writer
+				writer.add_crop(np.array(shard.get_crop(index)), metadata["centroid"], metadata["canvas"], metadata["name"], label=metadata["label"])
+
+			move_writer.close()
+			keep_writer.close()
+
+
 def balance_classes_in_dir(input_dir):
 	input_subfolder_path_list = glob(input_dir + "*")
 
@@ -2,14 +2,11 @@
 import numpy as np
 import cv2
 from glob import glob
-import shutil
 import sys
 import os
-import random 
 import matplotlib.pyplot as plt
 from scipy import stats
 import math
-import itertools
 
 # import from local libraries
 sys.path.insert(0, './urine_particles')
@@ -21,6 +18,7 @@ Description: Processes many digiital urine samples through classification algo t
 Implementatinos Notes: 
 + Creating digital urine: When creating digital urine: 1) determine the expected particles per HPF (with decimals), 2) multiply by the total of HPFs and 3) round. This allows to give you a better estimate of the exact concentration of the urine. If we round prior to multiplying by HPFs, then you will only get a few discrete solution concentrations. 
 + Running out of particles: When creating a digital solution, if we run out of particles, we reuse particles again. The reason for this: 1) if we run out of particles, we will be so far above the threshold that it won't matter for the results of that specific particle (although it could matter for other particles), 2) different runs of the same repeat particles through the network will give different results, which will reduce variability (this is the whole point of using more than 1 HPF), 3) this is a rare occurence due to the particle distributions. 
++ Predictions: Each particle in validation_root_dir is classified a single time for each flip variant (the classifier flips the particles randomly, otherwise the predictions are deterministic). A digital urine sample is created by selecting from the predicted labels (with a random flip variant for each selected particle). So, the model is not re-run for each sample. 
 + Drawbacks of this method: 1) We do not include error from segmentation 2) we re-use particles across different digital samples, 3) etc 
 + Distribution Estimation: Since we don't let counts go to inf, we are not a perfect distribtion. However, our range is close enough (way over 95 percent of counts)
 
@@ -41,13 +39,14 @@ thresholds_device = {'10um': 5, 'other': 0, 'rbc': 4, 'wbc': 4}
 # Files/Folders
 input_dir_root = './urine_particles/data/clinical_experiment/image_data/20180225_digital_urine/digital_urine_0p2val/'  
 validation_root_dir = input_dir_root + 'validation/'
-experimental_root_dir = input_dir_root + 'experiment_folder/'
 
 
 class_mapping =  {0:'10um', 1:'other', 2:'rbc', 3:'wbc'}
 indicator_dict = {'rbc': 'red', 'wbc': 'black', '10um': 'blue', 'other': 'orange'} 
 total_HPF_per_solution = 3.0 # Number of HPFs taken to product a results. Global var (not pass through functions.)
 min_other_particles_per_HPF = 1 # The minimum number of other particles in each HPF. 
+# (flip_horizontal, flip_vertical) variants that the classifier applies randomly to each particle. 
+flip_variants = [(False, False), (True, False), (False, True), (True, True)]
 
 # Distributions are calculated in utility/particle_distributions.py
 urine_distributions = {
@@ -68,25 +67,51 @@ def main():
 	# Create CNN model and data model.
 	# WARNING: PICK THE CORRECT MODEL IN CNN_FUNCTIONS
 	model, data = CNN_functions.initialize_classification_model(log_dir=input_dir_root)
-	# Make sure batch_size in configuration correctly setup. 
-	if (data.config.batch_size != 1):
-		raise ValueError("In digital_urine_experiment, the batch_size needs to be 1. Please update configuration.")
+
+	# Classify each validation particle a single time. 
+	predicted_labels_dict = predict_validation_particles(model, data, validation_root_dir)
 
 	# Run entire digital urine experiment. 
-	reference_all_dict, results_all_dict = run_all_digital_urine_samples(model, data, class_mapping)
+	reference_all_dict, results_all_dict = run_all_digital_urine_samples(predicted_labels_dict, data, class_mapping)
 
 	# Create Figures
 	summarize_entire_urine_experiment(reference_all_dict, results_all_dict, data.config)
 
 
 
-def run_all_digital_urine_samples(model, data, class_mapping):
+def predict_validation_particles(model, data, source_folder):
+	"""
+	Description: Classifies each particle in source_folder under each of the 4 flip variants, a single time. 
+	Note: The classifier flips each particle randomly (see ClassifyParticlesData._transform_image). So, a sample draws one of the flip variants at random. 
+	Returns
+	predicted_labels_dict: dict that maps each class name (class folder in source_folder) to the predicted labels of the particles in that folder, of size (particles, flip variants). 
+	"""
+	label_list_per_flip = []
+	for flips in flip_variants:
+		pred_generator = data.create_prediction_iterator(pred_dir_path=source_folder, fixed_flips=flips)
+		all_pred, all_path_list = data.predict_particle_images(model=model, pred_generator=pred_generator)
+		label_list_per_flip.append(np.argmax(all_pred, axis=1))
+
+	# Group the predictions by class folder (the prediction iterator keeps the same order for each flip variant)
+	predicted_labels_dict = {}
+	for index, path in enumerate(all_path_list):
+		class_name = os.path.basename(os.path.dirname(path))
+		predicted_labels_dict.setdefault(class_name, []).append([label_list[index] for label_list in label_list_per_flip])
+
+	for class_name in predicted_labels_dict:
+		predicted_labels_dict[class_name] = np.array(predicted_labels_dict[class_name])
+		data.config.logger.info("Validation particles classified for %s: %d", class_name, len(predicted_labels_dict[class_name]))
+
+	return predicted_labels_dict
+
+
+def run_all_digital_urine_samples(predicted_labels_dict, data, class_mapping):
 	""" """
 	
 	reference_all_dict = {}
 	results_all_dict = {}
 	for i in range(total_solutions_to_run):
-		reference_dict, results_dict = run_single_digital_urine_sample(model, data, class_mapping)
+		reference_dict, results_dict = run_single_digital_urine_sample(predicted_labels_dict, data, class_mapping)
 
 		# Track overall results
 		for class_name in thresholds_ref: 
@@ -107,7 +132,7 @@ def run_all_digital_urine_samples(model, data, class_mapping):
 	return reference_all_dict, results_all_dict
 
 
-def run_single_digital_urine_sample(model, data, class_mapping):
+def run_single_digital_urine_sample(predicted_labels_dict, data, class_mapping):
 
 	global sample_count
 	sample_count += 1 
@@ -115,9 +140,7 @@ def run_single_digital_urine_sample(model, data, class_mapping):
 
 	sample_reference_dict = create_digital_urine_reference(validation_root_dir, class_mapping, urine_distributions)
 
-	create_digital_urine(validation_root_dir, experimental_root_dir, sample_reference_dict)
-
-	results_labels = process_digital_urine(model, data, experimental_root_dir)
+	results_labels = create_digital_urine_labels(predicted_labels_dict, sample_reference_dict)
 
 	sample_results_dict = calculate_digital_urine_results(sample_reference_dict, results_labels, class_mapping, data.config)
 
@@ -157,21 +180,21 @@ def create_digital_urine_reference(source_folder, class_mapping, urine_distribut
 
 
 
-def create_digital_urine(source_folder, target_folder, sample_reference_dict):
-	"""Creates a sample of digital urine by linking select files from source_folder into target_folder."""
-
-	# Creates target folder (if folder doesn't already exist)
-	if (os.path.isdir(target_folder)): 
-		shutil.rmtree(target_folder)
-	os.makedirs(target_folder + 'images/')
-
-	# Creates digital urine. 
+def create_digital_urine_labels(predicted_labels_dict, sample_reference_dict):
+	"""
+	Description: Creates a sample of digital urine by selecting particles from each class, and returns the predicted labels of the selected particles. 
+	Particles are selected in a random order. If a class runs out of particles, the particles are reused in the same order. 
+	Args
+	predicted_labels_dict: The predicted labels of the validation particles of each class (see predict_validation_particles). 
+	sample_reference_dict: dict that maps each class name to the number of particles in the sample. 
+	"""
+	results_labels = []
 	for urine_class, num_particles in sample_reference_dict.iteritems():
 
-		particle_files = glob(source_folder + urine_class + '/*.bmp')
-		random.shuffle(particle_files) # To ensure digital urine is not made through a pre-determined pattern. 
-		count_of_particles_in_class = len(particle_files)
-		particle_files_iterator = itertools.cycle(particle_files)
+		class_labels = predicted_labels_dict.get(urine_class, np.zeros((0, len(flip_variants)), dtype=int))
+		count_of_particles_in_class = len(class_labels)
+		if (num_particles > 0) and (count_of_particles_in_class == 0):
+			raise ValueError("create_digital_urine_labels: No validation particles for class %s." % urine_class)
 
 		# Flag if the scaled_count is above count of particles in the reference class. 
 		if num_particles > count_of_particles_in_class:
@@ -180,32 +203,14 @@ def create_digital_urine(source_folder, target_folder, sample_reference_dict):
 			print "Selected Particles: %0.2f"%num_particles
 			print "Particles Available: %0.2f"%count_of_particles_in_class
 
-		for index in range(num_particles): 
-			particle_file = next(particle_files_iterator)
-			split_index =  particle_file.rfind('/') + 1
-			target_filename = str(index) + particle_file[split_index:]
-			os.link(particle_file, target_folder + 'images/' + target_filename)
-
-		
-def process_digital_urine(model, data, target_folder, ):
-	"""  """
-
-	# Create necessary data generator
-	pred_generator = data.create_custom_prediction_generator(pred_dir_path=target_folder)
-
-
-	# Predict: Sort images in classes target_folder into classes
-	total_cropped_images = len(glob(target_folder + "images/*.bmp"))
-	all_pred, all_path_list = data.predict_particle_images(
-		model=model, 
-		pred_generator=pred_generator, 
-		total_batches=total_cropped_images) 
-
-
-	# Get counts for each of the particle labels
-	label_list = np.argmax(all_pred, axis=1)
+		# Random order of the particles, repeated if the class runs out of particles. 
+		# To ensure digital urine is not made through a pre-determined pattern. 
+		particle_indices = np.resize(np.random.permutation(count_of_particles_in_class), num_particles)
+		# Each selected particle is classified under a random flip variant (same as the random flips of the classifier). 
+		flip_indices = np.random.randint(len(flip_variants), size=num_particles)
+		results_labels.extend(class_labels[particle_indices, flip_indices])
 
-	return label_list
+	return results_labels
 
 
 def calculate_digital_urine_results(reference_dict, results_labels, class_mapping, config):
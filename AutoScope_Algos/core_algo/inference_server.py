@@ -0,0 +1,335 @@
+# Import basic libraries
+import os
+import time
+import json
+import argparse
+import threading
+import traceback
+import Queue
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+
+# import from local libraries
+import CNN_functions
+import process_urine_segment as segment
+import process_urine_end_to_end as end_to_end
+
+"""
+Description: Long-lived local server that keeps the segmentation and classification models loaded.
+Removes the model build + weight loading time (tens of seconds) from each run.
+
+Execution Notes:
++ Start: python inference_server.py --port 8890 --log_folder ./inference_server_log/
++ POST /process: Segments and classifies a single canvas image. Returns the classified particles as JSON.
+++ Canvas path: Content-Type 'application/json' with body {"image_path": "<path to canvas>"} (path on the server machine)
+++ Raw bytes: Any other Content-Type, with the encoded image (e.g. the .bmp file) as the body
+++ Example: curl --data-binary @img1.bmp -H "Content-Type: application/octet-stream" http://127.0.0.1:8890/process
++ GET /health: {"status": "loading"} (status code 503) while the models are loaded, then {"status": "ready"}
++ GET /metrics: Request/batch counters and latencies.
++ Only binds to localhost.
+
+Implementation Notes:
++ The models are built and used by a single batching thread (the Keras/Tensorflow graph is not shared across threads).
++ Each client connection is handled by its own thread. The canvas is decoded in the client thread. So, decoding runs in parallel with the model.
++ Requests from concurrent clients are batched: The batching thread waits up to max_batch_wait seconds to fill a batch of segmentation_batch_size canvas images.
++ The crops of all the canvas images in a batch are classified together.
++ The segmentation/classification settings are configured in process_urine_segment.py and process_urine_end_to_end.py
+"""
+
+""" Configuration """
+server_host = "127.0.0.1"
+server_port = 8890
+# Folder for the model logs
+log_folder = "./inference_server_log/"
+# Maximum time (in seconds) the first request of a batch waits for other requests
+max_batch_wait = 0.05
+# Maximum time (in seconds) a client waits for the result of a request
+request_timeout = 600
+
+
+
+def main():
+
+	# Get server configuration from user
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-p","--port", help="Port of the server (on localhost)", type=int, default=server_port)
+	parser.add_argument("-l","--log_folder", help="Folder for the model logs", type=str, default=log_folder)
+	args = parser.parse_args()
+
+	if (not os.path.isdir(args.log_folder)):
+		os.makedirs(args.log_folder)
+
+	# Load the models on the batching thread
+	batcher = InferenceBatcher(args.log_folder)
+	batcher.start()
+
+	server = InferenceServer((server_host, args.port), InferenceRequestHandler)
+	server.batcher = batcher
+	print "Inference server listening on http://%s:%d" % (server_host, args.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+
+class InferenceRequest(object):
+	"""
+	Description: A single canvas image waiting to be processed by the InferenceBatcher.
+	"""
+
+	def __init__(self, original_img, img_input, image_path=None):
+		self.original_img = original_img
+		self.img_input = img_input
+		self.image_path = image_path
+		self.submit_time = time.time()
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+
+class InferenceBatcher(threading.Thread):
+	"""
+	Description: Owns the models. Collects the requests of all clients into batches, and segments + classifies each batch.
+	"""
+
+	def __init__(self, log_dir):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.log_dir = log_dir
+		self.queue = Queue.Queue()
+		self.ready = threading.Event()
+		self.load_error = None
+
+		# Metrics
+		self.metrics_lock = threading.Lock()
+		self.start_time = time.time()
+		self.load_time = None
+		self.requests_total = 0
+		self.errors_total = 0
+		self.batches_total = 0
+		self.particles_total = 0
+		self.latency_total = 0.0
+		self.latency_max = 0.0
+		self.model_time_total = 0.0
+
+
+	def run(self):
+		try:
+			self.seg_model, self.seg_data = segment.initialize_segmentation_model(log_dir=self.log_dir, log_prefix="server_")
+			self.class_model, self.class_data = CNN_functions.initialize_classification_model(log_dir=self.log_dir)
+			self.batch_size = segment.get_segmentation_batch_size(self.seg_data)
+		except Exception:
+			self.load_error = traceback.format_exc()
+			self.ready.set()
+			raise
+
+		self.load_time = time.time() - self.start_time
+		self.seg_data.config.logger.info("Inference server: Models loaded in %0.1f seconds", self.load_time)
+		self.ready.set()
+
+		while True:
+			request_list = self._get_batch_of_requests()
+			self._process_batch(request_list)
+
+
+	def submit(self, original_img, img_input, image_path=None):
+		"""
+		Description: Queues a decoded canvas image, and blocks until it is processed. Returns the classified particles.
+		"""
+		request = InferenceRequest(original_img, img_input, image_path)
+		self.queue.put(request)
+
+		if not request.done.wait(request_timeout):
+			raise RuntimeError("InferenceBatcher: Request timed out.")
+		if request.error is not None:
+			raise RuntimeError(request.error)
+
+		return request.result
+
+
+	def is_ready(self):
+		return self.ready.is_set() and (self.load_error is None)
+
+
+	def get_metrics(self):
+		with self.metrics_lock:
+			return {
+				"status": "ready" if self.is_ready() else "loading",
+				"uptime_seconds": time.time() - self.start_time,
+				"model_load_seconds": self.load_time,
+				"requests_total": self.requests_total,
+				"errors_total": self.errors_total,
+				"batches_total": self.batches_total,
+				"canvases_per_batch": self.requests_total/float(max(1, self.batches_total)),
+				"particles_total": self.particles_total,
+				"latency_mean_seconds": self.latency_total/float(max(1, self.requests_total)),
+				"latency_max_seconds": self.latency_max,
+				"model_seconds_total": self.model_time_total,
+				"queue_size": self.queue.qsize()}
+
+
+	def _get_batch_of_requests(self):
+		"""
+		Description: Blocks until a request arrives. Then, waits up to max_batch_wait for more requests (up to batch_size).
+		"""
+		request_list = [self.queue.get()]
+
+		deadline = time.time() + max_batch_wait
+		while len(request_list) < self.batch_size:
+			remaining_time = deadline - time.time()
+			if remaining_time <= 0:
+				break
+			try:
+				request_list.append(self.queue.get(timeout=remaining_time))
+			except Queue.Empty:
+				break
+
+		return request_list
+
+
+	def _process_batch(self, request_list):
+		"""
+		Description: Segments a batch of canvas images, and classifies the crops of all canvas images together.
+		"""
+		model_start_time = time.time()
+		try:
+			# Predict segmentation for the batch (the prediction cache is only used if all canvas images are given by path)
+			image_path_list = [request.image_path for request in request_list]
+			if None in image_path_list:
+				image_path_list = None
+			pred_array_list = self.seg_data.predict_input_batch(self.seg_model, [request.img_input for request in request_list], image_path_list=image_path_list)
+
+			# Crop the particles of all canvas images
+			all_crop_list = []
+			all_centroid_list = []
+			crop_count_list = []
+			for batch_index, request in enumerate(request_list):
+				centroid_list, _ = segment.get_centroids_from_prediction(self.seg_data, pred_array_list[batch_index])
+				crop_list, crop_centroid_list, _ = segment.get_crops_from_centroids(request.original_img, centroid_list)
+				all_crop_list.extend(crop_list)
+				all_centroid_list.extend(crop_centroid_list)
+				crop_count_list.append(len(crop_list))
+
+			# Classify all the crops together, and split the results per canvas image
+			label_pred = end_to_end.classify_crops(self.class_model, self.class_data, all_crop_list, all_centroid_list)
+			crop_start = 0
+			for request, crop_count in zip(request_list, crop_count_list):
+				crop_end = crop_start + crop_count
+				request.result = get_particle_list(all_centroid_list[crop_start:crop_end], label_pred[crop_start:crop_end])
+				crop_start = crop_end
+
+		except Exception:
+			error = traceback.format_exc()
+			self.seg_data.config.logger.error("Inference server: Failed to process batch.\n%s", error)
+			for request in request_list:
+				request.error = error
+
+		# Update the metrics, and release the clients
+		end_time = time.time()
+		with self.metrics_lock:
+			self.batches_total += 1
+			self.model_time_total += end_time - model_start_time
+			for request in request_list:
+				latency = end_time - request.submit_time
+				self.requests_total += 1
+				self.errors_total += int(request.error is not None)
+				self.particles_total += 0 if request.result is None else len(request.result)
+				self.latency_total += latency
+				self.latency_max = max(self.latency_max, latency)
+
+		for request in request_list:
+			request.done.set()
+
+
+
+def get_particle_list(centroid_list, label_pred):
+	"""
+	Description: Builds the JSON output for the classified particles of a single canvas image.
+	"""
+	particle_list = []
+	for centroid, particle_pred in zip(centroid_list, label_pred):
+		label = int(np.argmax(particle_pred))
+		particle_list.append({
+			"center": [int(centroid[0]), int(centroid[1])],
+			"label": label,
+			"class_name": end_to_end.class_mapping[label],
+			"confidence": float(particle_pred[label])})
+
+	return particle_list
+
+
+
+class InferenceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	""" HTTP server that handles each client connection on its own thread. """
+	daemon_threads = True
+	batcher = None
+
+
+
+class InferenceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		batcher = self.server.batcher
+
+		if (self.path == "/health"):
+			status = "ready" if batcher.is_ready() else ("failed" if batcher.load_error else "loading")
+			self._send_json(200 if batcher.is_ready() else 503, {"status": status})
+		elif (self.path == "/metrics"):
+			self._send_json(200, batcher.get_metrics())
+		else:
+			self._send_json(404, {"error": "Unknown endpoint: %s" % self.path})
+
+
+	def do_POST(self):
+		batcher = self.server.batcher
+
+		if (self.path != "/process"):
+			self._send_json(404, {"error": "Unknown endpoint: %s" % self.path})
+			return
+
+		batcher.ready.wait()
+		if not batcher.is_ready():
+			self._send_json(503, {"error": "Models failed to load."})
+			return
+
+		# Decode the canvas image (on the client thread)
+		content_length = int(self.headers.getheader('Content-Length', 0))
+		body = self.rfile.read(content_length)
+		target_size = batcher.seg_data.config.target_size
+		image_path = None
+		try:
+			if self.headers.getheader('Content-Type', '').startswith('application/json'):
+				image_path = json.loads(body)["image_path"]
+				original_img, img_input = batcher.seg_data.load_canvas(image_path, new_size=target_size)
+			else:
+				original_img, img_input = batcher.seg_data.decode_canvas(body, new_size=target_size)
+		except (IOError, ValueError, KeyError) as e:
+			self._send_json(400, {"error": "Invalid canvas image: %s" % str(e)})
+			return
+
+		try:
+			particle_list = batcher.submit(original_img, img_input, image_path)
+		except RuntimeError as e:
+			self._send_json(500, {"error": str(e)})
+			return
+
+		self._send_json(200, {"image_path": image_path, "particle_list": particle_list})
+
+
+	def _send_json(self, status_code, output):
+		body = json.dumps(output)
+		self.send_response(status_code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+
+if __name__ == "__main__":
+	main()
@@ -8,12 +8,14 @@ from datetime import datetime
 import re
 import argparse
 import json
+import collections
 
 #Import keras libraries
 from tensorflow.python.keras.utils import plot_model
 
 # import from local libraries
 import CNN_functions
+import CropShard
 
 """
 Description: Given a setup of croped particles, classify particles. Provide statistics on predictions. 
@@ -77,23 +79,13 @@ def main():
 
 
 		# Create necessary data generator
-		pred_generator = data.create_custom_prediction_generator(pred_dir_path=image_data_path)
-
-		# Calculate number of batches to run. 
-		# When round number of batches DOWN: 
-		# + Drawback: Certain segmented particles will not be classified. So, results/vizualizations will  not include these.
-		# When round number of batches UP: 
-		# + Will label all segmented particles. However 1) will have duplicates in labeling (should be fine) and 2) duplicate in statistics.
-		# Note: With either approach, the statistics will be randomly biased. With round UP will have all particles included on output images.
-		total_cropped_images = len(glob(image_data_path + "images/*.bmp"))
-		num_batches = int(math.ceil(total_cropped_images/float(data.config.batch_size)))
-		data.config.logger.info("Images classified twice: %d", num_batches*data.config.batch_size-total_cropped_images)
+		# Each crop is classified exactly once (the last batch is padded, and the padding is dropped from the predictions). 
+		pred_generator = data.create_prediction_iterator(pred_dir_path=image_data_path)
 
 		# Predict: Sort crops into classes
 		all_pred, all_path_list = data.predict_particle_images(
 			model=model, 
-			pred_generator=pred_generator, 
-			total_batches=num_batches) 
+			pred_generator=pred_generator) 
 
 		# Print out results for single folder
 		label_list = np.argmax(all_pred, axis=1)
@@ -110,19 +102,10 @@ def main():
 		if (split_crops_into_class_folders_flag):
 			split_batch_into_class_folders(all_pred, all_path_list, sorted_output_path, class_mapping)
 
-		
-		original_img_dic, data_json = label_canvas_based_on_crop_filename(label_list, all_path_list, root_folder, data.config.colors)
-
 
+		# Label the canvas images, and save the labeled images + json to log (one canvas in memory at a time)
 		prefix_rootdir = root_folder.split('/')[-2]
-		# Save json to log
-		json_path =  debug_output_path + prefix_rootdir +  "_data.json"
-		with open(json_path, 'w') as outfile:
-    			json.dump(data_json, outfile)
-
-		# Save the labeled iamges
-		for img_name in original_img_dic:
-			cv2.imwrite(debug_output_path + prefix_rootdir + "_" + img_name + "_labeled_from_crops.jpg", original_img_dic[img_name])
+		label_canvas_based_on_crop_filename(label_list, all_path_list, root_folder, data.config.colors, output_path_prefix = debug_output_path + prefix_rootdir)
 
 
 	# Print out results for all folders in input_folders
@@ -136,62 +119,90 @@ def main():
 		image_count = total_input_images)
 
 
-def label_canvas_based_on_crop_filename(label_list, all_path_list, root_folder, label_colors):
+def label_canvas_based_on_crop_filename(label_list, all_path_list, root_folder, label_colors, output_path_prefix):
 	"""
 	Description: Label predicted particles on canvas image (original image).
 	Use information in the cropped particles path to 1) determine centroid and 2) determine which original image to label. 
+	Streaming: Each canvas is loaded, labeled, saved and released before the next canvas is loaded. The json is written one canvas at a time. 
+	So, only a single canvas is kept in memory (regardless of the number of canvas images). 
 	Args
 	label_list: List of labels. Labels are in same order as paths in all_path_list
-	all_path_list: List of paths, including filename of the crops
+	all_path_list: List of paths, including filename of the crops (or CropShard.ShardCrop references)
 	root_folder: The folder containing the original images. 
 	label_colors: RGB colors of size nclasses. 
+	output_path_prefix: Prefix of the output files. Saves <output_path_prefix>_<canvas>_labeled_from_crops.jpg for each canvas and <output_path_prefix>_data.json 
 	Return 
-	original_img_dic: Dictionary that maps the base name (no extension) of the original image to the labeled original image
+	canvas_count: The number of labeled canvas images
 	"""
-	original_img_dic = {}
-	data_json = {}
-	for index_path, crop_path in enumerate(all_path_list): 
+	particles_per_canvas = group_crops_by_canvas(label_list, all_path_list)
 
-		# Identify crop_path file name
-		crop_filename = crop_path[crop_path.rfind('/')+1:]
+	# The json maps the base name (no extension) of the original image to the meta-data of its classified particles. 
+	with open(output_path_prefix + "_data.json", 'w') as json_file:
+		json_file.write("{")
 
-		# Identify original image name
-		original_img_name = crop_filename[:crop_filename.find('_')]
-		
+		for index_canvas, (original_img_name, particle_list) in enumerate(particles_per_canvas.iteritems()):
 
-		# Get reference to original image: either load it (and store in dic for future reference) 
-		# Or get referene from original_img_dic
-		if original_img_name in original_img_dic:
-			original_img = original_img_dic[original_img_name]
-		else:
-			# Load the original image, and store it in dictionary
+			# Load the original image
 			original_img_path = root_folder + original_img_name + ".bmp"
 			original_img = cv2.imread(original_img_path)
-			original_img_dic[original_img_name] = original_img
-			data_json[original_img_name] = [] 
 
+			# Place indicator for each classified particle. 
+			canvas_json = [label_particle_on_canvas(original_img, circle_centroid, label, label_colors) for circle_centroid, label in particle_list]
+
+			# Save the labeled image, and release it
+			cv2.imwrite(output_path_prefix + "_" + original_img_name + "_labeled_from_crops.jpg", original_img)
+			del original_img
+
+			# Update the meta-data for the classified particles
+			if (index_canvas > 0):
+				json_file.write(", ")
+			json_file.write(json.dumps(original_img_name) + ": " + json.dumps(canvas_json))
+			json_file.flush()
+
+		json_file.write("}")
+
+	return len(particles_per_canvas)
+
+
+def group_crops_by_canvas(label_list, all_path_list):
+	"""
+	Description: Groups the classified particles by the canvas (original image) they were cropped from. 
+	Return 
+	particles_per_canvas: OrderedDict that maps the base name (no extension) of the original image to a list of (circle_centroid, label) of its particles. 
+	Canvases (and particles) are in the order of all_path_list. 
+	"""
+	particles_per_canvas = collections.OrderedDict()
+	for index_path, crop_path in enumerate(all_path_list): 
+
+		# Identify crop_path file name
+		crop_filename = CropShard.get_crop_name(crop_path)
+
+		# Identify original image name
+		original_img_name = crop_filename[:crop_filename.find('_')]
 
 		# Identify particle centroid from crop image name
-		# Coordinate_metrics includes 3 lists, including coordinate_pos, delta_pos, angular_pos. 
 		coordinate_metrics = CNN_functions.get_coordinates_from_cropname(crop_filename)
 		circle_centroid = (int(coordinate_metrics[0]), int(coordinate_metrics[1])) # turn into tuple with (width, height)
 
+		particles_per_canvas.setdefault(original_img_name, []).append((circle_centroid, label_list[index_path]))
+
+	return particles_per_canvas
 
-		# Place indicator for each classified particle. 
-		label = label_list[index_path]
-		
-		# Update the meta-data dictionary for the classified particles
-                data_json[original_img_name].append({"center":circle_centroid, "label": label, "color":label_colors[label]})
-		
-		cv2.circle(
-			original_img, 
-			center=circle_centroid, 
-			radius=indicator_radius, 
-			color=label_colors[label], 
-			thickness=3)
 
+def label_particle_on_canvas(original_img, circle_centroid, label, label_colors):
+	"""
+	Description: Place indicator for a single classified particle on the canvas image (original_img is labeled in place). 
+	Return
+	The meta-data dictionary for the classified particle
+	"""
+	cv2.circle(
+		original_img, 
+		center=circle_centroid, 
+		radius=indicator_radius, 
+		color=label_colors[label], 
+		thickness=3)
 
-	return original_img_dic, data_json
+	return {"center":circle_centroid, "label": label, "color":label_colors[label]}
 
 
 
@@ -202,8 +213,9 @@ def split_batch_into_class_folders(label_pred, path_list, output_dir, labels_to_
 	Description: Takes a batch of images with correspoinding categorigcal/softmax predictions. Uses output_dir and labels_to_class to store outputs. 
 	output_dir: Directory into which predicted images will be saved. 
 	labels_to_class: Dictionary structure that has labels as keys to the class names. 
-	Note: Create a permenant link. to corresponding image. 
+	Note: Create a permenant link. to corresponding image. Crops stored in shards are written as .bmp files. 
 	"""
+	crop_shards = {}
 
 	# Setup output directory		
 	build_sorted_output_folder(output_dir, labels_to_class)
@@ -213,7 +225,13 @@ def split_batch_into_class_folders(label_pred, path_list, output_dir, labels_to_
 		datestring = datetime.strftime(datetime.now(), '%Y%m%d_%H-%M-%S-%f')
 		file_name = str("%0.04fconfidence_%s"%(label_pred[index][label], datestring))
 		img_save_path = output_dir + labels_to_class[label] + "/" + file_name + ".bmp"
-		os.link(path_list[index], img_save_path)
+		crop_ref = path_list[index]
+		if isinstance(crop_ref, CropShard.ShardCrop):
+			if crop_ref.shard_path not in crop_shards:
+				crop_shards[crop_ref.shard_path] = CropShard.CropShard(crop_ref.shard_path)
+			cv2.imwrite(img_save_path, crop_shards[crop_ref.shard_path].get_crop(crop_ref.index))
+		else:
+			os.link(crop_ref, img_save_path)
 
 
 
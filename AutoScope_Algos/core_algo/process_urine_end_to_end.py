@@ -0,0 +1,182 @@
+# Import basic libraries
+import numpy as np
+import cv2
+import json
+import collections
+
+# import from local libraries
+import CNN_functions
+from CanvasPrefetcher import CanvasPrefetcher
+import process_urine_segment as segment
+import process_urine_classify as classify
+
+"""
+Description: Segments the canvas images and classifies the segmented particles in a single pipeline.
+Replaces running process_urine_segment.py (in 'crops' mode) followed by process_urine_classify.py.
+
+Execution Notes:
++ The crops are passed from the segmentation model to the classification model in memory. The crops are not written to disk, re-loaded or re-decoded.
++ The position features are calculated directly from the centroids (instead of being parsed from the crop filenames).
++ Saving the crops to disk is an optional debug sink (see save_crops_flag).
++ The segmentation settings (e.g. output_crop_size, keep_boundary_particles, segmentation_batch_size, crop_output_format) are configured in process_urine_segment.py
+"""
+
+""" Configuration """
+# Folder that contains the canvas files to be processed
+root_folder = "./urine_particles/data/clinical_experiment/prediction_folder/sol1/"
+# If True, auto selectes all '.bmp' images in root folder.
+auto_determine_inputs = True
+
+# Files/Folders
+# Name of files to be processed.
+input_files = ["img1.bmp", "img2.bmp", "img3.bmp", "img4.bmp", "img5.bmp", "img6.bmp", "img7.bmp"]
+# Name of the output folder (placed in the root folder)
+output_folders = ["img1_e2e/", "img2_e2e/",  "img3_e2e/", "img4_e2e/", "img5_e2e/", "img6_e2e/", "img7_e2e/"]
+
+class_mapping =  {0:'10um', 1:'other', 2:'rbc', 3:'wbc'}
+discard_label = 1
+# Number of crops classified in a single model call.
+classification_batch_size = 64
+
+# Flags
+debug_flag = True
+# If True, the crops are also saved to disk (same output as process_urine_segment.py in 'crops' mode).
+save_crops_flag = False
+
+
+# Classification results for a single canvas image.
+# centroid_list: The centroid of each classified particle, in (width, height) format. label_pred: The categorical prediction for each particle.
+ClassifiedCanvas = collections.namedtuple('ClassifiedCanvas', ['index', 'image_path', 'centroid_list', 'label_pred'])
+
+
+
+def main():
+
+	# Determine files to be processed automatically.
+	if (auto_determine_inputs):
+		global root_folder, input_files, output_folders
+		root_folder, input_files, output_folders = segment.auto_determine_segmentation_config_parameters(output_folder_suffix="e2e")
+
+	# Clean up disk from previous sessions
+	segment.clean_up_old_output_folders(root_folder, output_folders)
+
+	# Builds the segmentation and classification models
+	seg_model, seg_data = segment.initialize_segmentation_model(log_dir=root_folder, log_prefix="end_to_end_")
+	class_model, class_data = CNN_functions.initialize_classification_model(log_dir=root_folder)
+
+	# Print Configuration
+	class_data.config.logger.info("End-to-End Prediction Results")
+	class_data.config.logger.info(root_folder)
+	class_data.config.logger.info(input_files)
+	class_data.config.logger.info(output_folders)
+
+
+	image_path_list = [root_folder + target_file for target_file in input_files]
+	output_folder_paths = [root_folder + target_folder for target_folder in output_folders]
+
+	all_label_list = []
+	for classified_canvas in classify_particles_in_canvases(seg_model, seg_data, class_model, class_data, image_path_list, output_folder_paths):
+
+		# Print out results for single canvas
+		label_list = np.argmax(classified_canvas.label_pred, axis=1)
+		all_label_list.extend(label_list)
+		class_data.config.logger.info("Results for: %s", classified_canvas.image_path)
+		if len(label_list) > 0:
+			CNN_functions.print_summary_statistics_for_labels(label_list, class_mapping, class_data.config, discard_label=discard_label, image_count=1)
+
+
+	# Print out results for all canvas images
+	class_data.config.logger.info("Final Results Summary: %s", root_folder)
+	CNN_functions.print_summary_statistics_for_labels(all_label_list, class_mapping, class_data.config, discard_label=discard_label, image_count=len(input_files))
+
+
+
+def classify_particles_in_canvases(seg_model, seg_data, class_model, class_data, image_path_list, output_folder_paths=None):
+	"""
+	Description: Segments each canvas image and classifies the segmented particles. Yields the results one canvas at a time (in the order of image_path_list).
+	Args
+	image_path_list: The paths to the canvas images.
+	output_folder_paths: The output folder of each canvas image (for the debug outputs + saved crops). If None, nothing is saved to disk.
+	Yields
+	ClassifiedCanvas for each canvas image.
+	"""
+	batch_size = segment.get_segmentation_batch_size(seg_data)
+	prefetch_count = max(segment.prefetch_canvas_count, batch_size)
+	prefetcher = CanvasPrefetcher(seg_data, image_path_list, prefetch_count=prefetch_count, num_workers=segment.decode_workers)
+	for canvas_batch in prefetcher.iter_batches(batch_size):
+
+		# Predict segmentation for a batch of canvas images
+		pred_array_list = seg_data.predict_input_batch(seg_model, [canvas.img_input for canvas in canvas_batch], image_path_list=[canvas.image_path for canvas in canvas_batch])
+
+		for batch_index, canvas in enumerate(canvas_batch):
+
+			# Crop the particles found by the segmentation model
+			centroid_list, pred_image = segment.get_centroids_from_prediction(seg_data, pred_array_list[batch_index])
+			crop_list, crop_centroid_list, _ = segment.get_crops_from_centroids(canvas.original_img, centroid_list)
+
+			# Classify the crops
+			label_pred = classify_crops(class_model, class_data, crop_list, crop_centroid_list)
+
+			# Save outputs
+			if output_folder_paths is not None:
+				output_folder_path = output_folder_paths[canvas.index]
+				output_file_prefix = CNN_functions.get_file_name_from_path(canvas.image_path, remove_ext=True)
+				segment.build_segmentation_output_folder(output_folder_path)
+
+				if (save_crops_flag):
+					segment.save_crops(crop_list, crop_centroid_list, output_folder_path, output_file_prefix)
+
+				if (debug_flag):
+					output_debug_path_prefix = output_folder_path + "debug_output/" + output_file_prefix
+					segment.save_centroid_debug_output(seg_data, pred_image, centroid_list, output_debug_path_prefix)
+					save_labeled_canvas(canvas.original_img, crop_centroid_list, label_pred, class_data.config.colors, output_debug_path_prefix)
+
+			yield ClassifiedCanvas(canvas.index, canvas.image_path, np.asarray(crop_centroid_list), label_pred)
+
+	prefetcher.log_throughput(seg_data.config.logger)
+	seg_data.log_prefilter_statistics(seg_data.config.logger)
+
+
+
+def classify_crops(model, data, crop_list, centroid_list):
+	"""
+	Description: Classifies crops that are in memory.
+	Args
+	crop_list: List of crops (BGR format, as produced by cv2).
+	centroid_list: The centroid of each crop on the canvas, in (width, height) format.
+	Return
+	label_pred: The categorical prediction for each crop, of size (crops, nclasses).
+	"""
+	if len(crop_list) == 0:
+		return np.zeros((0, data.config.nclasses), dtype=np.float32)
+
+	label_pred_list = []
+	for batch_start in range(0, len(crop_list), classification_batch_size):
+		batch_end = batch_start + classification_batch_size
+		x_inputs = data.create_inputs_from_crops(crop_list[batch_start:batch_end], centroid_list[batch_start:batch_end])
+		label_pred_list.append(model.predict_on_batch(x_inputs))
+
+	return np.concatenate(label_pred_list, axis=0)
+
+
+
+def save_labeled_canvas(original_img, centroid_list, label_pred, label_colors, output_debug_path_prefix):
+	"""
+	Description: Labels each classified particle on the canvas image (original_img is labeled in place). Saves the labeled canvas and the particle meta-data.
+	"""
+	label_list = np.argmax(label_pred, axis=1)
+
+	particle_list = []
+	for index, centroid in enumerate(centroid_list):
+		circle_centroid = (int(centroid[0]), int(centroid[1]))
+		particle_list.append(classify.label_particle_on_canvas(original_img, circle_centroid, int(label_list[index]), label_colors))
+
+	cv2.imwrite(output_debug_path_prefix + "_labeled_from_crops.jpg", original_img)
+
+	with open(output_debug_path_prefix + "_data.json", 'w') as outfile:
+		json.dump({"particle_list": particle_list}, outfile)
+
+
+
+if __name__ == "__main__":
+	main()
@@ -21,7 +21,11 @@ from tensorflow.python.keras.utils import plot_model
 from SegmentParticlesData import SegmentParticlesData
 import CNN_functions
 from segmentation_models import FCN8_32px_factor as createModel
+from segmentation_models import FCN8_compact_output
 from SegmentParticles_config import SegmentParticles_Config
+from CanvasPrefetcher import CanvasPrefetcher
+from PostprocessPool import PostprocessPool
+import CropShard
 
 """
 Description: 
@@ -56,6 +60,16 @@ discard_label = 0
 # The output size of the crops, measured in pixels. Used on the original image. 
 output_crop_size = 64 
 indicator_radius = 32
+# Select 'bmp' to save each crop as a .bmp file (data/images/). Select 'shard' to save all crops of a canvas in a single CropShard (data/shards/). 
+crop_output_format = 'bmp'
+# Number of canvas images predicted in a single model call. If None, determined from the available memory. 
+segmentation_batch_size = None
+# Number of canvas images decoded ahead of the model on background threads (and the number of decoding threads). 
+prefetch_canvas_count = 2
+decode_workers = 2
+# Number of worker processes that post-process the predictions (while the model predicts the next canvas images). If 0, post-processed in the main process. 
+# Note: The predictions are converted to uint8 label matrices before they are sent to the workers. 
+postprocess_workers = 2
 
 # Flags
 debug_flag = True
@@ -100,17 +114,7 @@ def process_inputImages_in_crops_mode(model, data,  root_folder, input_files, ou
 	"""
 	Description: Process all images by generating crops around the predicted particle location (predicted through segmentation)
 	"""
-	for file_index, target_file in enumerate(input_files):
-
-		# Define files/folders
-		target_file_path = root_folder + target_file
-		output_folder_path = root_folder + output_folders[file_index]
-
-		# Build output folders (if necessary)
-		build_segmentation_output_folder(output_folder_path)
-
-		# Produce crops 
-		generate_crops_from_inputImage(model, data, target_file_path, output_folder_path)
+	segment_inputImages(model, data, root_folder, input_files, output_folders, 'crops')
 
 
 def process_inputImages_in_semantic_mode(model, data,  root_folder, input_files, output_folders):
@@ -119,17 +123,7 @@ def process_inputImages_in_semantic_mode(model, data,  root_folder, input_files,
 	Print out average results across all images to log. 
 	"""
 	all_labels_list = []
-	for file_index, target_file in enumerate(input_files):
-
-		# Define files/folders
-		target_file_path = root_folder + target_file
-		output_folder_path = root_folder + output_folders[file_index]
-
-		# Build output folders (if necessary)
-		build_segmentation_output_folder(output_folder_path)
-
-		# Produce labels from semantic segmentation of a single canvas image
-		label_list = generate_particlePredictions_from_inputImage(model, data, target_file_path, output_folder_path)
+	for label_list in segment_inputImages(model, data, root_folder, input_files, output_folders, 'semantic'):
 		all_labels_list.extend(label_list)
 
 	canvas_img_cnt = len(input_files)
@@ -137,24 +131,88 @@ def process_inputImages_in_semantic_mode(model, data,  root_folder, input_files,
 	CNN_functions.print_summary_statistics_for_labels(all_labels_list, class_mapping, data.config, discard_label=discard_label, image_count=canvas_img_cnt)
 
 
+def segment_inputImages(model, data,  root_folder, input_files, output_folders, mode):
+	"""
+	Description: Predicts the segmentation of all images, and post-processes each canvas image in either 'crops' or 'semantic' mode. 
+	Canvas images are predicted in batches. 
+	The next canvas images are decoded on background threads while the model predicts the current batch. 
+	The predictions are post-processed in worker processes (see postprocess_workers), while the model predicts the next batch. 
+	Returns
+	results: The output of postprocess_inputImage for each canvas image (in the order of input_files)
+	"""
+	results = []
+	batch_size = get_segmentation_batch_size(data)
+
+	# Note: The worker processes are forked before the prefetcher starts its decoding threads. 
+	# The TensorFlow threads already exist at this point, so the workers only run the numpy/cv2 post-processing (see PostprocessPool). 
+	postprocess_pool = PostprocessPool(data, num_workers=postprocess_workers)
+	try:
+		prefetcher = create_canvas_prefetcher(data, root_folder, input_files, batch_size)
+		for canvas_batch in prefetcher.iter_batches(batch_size):
+
+			# Predict segmentation for a batch of canvas images (the cached predictions are not predicted again)
+			pred_array_list = data.predict_input_batch(model, [canvas.img_input for canvas in canvas_batch], image_path_list=[canvas.image_path for canvas in canvas_batch])
 
-def generate_particlePredictions_from_inputImage(model, data,  target_file_path, output_folder_path): 
+			for batch_index, canvas in enumerate(canvas_batch):
+
+				# Define files/folders
+				output_folder_path = root_folder + output_folders[canvas.index]
+
+				# Convert to the uint8 label matrix before sending the prediction to a worker (the categorical array is 4*nclasses times larger)
+				pred_matrix = CNN_functions.predArray_to_predMatrix(pred_array_list[batch_index], data.config.target_size).astype(np.uint8, copy=False)
+
+				# Post-process the canvas image (collects the results of the canvas images that are already done)
+				results.extend(postprocess_pool.submit(postprocess_inputImage, mode, canvas.image_path, output_folder_path, pred_matrix, canvas.original_img))
+
+		results.extend(postprocess_pool.close())
+	finally:
+		# Stops the worker processes on an error (does nothing after close())
+		postprocess_pool.terminate()
+
+	prefetcher.log_throughput(data.config.logger)
+	data.log_prefilter_statistics(data.config.logger)
+	if data.get_prediction_cache() is not None:
+		data.get_prediction_cache().log_statistics(data.config.logger)
+
+	return results
+
+
+def postprocess_inputImage(data, mode, target_file_path, output_folder_path, pred_array, original_img):
+	"""
+	Description: Post-processes the predicted segmentation of a single canvas image. Runs in a PostprocessPool worker. 
+	Returns
+	In 'semantic' mode, the label of each particle. In 'crops' mode, None. 
+	"""
+	# Build output folders (if necessary)
+	build_segmentation_output_folder(output_folder_path)
+
+	if (mode == 'crops'):
+		# Produce crops 
+		generate_crops_from_inputImage(None, data, target_file_path, output_folder_path, pred_array=pred_array, original_img=original_img)
+		return None
+
+	# Produce labels from semantic segmentation of a single canvas image
+	return generate_particlePredictions_from_inputImage(None, data, target_file_path, output_folder_path, pred_array=pred_array, original_img=original_img)
+
+
+
+def generate_particlePredictions_from_inputImage(model, data,  target_file_path, output_folder_path, pred_array=None, original_img=None): 
 	"""
 	Description: Use semantic segmetnation approach to classify particles on a SINGLE image. 
+	pred_array: The segmentation predicted for target_file_path (e.g. from a batched prediction). If None, predicted with model. 
+	original_img: The already decoded canvas image (BGR). If None, loaded from target_file_path. The image is labeled in place. 
 	"""
 
 	# Get output prefix name
 	output_file_prefix = CNN_functions.get_file_name_from_path(target_file_path, remove_ext=True)
 
 	# Predict segmentation of original_img with segmentation model  
-	pred_array = data.predict_image(model, target_file_path)
+	if pred_array is None:
+		pred_array = data.predict_image(model, target_file_path)
 
 	# Obtain original image
-	original_img = cv2.imread(target_file_path)
-
-	# Temp (use for debugging as to generate predictions more rapidly)
-	#temp_prediction_path = root_folder + output_file_prefix + "_rawImgArray.bmp"
-	#pred_array = cv2.imread(temp_prediction_path, cv2.IMREAD_GRAYSCALE)
+	if original_img is None:
+		original_img = cv2.imread(target_file_path)
 
 	# Convert to labeled image.
 	pred_img = CNN_functions.predArray_to_predMatrix(pred_array, data.config.target_size)
@@ -220,31 +278,54 @@ def semanticImg_to_particleCounts(semantic_img, mask):
 
 	
 
+	# Count the pixel labels within each connected component in a single pass. 
+	# Each pixel is binned by its (component index, pixel label) pair. 
+	label_count = max(int(semantic_img.max()) + 1, discard_label + 1)
+	component_label_index = connectedComponents_mask.ravel().astype(np.int64)*label_count + semantic_img.ravel().astype(np.int64)
+	component_label_counts = np.bincount(component_label_index, minlength=connectedComponents_num*label_count)
+	component_label_counts = np.reshape(component_label_counts, (connectedComponents_num, label_count))
+
 	# Classify each connected component based on the labels within the semantic_img
-	particle_label_mask = np.zeros(semantic_img.shape)
-	component_labels = [] # list of all the images labels
-	for component_index in range(connectedComponents_num):
-
-		#  The first label is the background (zero label). We always ignore it. 
-		if component_index == 0:
-			continue
-
-		# Creates mask for a single connected component
-		target_component_mask = (connectedComponents_mask == component_index)
-		# Gets the labels in semantic_img that correspond to a single connected component. 
-		target_component_labels = semantic_img[target_component_mask]
-		# Calculates the particles single lable given a list of the labels for each pixel that particle has. 
-		particle_label = get_particleLabel_from_pixelLabels(target_component_labels, background=discard_label)
-		# Add label to list of labels for image
-		component_labels.append(particle_label)
-		
-		# Generate output image
-		particle_label_mask += target_component_mask * particle_label 
+	#  The first label is the background (zero label). We always ignore it. 
+	particle_labels = get_particleLabels_from_componentCounts(component_label_counts[1:], background=discard_label)
+	component_labels = list(particle_labels) # list of all the images labels
+
+	# Generate output image through a lookup table (maps each component index to the label of that component)
+	label_lookup = np.zeros(connectedComponents_num, dtype=semantic_img.dtype)
+	label_lookup[1:] = particle_labels
+	particle_label_mask = label_lookup[connectedComponents_mask]
 
 
 	return centroid_list, component_labels, particle_label_mask
 
 
+def get_particleLabels_from_componentCounts(component_label_counts, background = 0):
+	"""
+	Description: Vectorized version of get_particleLabel_from_pixelLabels for many particles. 
+	For each particle, find the label with the most pixels. Discard the background label as irrelevant. 
+	Ties are resolved in the same way as get_particleLabel_from_pixelLabels (the lowest label wins). 
+	component_label_counts: Array of size (particles, labels). Each row has the pixel count of each label within a single particle. 
+	background: The background label should never be returned. It is only returned if a particle has no other labels. 
+	Returns
+	particle_labels: Array with a single label for each particle. 
+	"""
+	if component_label_counts.shape[0] == 0:
+		return np.zeros(0, dtype=np.int64)
+
+	# Label with most counts (argmax returns the first maximum, so the lowest label wins a tie)
+	particle_labels = np.argmax(component_label_counts, axis=1)
+
+	# If the background has the most counts, use the label with the next most counts. 
+	counts_without_background = component_label_counts.copy()
+	counts_without_background[:, background] = -1
+	next_labels = np.argmax(counts_without_background, axis=1)
+	has_other_labels = counts_without_background[np.arange(len(next_labels)), next_labels] > 0
+	use_next_label = (particle_labels == background) & has_other_labels
+	particle_labels[use_next_label] = next_labels[use_next_label]
+
+	return particle_labels
+
+
 def get_particleLabel_from_pixelLabels(pixel_labels, background = 0):
 	"""
 	Description: A particle is made from many pixel labels. Given a list of pixel labels, find the label with the most pixels. 
@@ -268,22 +349,24 @@ def get_particleLabel_from_pixelLabels(pixel_labels, background = 0):
 	
 
 
-def generate_crops_from_inputImage(model, data, target_file_path, output_folder_path):
+def generate_crops_from_inputImage(model, data, target_file_path, output_folder_path, pred_array=None, original_img=None):
 	"""
 	Description: Use connectedComponents to determine predicted centroids of particles.
 	Create crops around each centroid to be classified with another model. Do for single image. 
+	pred_array: The segmentation predicted for target_file_path (e.g. from a batched prediction). If None, predicted with model. 
+	original_img: The already decoded canvas image (BGR). If None, loaded from target_file_path. 
 	"""
 
 	# Generate centroid list based on segmentation model
-	centroid_list = get_centroid_list(model, data, target_file_path, output_folder_path)
+	centroid_list = get_centroid_list(model, data, target_file_path, output_folder_path, pred_array=pred_array)
 
 
 	# Generate crops on input image based on the centroid_list (produced by segmentation model)
-	crop_based_on_centroids(target_file_path, centroid_list, output_folder_path)
+	crop_based_on_centroids(target_file_path, centroid_list, output_folder_path, original_img=original_img)
 
 
 
-def get_centroid_list(model, data, target_file_path, output_folder_path):
+def get_centroid_list(model, data, target_file_path, output_folder_path, pred_array=None):
 	"""
 	Description: Using the segmentation model, get the list of centroids generated from the target_file_path. 
 	# Possible To Do: Move saving results out of this function (should be done by user of function)
@@ -291,13 +374,33 @@ def get_centroid_list(model, data, target_file_path, output_folder_path):
 	data: object used to perform segmentations
 	target_file_path: The path to the input image to be segmented. 
 	output_folder_path: Location where outputs will be saved (centroid list and segmented image)
+	pred_array: The segmentation already predicted for target_file_path. If None, predicted with model. 
 	"""
 
 	# Get output prefix name
 	output_file_prefix = CNN_functions.get_file_name_from_path(target_file_path, remove_ext=True)
 
 	# Predict segmentation of original_img with segmentation model  
-	pred_array = data.predict_image(model, target_file_path)
+	if pred_array is None:
+		pred_array = data.predict_image(model, target_file_path)
+
+	# Obtain centroid list from the prediction
+	centroid_list, pred_image = get_centroids_from_prediction(data, pred_array)
+
+	# Save results: Segmented image + centroid list
+	save_centroid_debug_output(data, pred_image, centroid_list, output_folder_path + "debug_output/" + output_file_prefix)
+
+
+	return centroid_list
+
+
+def get_centroids_from_prediction(data, pred_array):
+	"""
+	Description: Get the list of particle centroids from the prediction of the segmentation model. 
+	Returns
+	centroid_list: Numpy array with the centroid of each particle, in (width, height) format. 
+	pred_image: The labeled prediction, after the morphological transformations. 
+	"""
 
 	# Apply morphological transformations
 	pred_image = CNN_functions.predArray_to_predMatrix(pred_array, data.config.target_size) # Convert from prediction arrays to labeled matrices
@@ -307,9 +410,14 @@ def get_centroid_list(model, data, target_file_path, output_folder_path):
 	pred_connected = cv2.connectedComponentsWithStats(pred_image.astype('int8'), connectivity=8)
 	centroid_list = np.asarray(pred_connected[3][1:])  # Remove the background centroid (at index 0).
 
+	return centroid_list, pred_image
+
 
+def save_centroid_debug_output(data, pred_image, centroid_list, output_debug_path_prefix):
+	"""
+	Description: Saves the segmented image and the centroid list (used for debugging). 
+	"""
 	# Save results: Segmented image
-	output_debug_path_prefix = output_folder_path + "debug_output/" + output_file_prefix 
 	img_output = CNN_functions.get_color_image(pred_image, data.config.nclasses, data.config.colors)
 	cv2.imwrite(output_debug_path_prefix + "_segmented.jpg", img_output)
 
@@ -319,68 +427,106 @@ def get_centroid_list(model, data, target_file_path, output_folder_path):
 	output_log.close()
 
 
-	return centroid_list
-
 
 
-
-def crop_based_on_centroids(target_file_path, centroid_list, output_folder_path):
+def crop_based_on_centroids(target_file_path, centroid_list, output_folder_path, original_img=None):
 	"""
 	Description: Crops the input image based on the centroids provided. 
 	Args:
 	centroid_list: List of centroids produced by connectedComponentsWithStats
 	output_folder_path: The path were the cropped images will be stored (as well as other outputs)
+	original_img: The already decoded canvas image (BGR). If None, loaded from target_file_path. 
 	"""
 
 	### Setup ###
-	# Load image
-	original_img = cv2.imread(target_file_path) 
-	original_cpy = None
-	if (debug_flag):
-		original_cpy = original_img.copy()
+	# Load image (if not already decoded)
+	if original_img is None:
+		original_img = cv2.imread(target_file_path) 
 
 	# Get output prefix name
 	output_file_prefix = CNN_functions.get_file_name_from_path(target_file_path, remove_ext=True)
 
-
 	# Crop each labeled particle from the original image. 
-	centroid_list = np.asarray(centroid_list)
-	for index, centroid in enumerate(centroid_list): 
+	crop_list, crop_centroid_list, cropped_flags = get_crops_from_centroids(original_img, centroid_list)
+
+	# Save cropped images
+	save_crops(crop_list, crop_centroid_list, output_folder_path, output_file_prefix)
+			
+	# Save output with cropped images
+	if (debug_flag):
+		original_cpy = draw_crop_indicators(original_img.copy(), centroid_list, cropped_flags)
+		debug_img_output_path = output_folder_path + "debug_output/" + output_file_prefix + "_flagged_crops.bmp"
+		cv2.imwrite(debug_img_output_path, original_cpy)
+
+
+def get_crops_from_centroids(original_img, centroid_list):
+	"""
+	Description: Crops the input image around each centroid. 
+	Crop particles when 1) the particle has the correct dimensions (not a boundary particle) or when we crop all particles (even boundary particles)
+	Returns
+	crop_list: List of crops (BGR). 
+	crop_centroid_list: The centroid of each crop in crop_list. 
+	cropped_flags: List of bools that indicate if each centroid in centroid_list was cropped. 
+	"""
+	crop_list = []
+	crop_centroid_list = []
+	cropped_flags = []
+	for centroid in np.asarray(centroid_list): 
 
 		# Crop Original image
 		x1, x2, y1, y2 = CNN_functions.get_crop_coordinates(original_img.shape, centroid, output_crop_size)
 		crop = original_img[y1:y2,x1:x2]
 
-
-		# Save cropped images
-		# Crop particles when 1) the particle has the correct dimensions (not a boundary particle) or when we crop all particles (even boundary particles)
 		crop_has_target_dim = (crop.shape[0] == output_crop_size) and (crop.shape[1] == output_crop_size)
 		if crop_has_target_dim or keep_boundary_particles:
-			# Save cropped image
-			# Important: Order of centroid data important! Used as a feature later. 
-			file_name =  output_file_prefix + "_" + str(int(centroid[0])) + "_" + str(int(centroid[1])) + ".bmp"
+			crop_list.append(crop)
+			crop_centroid_list.append(centroid)
+		cropped_flags.append(crop_has_target_dim or keep_boundary_particles)
+
+	return crop_list, crop_centroid_list, cropped_flags
+
+
+def save_crops(crop_list, crop_centroid_list, output_folder_path, output_file_prefix):
+	"""
+	Description: Saves the crops of a single canvas into output_folder_path, either as .bmp files or as a single shard (see crop_output_format). 
+	"""
+	# Collect crops into a single shard (instead of a file per crop)
+	shard_writer = None
+	if (crop_output_format == 'shard'):
+		shard_writer = CropShard.CropShardWriter(output_folder_path + "data/shards/" + output_file_prefix, crop_size=output_crop_size, channels=3)
+
+	for crop, centroid in zip(crop_list, crop_centroid_list):
+		# Important: Order of centroid data important! Used as a feature later. 
+		file_name =  output_file_prefix + "_" + str(int(centroid[0])) + "_" + str(int(centroid[1])) + ".bmp"
+		if shard_writer is not None:
+			# Shards need crops with identical dimensions. Boundary crops are resized (the classifier resizes .bmp crops when loading them)
+			if (crop.shape[0] != output_crop_size) or (crop.shape[1] != output_crop_size):
+				crop = cv2.resize(crop, (output_crop_size, output_crop_size), interpolation=cv2.INTER_AREA)
+			shard_writer.add_crop(crop, centroid, canvas_name=output_file_prefix, name=file_name)
+		else:
 			output_path = output_folder_path + "data/images/" + file_name
 			cv2.imwrite(output_path, crop)
-			indicator_color = (0, 255, 0) # Indicator color when cropped
-		else:
-			indicator_color = (255, 0, 0) # Indicator color when not cropped
-		
-
-		# Place indicator for each ground truth partidcle detected. 
-		if (debug_flag): 
-			circl_centroid = (int(centroid[0]), int(centroid[1]))
-			cv2.circle(
-				original_cpy, 
-				center=circl_centroid, 
-				radius=indicator_radius, 
-				color=indicator_color, 
-				thickness=3)
 
-			
-	# Save output with cropped images
-	if (debug_flag):
-		debug_img_output_path = output_folder_path + "debug_output/" + output_file_prefix + "_flagged_crops.bmp"
-		cv2.imwrite(debug_img_output_path, original_cpy)
+	# Save the shard with all crops from the canvas
+	if shard_writer is not None:
+		shard_writer.close()
+
+
+def draw_crop_indicators(original_img, centroid_list, cropped_flags):
+	"""
+	Description: Place indicator for each particle detected. Green when cropped, blue when not cropped. 
+	"""
+	for centroid, cropped in zip(centroid_list, cropped_flags):
+		indicator_color = (0, 255, 0) if cropped else (255, 0, 0)
+		circl_centroid = (int(centroid[0]), int(centroid[1]))
+		cv2.circle(
+			original_img, 
+			center=circl_centroid, 
+			radius=indicator_radius, 
+			color=indicator_color, 
+			thickness=3)
+
+	return original_img
 	
 
 def scale_centroid(centroid, factor):
@@ -440,20 +586,47 @@ def initialize_segmentation_model(log_dir=None, log_prefix=None):
 	# Instantiate training/validation data
 	data = SegmentParticlesData(config)
 
-	# Builds model
-	model = createModel(input_shape = config.image_shape, base_weights = config.imagenet_weights_file, classes=config.nclasses)
+	# Builds model and loads weights (the imagenet weights are skipped when the checkpoint exists)
+	# Note: With tile_inference, the model is built with the tile dimensions (weights are independent of input size). 
+	model = CNN_functions.build_model_for_inference(createModel, config.inference_shape, config)
 
-	# Load weights (if the load file exists)
-	CNN_functions.load_model(model, config.weight_file_input, config)
+	# Move the argmax into the model (the tiled predictions are blended before the argmax, so are converted after prediction)
+	if (config.compact_prediction and not config.tile_inference):
+		model = FCN8_compact_output(model, include_confidence=config.compact_confidence)
 
 	return model, data
 
 
+def get_segmentation_batch_size(data):
+	"""
+	Description: Returns segmentation_batch_size. If not configured, determines the batch size from the available memory. 
+	"""
+	batch_size = segmentation_batch_size
+	if batch_size is None:
+		batch_size = data.get_auto_batch_size()
+
+	data.config.logger.info("Canvas images per prediction batch: %d", batch_size)
+
+	return batch_size
+
+
+def create_canvas_prefetcher(data, root_folder, input_files, batch_size):
+	"""
+	Description: Creates the pipeline that decodes the canvas images in input_files ahead of the model. 
+	At least a full batch is decoded ahead, so that the next batch is ready when the model finishes the current batch. 
+	"""
+	image_path_list = [root_folder + target_file for target_file in input_files]
+	prefetch_count = max(prefetch_canvas_count, batch_size)
+
+	return CanvasPrefetcher(data, image_path_list, prefetch_count=prefetch_count, num_workers=decode_workers)
+
+
 def build_segmentation_output_folder(output_folder_path):
 
 	if (not os.path.isdir(output_folder_path)): 
 		os.makedirs(output_folder_path)
 		os.makedirs(output_folder_path + "data/images/")
+		os.makedirs(output_folder_path + "data/shards/")
 		os.makedirs(output_folder_path + "debug_output/")
 
 def clean_up_old_output_folders(root_folder, output_folders):
@@ -12,7 +12,7 @@ import h5py
 
 # Import keras libraries
 from tensorflow.python.keras.models import Model # Allows to build more complex models than Sequential
-from tensorflow.python.keras.layers import Conv2D, MaxPooling2D, Input, Dropout, Conv2DTranspose, Cropping2D, Add, Reshape, Permute, Activation # Import custom layers. 
+from tensorflow.python.keras.layers import Conv2D, MaxPooling2D, Input, Dropout, Conv2DTranspose, Cropping2D, Add, Reshape, Permute, Activation, Lambda # Import custom layers. 
 from tensorflow.python.keras._impl.keras import backend as K
 
 
@@ -22,7 +22,7 @@ def FCN8_32px_factor(input_shape, base_weights, classes):
 	Configuration: data_format => channel_last
 	Args: 
 	input_shape: shape of image, including the channel. The format is (input_height, input_width ,channels)
-	base_weights: Path to file with pre-trained weights. 
+	base_weights: Path to file with pre-trained weights. If None, the pre-trained weights are not loaded (e.g. when a checkpoint is loaded afterwards). 
 	Return: 
 	An instantiated model.
 	Notes: Comments explain model/data with a 64x64px input. Model design for input image size that is a fact of 32px. 
@@ -96,7 +96,8 @@ def FCN8_32px_factor(input_shape, base_weights, classes):
 
 	# Load VGG16 weights for convolutional layers obtained from imagenet training
 	vgg_noFC  = Model(  img_input , f5  )
-	vgg_noFC.load_weights(base_weights)
+	if base_weights is not None:
+		vgg_noFC.load_weights(base_weights)
 
 
 	### Converting fully connected layers (fc6 and fc7) to fully convolutional layers. ####
@@ -169,4 +170,39 @@ def FCN8_32px_factor(input_shape, base_weights, classes):
 	assert model.outputWidth == input_shape[1]
 
 
-	return model
\ No newline at end of file
+	return model
+
+
+def FCN8_compact_output(model, include_confidence=False):
+	"""
+	Inference variant of FCN8_32px_factor: Moves the argmax of the softmax output into the graph. 
+	Args: 
+	model: An instantiated FCN8_32px_factor model (weights can be loaded before or after wrapping, since the added layers have no weights). 
+	Also accepts a model loaded from a saved file (see CNN_functions.build_model_for_inference), which doesn't have the outputHeight/outputWidth attributes. 
+	include_confidence: If True, the model also outputs the max-probability of each pixel. 
+	Return: 
+	A model that outputs a uint8 (height, width) label map. With include_confidence, outputs [label_map, confidence_map]. 
+	The confidence_map is the max-probability quantized to uint8 (0 => 0.0, 255 => 1.0). 
+	Notes: Compared to the float32 (height*width, classes) output, the label map is classes*4 times smaller. 
+	"""
+
+	# The output of FCN8_32px_factor has the same height and width as its input
+	outputHeight, outputWidth = model.input_shape[1:3]
+
+	# Input: (height*width, classes), Output: (height, width, classes)
+	probabilities = Reshape((outputHeight, outputWidth, -1), name='probability_map')(model.output)
+
+	# Input: (height, width, classes), Output: (height, width) as uint8
+	label_map = Lambda(lambda x: K.cast(K.argmax(x, axis=-1), 'uint8'), name='label_map')(probabilities)
+	outputs = [label_map]
+
+	# Input: (height, width, classes), Output: (height, width) as uint8
+	if (include_confidence):
+		confidence_map = Lambda(lambda x: K.cast(K.round(K.max(x, axis=-1)*255.0), 'uint8'), name='confidence_map')(probabilities)
+		outputs.append(confidence_map)
+
+	compact_model = Model(model.input, outputs)
+	compact_model.outputWidth = outputWidth
+	compact_model.outputHeight = outputHeight
+
+	return compact_model
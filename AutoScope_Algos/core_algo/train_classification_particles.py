@@ -13,6 +13,7 @@ from ClassifyParticlesData import ClassifyParticlesData
 import CNN_functions
 from classification_models import base_model_with_pos as createModel
 from ClassifyParticles_config import ClassifyParticles_Config
+from BatchPrefetcher import BatchPrefetcher
 
 
 
@@ -26,8 +27,18 @@ CNN_functions.validate_classification_config(config)
 data = ClassifyParticlesData(config)
 
 # Create necessary data generators
-train_generator = data.create_custom_labeled_generator(target_directory=config.train_images_dir, augment_data=True)
-val_generator = data.create_custom_labeled_generator(target_directory=config.val_images_dir, augment_data=False)
+if (config.use_packed_dataset):
+	create_train_generator = lambda: data.create_packed_labeled_generator(pack_prefix=config.train_pack_prefix, augment_data=True)
+	val_generator = data.create_packed_labeled_generator(pack_prefix=config.val_pack_prefix, augment_data=False)
+else:
+	create_train_generator = lambda: data.create_custom_labeled_generator(target_directory=config.train_images_dir, augment_data=True)
+	val_generator = data.create_custom_labeled_generator(target_directory=config.val_images_dir, augment_data=False)
+
+# Build the training batches on background threads (see BatchPrefetcher)
+if (config.prefetch_workers > 0):
+	train_generator = BatchPrefetcher(create_train_generator, num_workers=config.prefetch_workers, queue_size=config.prefetch_queue_size)
+else:
+	train_generator = create_train_generator()
 
 # Print configuration
 CNN_functions.print_configurations(config) # Print config summary to log file
@@ -13,6 +13,7 @@ from SegmentParticlesData import SegmentParticlesData
 import CNN_functions
 from segmentation_models import FCN8_32px_factor as createModel
 from SegmentParticles_config import SegmentParticles_Config
+from BatchPrefetcher import BatchPrefetcher
 
 
 # Instantiates configuration for training/validation
@@ -25,9 +26,15 @@ CNN_functions.validate_segmentation_config(config)
 data = SegmentParticlesData(config)
 
 # Create necessary data generators
-train_generator = data.get_data_generator(config.train_images_dir, config.train_annotations_dir) 
+create_train_generator = lambda: data.get_data_generator(config.train_images_dir, config.train_annotations_dir) 
 val_generator = data.get_data_generator(config.val_images_dir, config.val_annotations_dir)
 
+# Build the training batches on background threads (see BatchPrefetcher)
+if (config.prefetch_workers > 0):
+	train_generator = BatchPrefetcher(create_train_generator, num_workers=config.prefetch_workers, queue_size=config.prefetch_queue_size)
+else:
+	train_generator = create_train_generator()
+
 # Print configuration
 CNN_functions.print_configurations(config) # Print config summary to log file
 data.print_data_summary() # Print data summary to log file
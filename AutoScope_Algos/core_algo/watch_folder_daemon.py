@@ -0,0 +1,171 @@
+# Import basic libraries
+import os
+import time
+import argparse
+import traceback
+import numpy as np
+from glob import glob
+
+# import from local libraries
+import CNN_functions
+from CanvasManifest import CanvasManifest
+import process_urine_segment as segment
+import process_urine_end_to_end as end_to_end
+
+"""
+Description: Watches solution folders for new canvas images, and segments + classifies each canvas exactly once.
+Replaces re-running process_urine_end_to_end.py on a folder that is still being captured.
+
+Execution Notes:
++ Start: python watch_folder_daemon.py --root_folder ./path/to/sol1/ ./path/to/sol2/
++ Each root_folder is a solution folder with '.bmp' canvas images (same folder setup as process_urine_end_to_end.py).
++ The outputs of each canvas are saved in the same output folder as process_urine_end_to_end.py (e.g. img1_e2e/).
++ Completed canvases are recorded in a manifest in each root folder (see CanvasManifest). A restart resumes where it left off.
++ The summary statistics of each solution are updated (and logged) after each canvas. They are also stored in the manifest.
++ Stop with Ctrl-C.
+
+Implementation Notes:
++ A canvas is only processed once its size and modification time are unchanged between two polls (so canvases that are still being written are not read).
++ A canvas that was interrupted by a restart has no manifest entry. Its partial outputs are removed, and it is processed again.
++ A canvas that fails max_attempts times is recorded as failed, and is not retried.
+++ When a batch of canvases fails, the unrecorded canvases are retried one at a time. Only a failure of a single canvas counts as an attempt (the failing canvas of a batch is not known).
++ The segmentation/classification settings are configured in process_urine_segment.py and process_urine_end_to_end.py
+"""
+
+""" Configuration """
+# Time (in seconds) between two scans of the root folders
+poll_interval = 10
+# Number of times processing a canvas is attempted before it's recorded as failed
+max_attempts = 3
+# Suffix of the output folder of each canvas (same as process_urine_end_to_end.py)
+output_folder_suffix = "e2e"
+
+
+
+def main():
+
+	# Get root folders from user
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-r","--root_folder", help="Paths to the solution folders to watch", type=str, nargs='+', required=True)
+	args = parser.parse_args()
+
+	for root_folder in args.root_folder:
+		if (not os.path.isdir(root_folder)):
+			raise ValueError("watch_folder_daemon: Root folder doesn't exist: %s" % root_folder)
+
+	# Builds the models a single time (the logs are saved in the first root folder)
+	seg_model, seg_data = segment.initialize_segmentation_model(log_dir=args.root_folder[0], log_prefix="daemon_")
+	class_model, class_data = CNN_functions.initialize_classification_model(log_dir=args.root_folder[0])
+	logger = class_data.config.logger
+
+	watcher_list = [SolutionWatcher(root_folder) for root_folder in args.root_folder]
+	for watcher in watcher_list:
+		logger.info("Watching: %s (%d canvas images already processed)", watcher.root_folder, watcher.manifest.get_canvas_count())
+
+	try:
+		while True:
+			for watcher in watcher_list:
+				ready_path_list = watcher.get_ready_canvases()
+				if ready_path_list:
+					watcher.process_canvases(ready_path_list, seg_model, seg_data, class_model, class_data)
+
+			time.sleep(poll_interval)
+	except KeyboardInterrupt:
+		logger.info("Watch folder daemon stopped.")
+
+
+
+class SolutionWatcher(object):
+	"""
+	Description: Tracks the canvas images of a single solution folder.
+	"""
+
+	def __init__(self, root_folder):
+		self.root_folder = root_folder
+		self.manifest = CanvasManifest(root_folder, end_to_end.class_mapping)
+		self.previous_file_stats = {} # Maps canvas path to (size, modification time) at the previous poll
+		self.attempt_counts = {} # Maps canvas file name to the number of failed attempts
+
+
+	def get_ready_canvases(self):
+		"""
+		Description: Returns the paths to the canvas images that are not processed yet, and are completely written.
+		"""
+		ready_path_list = []
+		file_stats = {}
+		for image_path in sorted(glob(self.root_folder + "*.bmp")):
+			if self.manifest.is_done(os.path.basename(image_path)):
+				continue
+
+			try:
+				stat = os.stat(image_path)
+			except OSError: # Removed since the scan
+				continue
+
+			# Unchanged since the previous poll
+			file_stats[image_path] = (stat.st_size, stat.st_mtime)
+			if self.previous_file_stats.get(image_path) == file_stats[image_path]:
+				ready_path_list.append(image_path)
+
+		self.previous_file_stats = file_stats
+
+		return ready_path_list
+
+
+	def process_canvases(self, image_path_list, seg_model, seg_data, class_model, class_data):
+		"""
+		Description: Segments and classifies the canvas images. Records each canvas in the manifest as soon as its outputs are saved.
+		"""
+		logger = class_data.config.logger
+
+		# Remove partial outputs (e.g. of a canvas interrupted by a restart)
+		output_folders = [CNN_functions.get_file_name_from_path(image_path) + "_" + output_folder_suffix + "/" for image_path in image_path_list]
+		segment.clean_up_old_output_folders(self.root_folder, output_folders)
+		output_folder_paths = [self.root_folder + target_folder for target_folder in output_folders]
+
+		try:
+			for classified_canvas in end_to_end.classify_particles_in_canvases(seg_model, seg_data, class_model, class_data, image_path_list, output_folder_paths):
+				file_name = os.path.basename(classified_canvas.image_path)
+				label_list = np.argmax(classified_canvas.label_pred, axis=1)
+				self.manifest.record_canvas(file_name, label_list)
+
+				# Update the summary of the solution
+				logger.info("Processed: %s (%d particles)", classified_canvas.image_path, len(label_list))
+				logger.info("Solution Results Summary: %s (%d canvas images)", self.root_folder, self.manifest.get_canvas_count())
+				CNN_functions.print_summary_statistics_for_label_counts(
+					self.manifest.label_counts,
+					end_to_end.class_mapping,
+					class_data.config,
+					discard_label= end_to_end.discard_label,
+					image_count = self.manifest.get_canvas_count())
+
+		except Exception:
+			# All canvases that are not recorded are retried. 
+			error = traceback.format_exc()
+			unrecorded_path_list = [image_path for image_path in image_path_list if not self.manifest.is_done(os.path.basename(image_path))]
+			if not unrecorded_path_list: # All canvases are recorded (e.g. the summary or the teardown failed). So, no canvas is retried. 
+				logger.error("Watch folder daemon: Failed after all canvases were processed.\n%s", error)
+				return
+
+			# The canvases are decoded and segmented in batches. So, a failure can't be attributed to a single canvas (a corrupt canvas fails the canvases before it in the batch). 
+			# Each unrecorded canvas is retried on its own, and only a failure of a single canvas counts as an attempt. 
+			if (len(image_path_list) > 1):
+				logger.error("Watch folder daemon: Failed to process a batch of %d canvases. Retrying the %d unrecorded canvases one at a time.\n%s", 
+					len(image_path_list), len(unrecorded_path_list), error)
+				for image_path in unrecorded_path_list:
+					self.process_canvases([image_path], seg_model, seg_data, class_model, class_data)
+				return
+
+			failed_path = unrecorded_path_list[0]
+			logger.error("Watch folder daemon: Failed to process %s.\n%s", failed_path, error)
+
+			file_name = os.path.basename(failed_path)
+			self.attempt_counts[file_name] = self.attempt_counts.get(file_name, 0) + 1
+			if (self.attempt_counts[file_name] >= max_attempts):
+				logger.error("Watch folder daemon: Giving up on %s after %d attempts.", failed_path, max_attempts)
+				self.manifest.record_failure(file_name, error)
+
+
+
+if __name__ == "__main__":
+	main()
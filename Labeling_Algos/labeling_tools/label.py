@@ -105,27 +105,20 @@ def label_foregound(log_path):
 
 	# Load image
 	im_overlay = cv2.imread(input_image_path) # Careful: format in BGR
-	im_mask = np.zeros(im_overlay.shape)
-	im_mask_display = np.zeros(im_overlay.shape)
 
 	# Load the coordinate data structure saved in JSON format. 
 	log = open(log_path, 'r')
 	particle_list = json.load(log)
 	log.close()
 
-	# Label foreground pixels
-	for index in range(len(particle_list)):
-
-		centroid = particle_list[index]
-		centroid = (int(centroid[0]), int(centroid[1]))
-		cv2.circle(im_overlay, center=centroid, radius=indicator_radius, color=(255,255,255), thickness=-1) # Label pixels on overlay image
-		cv2.circle(im_mask, center=centroid, radius=indicator_radius, color=(1,1,1), thickness=-1) # Label pixels on mask image
-		cv2.circle(im_mask_display, center=centroid, radius=indicator_radius, color=(255,255,255), thickness=-1) # Label pixels on mask image
+	# Label foreground pixels (single-channel mask, the 3-channel masks are only created when they are saved)
+	label_mask = utility_functions.rasterize_labels(im_overlay.shape, particle_list, [0]*len(particle_list), indicator_radius)
+	im_overlay = utility_functions.labels_to_image(label_mask, [(255,255,255)], output_image=im_overlay) # Label pixels on overlay image
 
 	# Save input image with selected particles shown
 	cv2.imwrite(output_image_overlay_path, im_overlay)
-	cv2.imwrite(output_image_annotated_path, im_mask)
-	cv2.imwrite(output_image_display_path, im_mask_display)
+	cv2.imwrite(output_image_annotated_path, utility_functions.labels_to_image(label_mask, [(1,1,1)])) # Label pixels on mask image
+	cv2.imwrite(output_image_display_path, utility_functions.labels_to_image(label_mask, [(255,255,255)])) # Label pixels on mask image
 
 
 def label_classes(log_path):
@@ -151,8 +144,6 @@ def label_classes(log_path):
 
 	# Load image
 	im_overlay = cv2.imread(input_image_path) # Careful: format in BGR
-	im_mask = np.zeros(im_overlay.shape)
-	im_mask_display = np.zeros(im_overlay.shape)
 
 	# Load the coordinate data structure saved in JSON format. 
 	log = open(log_path, 'r')
@@ -169,24 +160,28 @@ def label_classes(log_path):
 	# Preselect random colors
 	colors = [(random.randint(0,255),random.randint(0,255),random.randint(0,255)) for _ in range(nclasses-1)]
 
+	indicator_colors = [colors[pixel_label - 1] for pixel_label in range(nclasses)] # "-1" since first non-background label is 1. 
+	class_colors = [(pixel_label, pixel_label, pixel_label) for pixel_label in range(nclasses)]
+
+	label_list = []
 	for index in range(len(particle_list)):
 		#colors = [(0,0,255), (0,255,0), (255,0,0), (255,255,255)]
 		centroid = particle_list[index][0]
 		class_metadata = particle_list[index][1]
 		pixel_label = metadata_to_label(class_metadata)
 		centroid = (int(centroid[0]), int(centroid[1]))
-		indicator_color = colors[pixel_label - 1] # "-1" since first non-background label is 1. 
-		class_color = (pixel_label, pixel_label, pixel_label)
+		label_list.append(pixel_label)
 
 		# Add indicators to image. 
-		cv2.circle(im_overlay, center=centroid, radius=indicator_radius, color=indicator_color, thickness=3) # Label pixels on overlay image
-		cv2.circle(im_mask, center=centroid, radius=indicator_radius, color=class_color, thickness=-1) # Label pixels on mask image (class color)
-		cv2.circle(im_mask_display, center=centroid, radius=indicator_radius, color=indicator_color, thickness=-1) # Label pixels on mask (variable color)
+		cv2.circle(im_overlay, center=centroid, radius=indicator_radius, color=indicator_colors[pixel_label], thickness=3) # Label pixels on overlay image
+
+	# Label pixels on the masks (single-channel mask, the 3-channel masks are only created when they are saved)
+	label_mask = utility_functions.rasterize_labels(im_overlay.shape, [particle[0] for particle in particle_list], label_list, indicator_radius)
 
 	# Save input image with selected particles shown
 	cv2.imwrite(output_image_overlay_path, im_overlay)
-	cv2.imwrite(output_image_annotated_path, im_mask)
-	cv2.imwrite(output_image_display_path, im_mask_display)
+	cv2.imwrite(output_image_annotated_path, utility_functions.labels_to_image(label_mask, class_colors)) # Mask image (class color)
+	cv2.imwrite(output_image_display_path, utility_functions.labels_to_image(label_mask, indicator_colors)) # Mask (variable color)
 
 
 
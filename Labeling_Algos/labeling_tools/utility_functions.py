@@ -1,5 +1,11 @@
 import os
 import cv2
+import numpy as np
+
+# Note: rasterize_labels, get_disc_kernel and labels_to_image are duplicated in AutoScope_Algos/core_algo/data_preperation/utility_functions_data.py
+# (Labeling_Algos and AutoScope_Algos are run from their own folders, and don't import from each other). Keep both copies identical.
+# Pixel offsets of the filled circles drawn by cv2.circle, for each radius. See get_disc_kernel
+_disc_kernels = {}
 
 
 
@@ -55,4 +61,86 @@ def get_image_file_name(log_path):
 	image_file_name = log_path[fileName_start+1:fileName_end]
 	subfolder_end = log_path.rfind("/",0, fileName_start) + 1
 	subfolder = log_path[:subfolder_end]
-	return image_file_name, subfolder
\ No newline at end of file
+	return image_file_name, subfolder
+
+
+def rasterize_labels(image_shape, centroid_list, label_list, radius):
+	"""
+	Description: Rasterizes a filled circle for each particle into a single-channel uint8 label mask. 
+	The pixels of each circle are a precomputed kernel (see get_disc_kernel), so all the circles are stamped with a single vectorized assignment. 
+	Pixel-identical to drawing the filled circles with cv2.circle, one by one, in the order of centroid_list (later circles are drawn on top). 
+	Args
+	image_shape: The shape of the labeled image (only the height and width are used). 
+	centroid_list: The centroid of each particle, in (width, height) format. 
+	label_list: The label of each particle (0 to 254). 
+	radius: the indicator radius
+	Return
+	label_mask: uint8 array of size (height, width). label+1 for pixels within a circle, and 0 for pixels without a circle. 
+	"""
+	height, width = image_shape[:2]
+	label_mask = np.zeros((height, width), dtype=np.uint8)
+	if (len(centroid_list) == 0):
+		return label_mask
+
+	label_array = np.asarray(label_list, dtype=int)
+	if (label_array.min() < 0) or (label_array.max() > 254):
+		raise ValueError("rasterize_labels: Labels need to be between 0 and 254.")
+
+	# Truncate centroids (same as the int() cast for cv2.circle)
+	centroids = np.array([(int(centroid[0]), int(centroid[1])) for centroid in centroid_list])
+
+	# Pixels of each circle: (particles, kernel pixels)
+	row_offsets, col_offsets = get_disc_kernel(radius)
+	rows = centroids[:, 1:2] + row_offsets
+	cols = centroids[:, 0:1] + col_offsets
+	values = np.repeat(label_array + 1, len(row_offsets)).astype(np.uint8)
+
+	# Remove pixels outside the image
+	inside = ((rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)).ravel()
+	pixel_index = (rows*width + cols).ravel()[inside]
+	values = values[inside]
+
+	# Overlapping circles: Keep the last circle of each pixel (the first occurrence in reversed order)
+	pixel_index, first_index = np.unique(pixel_index[::-1], return_index=True)
+	label_mask.ravel()[pixel_index] = values[::-1][first_index]
+
+	return label_mask
+
+
+def get_disc_kernel(radius):
+	"""
+	Description: Returns the pixels of a filled circle drawn with cv2.circle, relative to the circle center. Computed once for each radius. 
+	Note: Only filled circles. cv2 clips thick outlines (thickness > 1) differently at the image border, so stamped outlines wouldn't be pixel-identical there. 
+	Return
+	row_offsets, col_offsets: int arrays with the row/column offset of each pixel. 
+	"""
+	if radius not in _disc_kernels:
+		center = radius + 1
+		kernel_img = np.zeros((2*center+1, 2*center+1), dtype=np.uint8)
+		cv2.circle(kernel_img, center=(center, center), radius=radius, color=1, thickness=-1)
+		row_offsets, col_offsets = np.nonzero(kernel_img)
+		_disc_kernels[radius] = (row_offsets - center, col_offsets - center)
+
+	return _disc_kernels[radius]
+
+
+def labels_to_image(label_mask, color_list, output_image=None):
+	"""
+	Description: Colors a label mask (see rasterize_labels). Only needed to save the mask or to draw it on an image. 
+	Args
+	label_mask: uint8 array of size (height, width) with label+1 for each labeled pixel. 
+	color_list: The color of each label. 
+	output_image: The image the labels are drawn on (in place). If None, a new uint8 image (zeros for unlabeled pixels). 
+	Return
+	labeled_image: The image with the color of each labeled pixel. 
+	"""
+	color_lut = np.zeros((256, len(color_list[0])), dtype=np.uint8)
+	color_lut[1:len(color_list)+1] = color_list
+
+	if output_image is None:
+		return color_lut[label_mask]
+
+	labeled_pixels = label_mask > 0
+	output_image[labeled_pixels] = color_lut[label_mask[labeled_pixels]]
+
+	return output_image